@@ -88,7 +88,7 @@ if __name__ == "__main__":
                     ]
     
     
-    device.open_port()
+    device.connect()
     device.log_message("COMMANDS", "Sending commands:" + str(queries))
     device.send_commands(queries)
-    device.close_port()
+    device.disconnect()
@@ -30,7 +30,7 @@ if __name__ == "__main__":
     config_file = args.INI
     device = instrument(config_file = config_file)
 
-    device.open_port()
+    device.connect()
 
     for s in args.commands:
         device.log_message("COMMANDS", "Sending command '" + s + "'") 
@@ -37,7 +37,7 @@ if __name__ == "__main__":
 
     config_file = args.INI
     device = instrument(config_file = config_file)
-    device.open_port()
+    device.connect()
     
     queries = []
 
@@ -140,4 +140,4 @@ if __name__ == "__main__":
         device.log_message("COMMANDS", "ERROR: Valid licor-status: on and off.")
 
     device.send_commands(queries)
-    device.close_port()
+    device.disconnect()
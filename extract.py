@@ -2,6 +2,8 @@
 
 import configparser, argparse        # for argument parsing
 import os, sys, glob
+import io, json      # for the checkpoint of incremental runs
+import multiprocessing, traceback # for --jobs
 import ast             # for datastring parsing
 from collections import namedtuple
 import numpy as np
@@ -20,8 +22,14 @@ matplotlib.use('Agg') # needed when running from cronjob
 from fatcat_uploader import Uploader # httpsend command for uploading data
 from fatcat_uploader import FileUploader # httpsend command for uploading data
 from plot_event import Datafile
-from gui import hex2bin
+from status_byte import statusKeys, decode_status, status_bit
 from log import log_message
+from raw_cache import RawCache
+from raw_lines import scan_lines, count_tabs, count_chars, parsed_lines, count_parsed_lines, \
+     BAD_CHARS
+from event_engine import find_events, is_sorted, trapz_intervals, event_windows, \
+     window_means, near_rounding_tie
+from event_index import update_index
 
 ppmtoug = 12.01/22.4 # factor to convert C in ppm to ug/lt at 0 degC and 1atm
 
@@ -56,8 +64,29 @@ class EventError(Exception):
 class Rawfile(object):
     def __init__(self, datafile, events_path, integral_length,
                  data_length, baseline_length, all_events = True,
-                 baseline = False): # datafile is a valid filepointer
+                 baseline = False, cache = None): # datafile is a valid filepointer
 
+        self._setup(datafile, events_path, integral_length, data_length, baseline_length,
+                    baseline, cache)
+        self._load()
+        
+        print >>sys.stderr, '{1}\nCounting events in datafile "{0}"'.format(self.datafile, time.asctime( time.localtime(time.time()) ))
+        events = self._countAndFetchEvents()
+        events = self._dropIncompleteEvents(events)
+        self.numEvents  = len(events)
+            
+        self.sample_volume, self.sample_co2 = self._calculateAllSamplingVolumes()
+        self.resultsDf['sample'] = self.sample_volume
+        self.resultsDf['sample co2'] = self.sample_co2
+
+        print >>sys.stderr, '{0} lines of data.\n{1} event(s) found at index(es): {2}'.format(self.numSamples, len(self.resultsDf), events)
+        if not all_events:
+            self.resultsDf = self.resultsDf.iloc[[-1]].reset_index(drop=True)
+            self.numEvents = 1
+            
+
+    def _setup(self, datafile, events_path, integral_length, data_length, baseline_length,
+               baseline = False, cache = None):
         #init data structure
         self.datastring = ""
         self.eventfileSuffix = "-eventdata.csv"
@@ -65,8 +94,11 @@ class Rawfile(object):
         self.csvfile    = datafile
         self.eventDir = events_path
         self.date       = time.strftime("%Y-%m-%d")
-        self.skipedlines = []
+        self.skipedlines = [] # line numbers of the corrupt lines
+        self.chunkSize  = 10000 # lines per chunk when the file has corrupt lines
         self.baseline = baseline
+        self.cache      = cache # RawCache with the parsed data (optional)
+        self.windowCache = None # see _eventWindows()
 
         self.eventKeys = [
             "index",
@@ -159,62 +191,48 @@ class Rawfile(object):
             "userfile"]
 
         # interpretation of bits on the "Status Byte" column
-        self.statusKeys = [
-            "valve",   # internal valve
-            "pump",    # internal pump
-            "fan",
-            "oven",    # induction furnace
-            "band",    # cat. heater
-            "licor",   # external valve
-            "res2",    # external pump
-            "res"]     
+        self.statusKeys = statusKeys[:]
 
         self.fileData = pd.DataFrame(columns = self.keys)
-        self._load()
-        
-        print >>sys.stderr, '{1}\nCounting events in datafile "{0}"'.format(self.datafile, time.asctime( time.localtime(time.time()) ))
-        events = self._countAndFetchEvents()
-        # in case there is not enough data for the last event ignore it
-        if events[-1] >= self.numSamples - data_length*2: 
-           events = events[:-2]
-        self.numEvents  = len(events)
-            
-        self.sample_volume = []
-        self.sample_co2 = []
-        for event in range(0,self.numEvents):
-            volume, co2 = self._calculateSamplingVolume(event)
-            self.sample_volume.append(volume)
-            self.sample_co2.append(co2)
-        self.resultsDf['sample'] = self.sample_volume
-        self.resultsDf['sample co2'] = self.sample_co2
-
-        print >>sys.stderr, '{0} lines of data.\n{1} event(s) found at index(es): {2}'.format(self.numSamples, len(self.resultsDf), events)
-        if not all_events:
-            self.resultsDf = self.resultsDf.iloc[[-1]].reset_index(drop=True)
-            self.numEvents = 1
-            
-
-    def _countAndFetchEvents(self):
-        events = []
-        event_flag = False
 
+    def _countAndFetchEvents(self, previous_event = None):
         # self.on_status is the list of rows of self.df marked with True if "Oven Status" is True
         # value is False otherwise
-        for index, row in self.df[self.on_status].iterrows():
-            if not events:
-                events.append(index)
-                event_flag = True
-            elif (row['Time'] > self.df['Time'][events[-1]] + self.datalength):
-                event_flag = True
-                events.append(index)
-            if event_flag:
-                  event_flag = False
-                  self.resultsDf = self.resultsDf.append(
-                      {self.eventKeys[0]: int(index), self.eventKeys[1]: row['Time'], self.eventKeys[2]: row['Daytime']},
-                      ignore_index=True).fillna(0)
+        positions = find_events(self.df['Time'].values, self.on_status.values, self.datalength,
+                                previous_event = previous_event)
+        events = self.df.index[positions].tolist()
+
+        self.resultsDf = pd.DataFrame({
+            self.eventKeys[0]: np.asarray(events, dtype='int64'),
+            self.eventKeys[1]: self.df['Time'].values[positions],
+            self.eventKeys[2]: self.df['Daytime'].values[positions],
+            self.eventKeys[3]: np.zeros(len(events)),
+            self.eventKeys[4]: np.zeros(len(events)),
+            self.eventKeys[5]: np.zeros(len(events))},
+            columns = self.eventKeys).fillna(0)
 
         return events
 
+    def _dropIncompleteEvents(self, events):
+        # in case there is not enough data for the last event ignore it
+        if events[-1] >= self.numSamples - self.datalength*2: 
+           events = events[:-2]
+        return events
+
+    def _completeEvents(self, events):
+        # keep the events followed by at least 'data_length' seconds of data
+        positions = self.df.index.get_indexer(events)
+        windows = event_windows(self.df['Time'].values, positions, self.resultsDf['runtime'].values,
+                                self.baselinelength, self.integrallength, self.datalength)
+        incomplete = np.flatnonzero(windows.end_of_file)
+        n = incomplete[0] if len(incomplete) else len(events)
+        self.resultsDf = self.resultsDf.iloc[:n].copy()
+        return events[:n]
+
+    def _firstSampleRuntime(self):
+        # the sampling interval of the first event starts with the file
+        return int(self.df['Time'][0])
+
     def _read_header(self):
         # rewind file
         self.csvfile.seek(0, 0)
@@ -233,6 +251,7 @@ class Rawfile(object):
             self.header = 0
         self.raw_file_keys  = self.csvfile.readline().rstrip('\n').split('\t')
         self.raw_file_units = self.csvfile.readline().rstrip('\n').split('\t')
+        self.dataOffset = self.csvfile.tell() # first byte after the header
 
         # generates a units dictionary
         self.unitsDict = dict(zip(self.raw_file_keys, self.raw_file_units))
@@ -241,55 +260,212 @@ class Rawfile(object):
 
         print >>sys.stderr, "loading file", self.datafile
 
+        self._read_columns()
+        cached = None
+        if self.cache is not None:
+            try:
+                cached = self.cache.load(self.csvfile, self.dataOffset, list(self.columns), self._read_data)
+            except Exception as e:
+                log_message("Could not use the cache, parsing the whole file ({})".format(e))
+        if cached is None:
+            self.csvfile.seek(0, 0)
+            self.df = self._read_csv(self.csvfile, skiprows = self.skiprows)
+            decoded = None
+        else:
+            self.df, decoded = cached
+        self.numSamples = len(self.df.index)
+
+        print >>sys.stderr, "loaded successfully"
+        self._decodeStatus(decoded)
+
+        self.csvfile.close()
+
+    def _read_columns(self):
         try:
             self._read_header()
             self.csvfile.seek(0, 0)
-            columns = pd.read_csv(self.csvfile, header=self.header, nrows = 1, sep='\t',
-                                  parse_dates=True).columns
+            self.columns = pd.read_csv(self.csvfile, header=self.header, nrows = 1, sep='\t',
+                                       parse_dates=True).columns
         except Exception as e:
             log_message("Could not read the file header")
             log_message(e)
             raise
+
+    def _read_data(self, data, slow = False):
+        # Parses a block of data lines, tells also if the path for corrupt lines
+        # was used ('slow' skips the fast parser of the whole block)
+        if not slow:
+            try:
+                return self._parse_block(data), False
+            except Exception as e:
+                log_message("Error loading data with the standard pandas dtypes, isolating the corrupt lines")
+        return self._read_lines(data), True
+
+    def _read_csv(self, source, skiprows = 0):
+        # parses the data lines of source starting at its current position
+        start = source.tell()
         try:
-            self.csvfile.seek(0, 0)
-            self.df = pd.read_csv(self.csvfile, skiprows = self.skiprows, sep='\t',
-                                  parse_dates=True, header = None, names=columns,
-                                  usecols = self.keys, error_bad_lines = False,
-                                  dtype = self.dtypeDict
-                                  )
-            self.numSamples = len(self.df.index)
+            return self._parse(source, skiprows = skiprows)
         except Exception as e:
-            log_message("Error loading file with the standard pandas dtypes, using converter for slow import instead")
-            self.csvfile.seek(0, 0)
-            newDict = {}
-            dtypeDictCopy = self.dtypeDict.copy()
-            dtypeDictCopy.pop('Status Byte', None)
-            for key in dtypeDictCopy:
-                newDict[key]=conv
-            self.df = pd.read_csv(self.csvfile, skiprows = self.skiprows, sep='\t',
-                                  parse_dates=True, header = None, names=columns,
-                                  usecols = self.keys, error_bad_lines = False,
-                                  converters = newDict
-                                  )
-            self.numSamples = len(self.df.index)
+            log_message("Error loading file with the standard pandas dtypes, isolating the corrupt lines")
+        source.seek(start, 0)
+        return self._read_lines(source.read(), skiprows = skiprows)
+
+    def _read_lines(self, data, skiprows = 0):
+        if not data.endswith('\n'):
+            data += '\n'
+
+        # lines with a wrong number of tabs (as in clean-file.py) or with unexpected
+        # characters are quarantined and parsed with the slow converter, the other
+        # lines are parsed in chunks by the fast parser
+        # (line numbers are counted from the position where the parsing started)
+        starts, ends = scan_lines(data)
+        lines = np.flatnonzero(parsed_lines(data, starts, ends))
+        lines = lines[lines >= skiprows]
+        starts, ends = starts[lines], ends[lines]
+        suspect = ((count_tabs(data, starts, ends) != len(self.columns) - 1) |
+                   (count_chars(data, starts, ends, BAD_CHARS) > 0))
+        quarantine = np.flatnonzero(suspect).tolist()
+        clean = np.flatnonzero(~suspect)
+        frames = []
+        for i in range(0, len(clean), self.chunkSize):
+            rows = clean[i:i + self.chunkSize]
+            frames.extend(self._parse_lines(data, starts[rows], ends[rows], rows, quarantine))
+        if quarantine:
+            rows = np.array(sorted(quarantine))
+            frames.extend(self._parse_lines(data, starts[rows], ends[rows], rows, slow = True))
+            corrupt = (lines[rows] + 1).tolist()
+            log_message("{} corrupt line(s) parsed with the slow converter, line number(s): {}".format(len(corrupt), corrupt))
+            self.skipedlines.extend(corrupt)
+        if not frames:
+            return self._empty_frame()
+        return pd.concat(frames).sort_index().reset_index(drop = True)
+
+    def _parse(self, source, skiprows = 0, slow = False, float_precision = None):
+        if not slow:
+            return pd.read_csv(source, skiprows = skiprows, sep='\t',
+                               header = None, names=self.columns, index_col = False,
+                               usecols = self.keys, error_bad_lines = False,
+                               dtype = self.dtypeDict, float_precision = float_precision
+                               )
+        # converter for every cell (slow import)
+        newDict = {}
+        dtypeDictCopy = self.dtypeDict.copy()
+        dtypeDictCopy.pop('Status Byte', None)
+        for key in dtypeDictCopy:
+            newDict[key]=conv
+        return pd.read_csv(source, skiprows = skiprows, sep='\t',
+                           header = None, names=self.columns, index_col = False,
+                           usecols = self.keys, error_bad_lines = False,
+                           converters = newDict, dtype = {'Status Byte': 'object'}
+                           )
+
+    def _parse_block(self, data, slow = False, float_precision = None):
+        # pandas takes the number of fields from the first line, thus a line with
+        # all the fields is added before the data (and its row removed)
+        block = '\t'*(len(self.columns) - 1) + '\n' + data
+        df = self._parse(io.BytesIO(block), slow = slow, float_precision = float_precision)
+        return df.iloc[1:].reset_index(drop = True)
+
+    def _parse_lines(self, data, starts, ends, rows, quarantine = None, slow = False):
+        # List of DataFrames with the given lines, indexed by 'rows'. When the fast
+        # parser fails, the block is halved until the corrupt lines are found, these
+        # are added to 'quarantine'. The lines the slow converter can not parse are ignored.
+        block = ''.join(data[i:j + 1] for i, j in zip(starts, ends))
+        try:
+            # same rounding as the converter ('round_trip' uses the python float)
+            df = self._parse_block(block, slow = slow, float_precision = 'round_trip')
+        except Exception:
+            df = None
+        if df is not None and len(df.index) == len(rows):
+            df.index = rows
+            return [df]
+        if len(rows) > 1:
+            half = len(rows)//2
+            return (self._parse_lines(data, starts[:half], ends[:half], rows[:half], quarantine, slow) +
+                    self._parse_lines(data, starts[half:], ends[half:], rows[half:], quarantine, slow))
+        if slow:
+            log_message("Line ignored: {}".format(block.rstrip()))
+        else:
+            quarantine.append(int(rows[0]))
+        return []
 
-        print >>sys.stderr, "loaded successfully"
+    def _empty_frame(self):
+        # DataFrame without rows and with the columns of a parsed file
+        return pd.DataFrame(dict((k, pd.Series([], dtype=self.dtypeDict.get(k, 'object')))
+                                 for k in self.keys), columns = self.keys)
+
+    def _decodeStatus(self, decoded = None):
         # validate status byte to find rows with errors
-        mask = self.df['Status Byte'].apply(lambda x: iserror(hex2bin, x))
-        #number_of_errors = (mask.values).sum() # fastest way to count errorlines
-        errors = self.df['Daytime'][mask].values.tolist()
-        # exclude errors
-        self.df = self.df[~mask]
+        # ('decoded' is the result of decode_status if already known)
+        codes, nbits, valid = decoded if decoded is not None else decode_status(self.df['Status Byte'].values)
+        mask = ~valid
+        #number_of_errors = mask.sum() # fastest way to count errorlines
+        errors = self.df['Daytime'].values[mask].tolist()
+        # extract oven status (before excluding the errors, the result of
+        # self.df[valid] is not modified afterwards)
+        self.df['Oven Status'] = status_bit(codes, nbits, "oven")
+        self.df['Valve Status'] = status_bit(codes, nbits, "valve")
+        self.df['Pump Status'] = status_bit(codes, nbits, "pump")
+        # exclude errors (without copying the rows if there are none)
+        if not valid.all():
+            self.df = self.df[valid]
         if len(errors):
             log_message("{} line(s) with 'Status Byte' errors removed at times: {}".format(len(errors), errors))
-        # extract oven status
-        self.df['Oven Status'] = [bool(int(hex2bin(x)[self.statusKeys.index("oven")])) for x in self.df['Status Byte']]
-        self.df['Valve Status'] = [bool(int(hex2bin(x)[self.statusKeys.index("valve")])) for x in self.df['Status Byte']]
-        self.df['Pump Status'] = [bool(int(hex2bin(x)[self.statusKeys.index("pump")])) for x in self.df['Status Byte']]
         self.on_status = self.df['Oven Status']==True
         self.sample_on = self.df['Valve Status']==True
+        return valid
+
+    def _samplingFlows(self, df):
+        # np.where is used to acount for sampling interuptions
+        # instead of using the condition as part of the subset building.
+        # bypass needs to be deactivated for the sample to enter FATCAT
+        flow = np.where(df['Valve Status']==False, df["Ext flow"] + df["Flowrate"], 0)
+        # use co2 data only if the internal pump was active
+        co2 = np.where(df['Pump Status']==True, flow*df["CO2"], 0)
+        return flow, co2
+
+    def _calculateAllSamplingVolumes(self):
+        # The sampling interval of each event starts with the previous event.
+        # Both integrals are taken from cumulative trapezoids of the whole file,
+        # thus each interval costs two binary searches and one subtraction.
+        if not self.numEvents:
+            return [], []
+        if not is_sorted(self.df['Time'].values):
+            # runtime reset within the file: the intervals are not contiguous
+            sample_volume = []
+            sample_co2 = []
+            for event in range(0,self.numEvents):
+                volume, co2 = self._calculateSamplingVolume(event)
+                sample_volume.append(volume)
+                sample_co2.append(co2)
+            return sample_volume, sample_co2
 
-        self.csvfile.close()
+        time = self.df['Time'].values
+        event_runtime = self.resultsDf['runtime'].values[:self.numEvents].astype(int)
+        start_runtime = np.concatenate(([self._firstSampleRuntime()], event_runtime[:-1]))
+        lo = np.searchsorted(time, start_runtime, side='left')
+        hi = np.searchsorted(time, event_runtime, side='left')
+
+        flow, co2 = self._samplingFlows(self.df)
+        sample_volume = trapz_intervals(flow, time, lo, hi)/60/1000
+        co2_integral = trapz_intervals(co2, time, lo, hi)/60/1000
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # weigthed using sampling flowrate
+            sample_co2 = np.where(sample_volume > 0, co2_integral/sample_volume, 0)
+
+        daytime = self.df['Daytime'].values
+        for i0, i1 in zip(lo, hi):
+            if i1 > i0:
+                print >> sys.stderr, "sample interval found: {}-{}".format(daytime[i0], daytime[i1 - 1])
+
+        # the cumulative sums may differ in the last bits from the integral of each
+        # interval, recompute the values that could be printed differently
+        sample_volume, sample_co2 = sample_volume.tolist(), sample_co2.tolist()
+        for event in np.flatnonzero(near_rounding_tie(sample_volume, 5) | near_rounding_tie(sample_co2, 1)):
+            sample_volume[event], sample_co2[event] = self._calculateSamplingVolume(event)
+
+        return sample_volume, sample_co2
 
     def _calculateSamplingVolume(self, eventIndex):
         if eventIndex >= self.numEvents:
@@ -302,21 +478,15 @@ class Rawfile(object):
             if eventIndex > 0:
                 start_runtime = int(self.resultsDf['runtime'][eventIndex - 1])
             else:
-                start_runtime = int(self.df['Time'][0])
+                start_runtime = self._firstSampleRuntime()
             df_subset = self.df[(self.df['Time'] < event_runtime) & (self.df['Time'] >= start_runtime)]
-            # np.where is used to acount for sampling interuptions
-            # instead of using the condition as part of the subset building.
-            # bypass needs to be deactivated for the sample to enter FATCAT
-            flow = np.where(df_subset['Valve Status']==False,
-                            df_subset["Ext flow"] + df_subset["Flowrate"], 0)
+            flow, co2 = self._samplingFlows(df_subset)
             time = df_subset["Time"]
             sample_volume = np.trapz(flow, x=time)/60/1000
             if len(df_subset) > 0:
                  print >> sys.stderr, "sample interval found: {}-{}".format(df_subset['Daytime'][df_subset.index[0]],df_subset['Daytime'][df_subset.index[-1]])
 
             if sample_volume > 0:
-                # use co2 data only if the internal pump was active
-                co2  = np.where(df_subset['Pump Status']==True, flow*df_subset["CO2"], 0)
                 sample_co2 = np.trapz(co2, x=time)/60/1000/sample_volume # weigthed using sampling flowrate
             else:
                 sample_co2 = 0
@@ -324,6 +494,22 @@ class Rawfile(object):
             return sample_volume, sample_co2
             
 
+    def _eventWindows(self):
+        # positions of the baseline and integration windows of all events, kept
+        # until the rows or the events change (the per-event methods are called
+        # for many events)
+        events = self.resultsDf['index'].values[:self.numEvents]
+        if self.windowCache is not None:
+            df, cached, positions, windows = self.windowCache
+            if df is self.df and np.array_equal(cached, events):
+                return positions, windows
+        positions = self.df.index.get_indexer(events)
+        windows = event_windows(self.df['Time'].values, positions,
+                                self.resultsDf['runtime'].values[:self.numEvents],
+                                self.baselinelength, self.integrallength, self.datalength)
+        self.windowCache = (self.df, events.copy(), positions, windows)
+        return positions, windows
+
     def calculateEventBaseline(self, eventIndex):
         if eventIndex >= self.numEvents:
            try:
@@ -331,35 +517,38 @@ class Rawfile(object):
            except EventError as e:
                log_message("Event out of range (calculateEventBaseline)")
         else:
-            i0 = int(self.resultsDf['index'][eventIndex])
-            runtime = self.resultsDf['runtime'][eventIndex]
-            i1 = i0
-            try:
-                elapsedTime = runtime - self.df['Time'].loc[i1]
-            except:
-                log_message("error calculating baseline for event {}".format(eventIndex))
-                raise
-            while (elapsedTime <= self.baselinelength and i1 >= 0):
-                i1 = i1 - 1
-                try:
-                    elapsedTime = runtime - self.df['Time'].loc[i1]
-                except:
-                    log_message("error calculating baseline for event {}".format(eventIndex))
-                    raise
-            else:
-                i1 += 1
+            positions, windows = self._eventWindows()
+            i0 = positions[eventIndex]
+            i1 = windows.baseline_start[eventIndex]
             # "i0-1" excludes the starting point of the event
             # not necesary, but included for compatibility reasons
             # may be changed to only "i0" without consequences
-            return round(np.mean(self.df['CO2'].loc[i1:i0-1]), 2)
+            return round(np.mean(self.df['CO2'].iloc[i1:i0]), 2)
 
     def calculateAllBaseline(self):
 
-        baselines = []
-        for event in range(0,self.numEvents):
-            baselines.append(self.calculateEventBaseline(event))
+        positions, windows = self._eventWindows()
+        means = window_means(self.df['CO2'].values, windows.baseline_start, positions)
+        baselines = [round(m, 2) for m in means]
+        # the cumulative sums may differ in the last bits from the mean of each window
+        for event in np.flatnonzero(near_rounding_tie(means, 2)):
+            baselines[event] = self.calculateEventBaseline(event)
         self.resultsDf['baseline'] = baselines
 
+    def _eventData(self, eventIndex, positions, windows):
+        i0 = positions[eventIndex]
+        i1 = windows.data_end[eventIndex]
+        if windows.end_of_file[eventIndex]:
+            log_message('End of file reachead while integrating last event ({0})!'.format(self.resultsDf['daytime'][eventIndex]))
+
+        co2     = self.df['CO2'].values[i0:i1+1]-self.resultsDf['baseline'][eventIndex]
+        seconds = self.df['Time'].values[i0:i1+1]
+        flow    = (self.df['Flowrate'].values[i0:i1+1]).astype('float64')
+
+        #deltatc  = co2*np.mean(flow)*ppmtoug        ### Evaluate TC using the average flow
+        deltatc  = co2*flow*ppmtoug                 ### Evaluate TC using real time flow
+        return i0, i1, co2, deltatc, seconds
+
     def integrateEvent(self, eventIndex = -1):
 
        if eventIndex >= self.numEvents:
@@ -368,45 +557,29 @@ class Rawfile(object):
            except EventError as e:
                log_message("Event {} out of range (integrateEvent)".format(eventIndex))
            return
+       if eventIndex < 0:
+           eventIndex += self.numEvents
 
-       i0 = int(self.resultsDf['index'][eventIndex])
-       runtime = self.resultsDf['runtime'][eventIndex]
-       i1 = i0
-       elapsedTime = self.df['Time'].loc[i1] - runtime
-       j = 0
-       while elapsedTime <= self.datalength and i1 < self.numSamples - 1:
-           i1 += 1
-           elapsedTime = self.df['Time'].loc[i1] - runtime
-           # search for index 
-           if elapsedTime <= self.integrallength:
-               j += 1
-       else:
-           if elapsedTime <= self.datalength and i1 == self.numSamples - 1:
-               log_message('End of file reachead while integrating last event ({0})!'.format(self.resultsDf['daytime'][eventIndex]))
-           i1 -= 1
-
-       # for back compatibility reasons to have always the same number of lines
-       # previous version used iloc instead of loc, thus excluded the last row
-       i1 = i1 - 1
-
-       co2     = self.df['CO2'].loc[i0:i1]-self.resultsDf['baseline'][eventIndex]
-       seconds = self.df['Time'].loc[i0:i1]
-       flow    = (self.df['Flowrate'].loc[i0:i1]).astype('float64')
-       
-       #deltatc  = co2*np.mean(flow)*ppmtoug        ### Evaluate TC using the average flow
-       deltatc  = co2*flow*ppmtoug                 ### Evaluate TC using real time flow
+       positions, windows = self._eventWindows()
+       i0, i1, co2, deltatc, seconds = self._eventData(eventIndex, positions, windows)
+       j = windows.nintegral[eventIndex]
        integral_y = deltatc[:j]
        integral_x = seconds[:j]
        #tc_s = simps(integral_y, integral_x)/60           ### Integrate using simpson's rule
        tc_t = np.trapz(integral_y, x=integral_x)/60 ### Integrate using trapezoidal rule
+       tc = tc_t.round(3)
 
+       maxT = self._saveEventData(eventIndex, i0, i1, co2, deltatc)
+
+       return tc, maxT
+
+    def _saveEventData(self, eventIndex, i0, i1, co2, deltatc):
        co2 = co2.round(3)
        deltatc = deltatc.round(3)
-       tc = tc_t.round(3)
-       maxT = max(self.df['T Oven'].loc[i0:i1])
-       dtcDf = pd.concat([co2,deltatc], axis = 1)
+       maxT = max(self.df['T Oven'].iloc[i0:i1+1])
        newColNames = ['co2-event', 'dtc']
-       dtcDf.columns = ['co2-event', 'dtc']
+       dtcDf = pd.DataFrame({'co2-event': co2, 'dtc': deltatc},
+                            index = self.df.index[i0:i1+1], columns = newColNames)
 
        if self.resultsDf['sample'][eventIndex] > 0:
            sample_info = "volume: {:.5f} m^3".format(self.resultsDf['sample'][eventIndex])
@@ -417,7 +590,7 @@ class Rawfile(object):
 
        self._saveEvent(i0, i1, dtcDf, newColNames = newColNames, newUnits = ['ppm', 'ug/min'], additional_data = sample_info)
 
-       return tc, maxT
+       return maxT
 
     def _saveEvent(self, i0, i1, df, newColNames, newUnits, additional_data = False):  #### create output file for event
 
@@ -430,9 +603,11 @@ class Rawfile(object):
         colNames = colNames + newColNames
         units = units + newUnits
 
-        valuesDf = pd.concat([self.df.loc[i0:i1, self.eventfileKeys],df], axis = 1)
+        # i0 and i1 are positions (not labels) of the first and last rows of the event
+        valuesDf = pd.concat([self.df[self.eventfileKeys].iloc[i0:i1+1],df], axis = 1)
 
-        filename = self.date + "-" + self.df['Daytime'].loc[i0][0:2] + self.df['Daytime'].loc[i0][3:5] + "-eventdata.csv"
+        daytime = self.df['Daytime'].iloc[i0]
+        filename = self.date + "-" + daytime[0:2] + daytime[3:5] + "-eventdata.csv"
         newfile = self.eventDir + filename
         
         header = "{}\nsource: {}\n".format(filename, self.datafile)
@@ -446,10 +621,29 @@ class Rawfile(object):
 
     def integrateAll(self):
 
+        positions, windows = self._eventWindows()
+        baseline = self.resultsDf['baseline'].values[:self.numEvents]
+
+        # tc = integral of (co2 - baseline)*flow over the first rows of each event,
+        # evaluated from the cumulative trapezoids of co2*flow and flow
+        lo = positions
+        hi = positions + np.minimum(windows.nintegral, np.maximum(windows.data_end - positions + 1, 0))
+        time = self.df['Time'].values
+        flow = self.df['Flowrate'].values.astype('float64')
+        co2flow = trapz_intervals(self.df['CO2'].values*flow, time, lo, hi)
+        flowint = trapz_intervals(flow, time, lo, hi)
+        tc_all = (co2flow - baseline*flowint)*ppmtoug/60
+
         tc_data = []
         temp_data = []
         for event in range(0,self.numEvents):
-            tc, temp = self.integrateEvent(event)
+            i0, i1, co2, deltatc, seconds = self._eventData(event, positions, windows)
+            if near_rounding_tie(tc_all[event], 3):
+                j = windows.nintegral[event]
+                tc = (np.trapz(deltatc[:j], x=seconds[:j])/60).round(3)
+            else:
+                tc = tc_all[event].round(3)
+            temp = self._saveEventData(event, i0, i1, co2, deltatc)
             tc_data.append(tc)
             temp_data.append(temp)
         self.resultsDf['maxtoven'] = temp_data
@@ -537,6 +731,561 @@ class Rawfile(object):
                 print >>sys.stderr, "Skipping upload of datapoint", j
             j += 1
 
+class IncrementalRawfile(Rawfile):
+    # Processes only the events completed since the previous run on the same file.
+    # A json checkpoint keeps the byte offset and row number where the next run
+    # starts parsing (the sampling interval of the next event begins with the last
+    # processed event) together with the last event, thus the cost of each run
+    # depends on the new data and not on the size of the file.
+    def __init__(self, datafile, checkpoint_file, events_path, integral_length,
+                 data_length, baseline_length, baseline = False):
+        self.checkpointFile = checkpoint_file
+        self.state = self._loadCheckpoint(datafile.name)
+        Rawfile.__init__(self, datafile, events_path, integral_length, data_length,
+                         baseline_length, all_events = True, baseline = baseline)
+
+    def _loadCheckpoint(self, datafile):
+        if not os.path.isfile(self.checkpointFile):
+            return None
+        try:
+            with open(self.checkpointFile, 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            log_message("Invalid checkpoint file {}, processing the whole file".format(self.checkpointFile))
+            return None
+        stat = os.stat(datafile)
+        if (state['datafile'] != os.path.abspath(datafile) or state['inode'] != stat.st_ino
+                or state['offset'] > stat.st_size):
+            log_message("Checkpoint does not match {}, processing the whole file".format(datafile))
+            return None
+        return state
+
+    def _load(self):
+
+        print >>sys.stderr, "loading new data of file", self.datafile
+
+        self._read_columns()
+        if (self.state is None or self.state['date'] != self.date
+                or self.state['columns'] != list(self.columns)):
+            self.state = {
+                "datafile": os.path.abspath(self.datafile),
+                "inode": os.fstat(self.csvfile.fileno()).st_ino,
+                "date": self.date,
+                "columns": list(self.columns),
+                "offset": self.dataOffset,      # end of the data parsed so far
+                "tail_offset": self.dataOffset, # where the next run starts parsing
+                "tail_row": 0,                  # rows of data before tail_offset
+                "first_runtime": None,          # start of the first sampling interval
+                "last_event": None}
+        offset = self.state['tail_offset']
+        self.csvfile.seek(offset, 0)
+        data = self.csvfile.read()
+        self.csvfile.close()
+
+        # only complete lines are parsed, keeping the byte offset of every row
+        starts, ends = scan_lines(data, offset)
+        parsed = parsed_lines(data, starts, ends, offset)
+        self.dataEnd = int(ends[-1]) + 1 if len(ends) else offset
+        self.rowOffsets = starts[parsed]
+        if parsed.all():
+            data = data[:self.dataEnd - offset]
+        else:
+            data = ''.join(data[i - offset:j - offset + 1] for i, j in zip(starts[parsed], ends[parsed]))
+
+        if self.rowOffsets.size:
+            self.df, slow = self._read_data(data)
+        else:
+            self.df = self._empty_frame()
+        if len(self.df.index) != len(self.rowOffsets):
+            log_message("Could not map the rows to the file, the checkpoint will not advance")
+            self.rowOffsets = None
+        self.df.index = self.df.index + self.state['tail_row']
+        self.numSamples = self.state['tail_row'] + len(self.df.index)
+
+        print >>sys.stderr, "loaded {} new bytes".format(self.dataEnd - offset)
+        valid = self._decodeStatus()
+        if self.rowOffsets is not None:
+            self.rowOffsets = self.rowOffsets[valid]
+        if self.state['first_runtime'] is None and len(self.df.index):
+            self.state['first_runtime'] = int(self.df['Time'].values[0])
+
+    def _countAndFetchEvents(self):
+        last_event = self.state['last_event']
+        return Rawfile._countAndFetchEvents(self,
+            previous_event = last_event['runtime'] if last_event else None)
+
+    def _dropIncompleteEvents(self, events):
+        # the events without enough data will be processed in the next run
+        return self._completeEvents(events)
+
+    def _firstSampleRuntime(self):
+        last_event = self.state['last_event']
+        if last_event:
+            return int(last_event['runtime'])
+        return self.state['first_runtime']
+
+    def saveCheckpoint(self):
+        # call after the results were printed
+        state = self.state
+        state['offset'] = self.dataEnd
+        if self.numEvents:
+            event = self.numEvents - 1
+            runtime = float(self.resultsDf['runtime'][event])
+            state['last_event'] = {
+                "index": int(self.resultsDf['index'][event]),
+                "runtime": runtime,
+                "daytime": str(self.resultsDf['daytime'][event])}
+            if self.rowOffsets is not None:
+                # the next sampling interval starts at int(runtime)
+                i0 = self.df.index.get_loc(self.resultsDf['index'][event])
+                before = np.flatnonzero(~(self.df['Time'].values[:i0] >= int(runtime)))
+                start = before[-1] + 1 if len(before) else 0
+                state['tail_offset'] = int(self.rowOffsets[start])
+                state['tail_row'] = int(self.df.index[start])
+
+        tmpfile = self.checkpointFile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(state, f, indent = 1)
+        os.rename(tmpfile, self.checkpointFile)
+
+class LastEventRawfile(Rawfile):
+    # Processes only the last event of a raw file (--last). The file is read
+    # backwards in blocks until the slice holds a row that certainly starts an
+    # event (an oven-on row more than 'data_length' seconds after the previous
+    # one), the two last events of the file and the rows needed for the baseline
+    # and the sampling volume of the last one. Only that slice is parsed, the rows
+    # before it are just counted to keep the row numbers of a full load.
+    # With the event index (extras/event_index.py) the slice starts three (or
+    # five) events before the end and nothing else is read. Files with a runtime reset
+    # are loaded completely.
+    def __init__(self, datafile, events_path, integral_length, data_length,
+                 baseline_length, baseline = False, block_size = 1 << 18):
+        self.blockSize = block_size
+        Rawfile.__init__(self, datafile, events_path, integral_length, data_length,
+                         baseline_length, all_events = False, baseline = baseline)
+
+    def _load(self):
+
+        print >>sys.stderr, "loading the end of file", self.datafile
+
+        self._read_columns()
+        if self._loadIndexed():
+            return
+        self.csvfile.seek(0, 2)
+        size = pos = self.csvfile.tell()
+        offset = pos # start of the parsed slice
+        data = ''    # bytes read before the slice
+        chunks = []
+        block = self.blockSize
+        while pos > self.dataOffset:
+            start = max(pos - block, self.dataOffset)
+            self.csvfile.seek(start, 0)
+            data = self.csvfile.read(pos - start) + data
+            pos = start
+            block *= 2
+            # each block is parsed from its first complete line on
+            first = pos
+            if pos > self.dataOffset:
+                first += data.find('\n') + 1
+                if first == pos:
+                    continue
+            if not data[first - pos:].strip():
+                continue
+            chunks.insert(0, self._read_data(data[first - pos:])[0])
+            data = data[:first - pos]
+            offset = first
+            df = pd.concat(chunks, ignore_index = True)
+            anchor = self._lastEventsAnchor(df)
+            if anchor is not None and self._sortedBefore(offset, df['Time'].values[0]):
+                break
+        else:
+            # no safe starting point, use the whole file
+            Rawfile._load(self)
+            self.partial = False
+            return
+
+        rows = count_parsed_lines(self.csvfile, self.dataOffset, offset)
+        self.csvfile.close()
+        self.partial = True
+        self.df = df
+        self.df.index = self.df.index + rows
+        self.numSamples = rows + len(self.df.index)
+        print >>sys.stderr, "loaded the last {} bytes".format(size - offset)
+
+        self._decodeStatus()
+        # events are counted from the anchor on
+        self.on_status.iloc[:anchor] = False
+
+    def _indexSlice(self, index, events):
+        # Positions in 'events' of the first event of the slice and of the event
+        # ending it (None for the start and the end of the indexed data). The
+        # sampling interval of the reported event starts with the integer runtime
+        # of the event before, thus the slice starts one event earlier. The last
+        # event is dropped with the one before if it is too close to the end of
+        # the file (see Rawfile._dropIncompleteEvents).
+        if not len(events):
+            return None, None
+        drop = index.records['row'][events[-1]] >= index.header['rows'] - self.datalength*2
+        n = 5 if drop else 3
+        if len(events) < n:
+            return None, None
+        return len(events) - n, None
+
+    def _loadIndexed(self):
+        # Parses the slice given by the event index, returns False if the index
+        # cannot be used.
+        try:
+            index = update_index(self.datafile)
+        except Exception as e:
+            log_message("Could not use the event index ({})".format(e))
+            return False
+        events, exact = index.events(self.datalength)
+        if not exact or index.header['data_offset'] != self.dataOffset:
+            return False
+        bounds = self._indexSlice(index, events)
+        if bounds is None:
+            return False
+        first, last = bounds
+        if first is None:
+            offset, rows = self.dataOffset, 0
+        else:
+            offset = int(index.records['offset'][events[first]])
+            rows = int(index.records['row'][events[first]])
+        # the lines written after the update of the index are left out
+        if last is None:
+            end = index.header['end']
+        else:
+            end = int(index.records['offset'][events[last]])
+        self.csvfile.seek(offset, 0)
+        data = self.csvfile.read(end - offset)
+        if not data.strip():
+            return False
+        df = self._read_data(data)[0]
+        if not is_sorted(df['Time'].values) or not self._sortedBefore(offset, df['Time'].values[0]):
+            return False
+
+        self.csvfile.close()
+        self.partial = offset > self.dataOffset
+        self.df = df
+        self.df.index = self.df.index + rows
+        self.numSamples = rows + len(self.df.index)
+        print >>sys.stderr, "loaded {} bytes using the event index".format(len(data))
+        self._decodeStatus()
+        return True
+
+    def _sortedBefore(self, offset, runtime):
+        # Checks for a runtime reset before the byte 'offset' using the first
+        # complete line of every block, i.e., a few reads instead of parsing.
+        samples = []
+        for pos in range(self.dataOffset, offset, self.blockSize):
+            self.csvfile.seek(pos, 0)
+            if pos > self.dataOffset:
+                self.csvfile.readline()
+            if self.csvfile.tell() >= offset:
+                break
+            try:
+                samples.append(float(self.csvfile.readline().split('\t')[list(self.columns).index('Time')]))
+            except (ValueError, IndexError):
+                pass # corrupt line
+        samples.append(runtime)
+        return is_sorted(samples)
+
+    def _lastEventsAnchor(self, df):
+        # Position (after removing the status errors) of a row of df that certainly
+        # starts an event and is followed by at least two events, None if the
+        # slice is not long enough for the last event.
+        codes, nbits, valid = decode_status(df['Status Byte'].values)
+        runtime = df['Time'].values[valid]
+        oven_on = status_bit(codes, nbits, "oven")[valid]
+        if not len(runtime) or not is_sorted(runtime):
+            return None
+        on_pos = np.flatnonzero(oven_on)
+        # the events before the slice started at or before its first row
+        previous_on = np.concatenate(([runtime[0]], runtime[on_pos[:-1]]))
+        anchors = on_pos[runtime[on_pos] > previous_on + self.datalength]
+        if not len(anchors):
+            return None
+        anchor = anchors[0]
+        events = anchor + find_events(runtime[anchor:], oven_on[anchor:], self.datalength)
+        if len(events) < 2:
+            return None
+        # rows of the sampling interval and of the baseline of the last event
+        if not (runtime[0] < int(runtime[events[-2]])
+                and runtime[0] < runtime[events[-1]] - self.baselinelength):
+            return None
+        return anchor
+
+    def _firstSampleRuntime(self):
+        # only used for the first event of the slice, which is not reported
+        if self.partial:
+            return int(self.df['Time'].values[0])
+        return Rawfile._firstSampleRuntime(self)
+
+class EventRawfile(LastEventRawfile):
+    # Processes only the event starting at the daytime 'event_time' (--event),
+    # e.g., to integrate it again with other settings. The event index gives the
+    # slice from the second event before it to the second event after it. The
+    # file is loaded completely when the index cannot be used.
+    def __init__(self, datafile, event_time, events_path, integral_length, data_length,
+                 baseline_length, baseline = False, block_size = 1 << 18):
+        self.eventTime = event_time
+        self.blockSize = block_size
+        Rawfile.__init__(self, datafile, events_path, integral_length, data_length,
+                         baseline_length, all_events = True, baseline = baseline)
+        selected = np.flatnonzero(self.resultsDf['daytime'].values == event_time)
+        if not len(selected):
+            raise EventError("No event at {} in {}".format(event_time, self.datafile))
+        if len(selected) > 1:
+            raise EventError(self._ambiguous(len(selected)))
+        event = selected[0]
+        self.resultsDf = self.resultsDf.iloc[[event]].reset_index(drop=True)
+        self.sample_volume = [self.sample_volume[event]]
+        self.sample_co2 = [self.sample_co2[event]]
+        self.numEvents = 1
+
+    def _load(self):
+
+        print >>sys.stderr, "loading the event at {} of file {}".format(self.eventTime, self.datafile)
+
+        self._read_columns()
+        if not self._loadIndexed():
+            Rawfile._load(self)
+            self.partial = False
+
+    def _ambiguous(self, n):
+        return "{} events at {} in {} (a file of several days)".format(n, self.eventTime, self.datafile)
+
+    def _indexSlice(self, index, events):
+        try:
+            k = index.find(self.eventTime, events)
+        except ValueError:
+            raise EventError(self._ambiguous(np.count_nonzero(index.records['daytime'][events] == self.eventTime)))
+        if k is None:
+            return None
+        return (k - 2 if k >= 2 else None), (k + 2 if k + 2 < len(events) else None)
+
+    def _dropIncompleteEvents(self, events):
+        # the slice may end before the end of the file
+        return self._completeEvents(events)
+
+class StreamingRawfile(Rawfile):
+    # Processes all events of a raw file with a memory use that does not depend on
+    # the size of the file (--stream). The file is parsed in blocks of 'chunk_size'
+    # bytes and only a rolling window of rows is kept: the rows since the start of
+    # the sampling interval of the next event. Each event is processed (baseline,
+    # tc and event file) as soon as 'data_length' seconds of data follow it. When
+    # the window grows beyond 'max_rows' rows without a complete event, its oldest
+    # rows are added to the integrals of the sampling interval and dropped (only
+    # if the runtime is sorted). The events at the end of the file without
+    # 'data_length' seconds of data are not processed, as with --checkpoint.
+    def __init__(self, datafile, events_path, integral_length, data_length,
+                 baseline_length, baseline = False, chunk_size = 1 << 20, max_rows = 20000):
+        self._setup(datafile, events_path, integral_length, data_length, baseline_length,
+                    baseline)
+        self.chunkBytes = chunk_size
+        self.maxRows = max_rows
+        self._stream()
+
+    def _stream(self):
+
+        print >>sys.stderr, "streaming file", self.datafile
+
+        self._read_columns()
+        self.csvfile.seek(self.dataOffset, 0)
+        self.numSamples = 0
+        self.firstRuntime = None # start of the first sampling interval
+        self.lastEvent = None    # runtime of the last processed event
+        self.folded = [0., 0.]   # integrals of flow and co2*flow of the dropped rows
+        self.foldedStart = None  # daytime of the first dropped row of the sampling interval
+        self.sample_volume = []
+        self.sample_co2 = []
+        results = []
+        window = None
+        rest = ''
+        while True:
+            data = self.csvfile.read(self.chunkBytes)
+            eof = not data
+            data = rest + data
+            # only complete lines, but the last line of the file
+            n = len(data) if eof else data.rfind('\n') + 1
+            data, rest = data[:n], data[n:]
+            if data.strip():
+                self.df = self._read_data(data)[0]
+                self.df.index = self.df.index + self.numSamples
+                self.numSamples += len(self.df.index)
+                if self.firstRuntime is None and len(self.df.index):
+                    self.firstRuntime = int(self.df['Time'].values[0])
+                self._decodeStatus()
+                window = self.df if window is None else pd.concat([window, self.df])
+                window = self._processWindow(window, results)
+            if eof:
+                break
+        self.csvfile.close()
+
+        if window is None:
+            self.df = self._empty_frame()
+            self._decodeStatus()
+        else:
+            self.df = window
+        self.on_status = self.df['Oven Status']==True
+        pending = Rawfile._countAndFetchEvents(self, previous_event = self.lastEvent)
+        if pending:
+            log_message("{} event(s) at the end of the file without {} seconds of data not processed".format(len(pending), self.datalength))
+        if results:
+            self.resultsDf = pd.concat(results, ignore_index = True)
+        else:
+            self.resultsDf = pd.DataFrame(columns = self.eventKeys + ['sample', 'sample co2'])
+        self.numEvents = len(self.resultsDf)
+
+        print >>sys.stderr, '{0} lines of data.\n{1} event(s) found at index(es): {2}'.format(self.numSamples, self.numEvents, self.resultsDf['index'].tolist())
+
+    def _processWindow(self, window, results):
+        # processes the complete events of the window and returns the rows still needed
+        self.df = window
+        self.on_status = self.df['Oven Status']==True
+        found = Rawfile._countAndFetchEvents(self, previous_event = self.lastEvent)
+        events = self._completeEvents(found)
+        self.numEvents = len(events)
+        if self.numEvents:
+            sample_volume = []
+            sample_co2 = []
+            for event in range(0,self.numEvents):
+                volume, co2 = self._streamSamplingVolume(event)
+                sample_volume.append(volume)
+                sample_co2.append(co2)
+            self.resultsDf['sample'] = sample_volume
+            self.resultsDf['sample co2'] = sample_co2
+            Rawfile.calculateAllBaseline(self)
+            Rawfile.integrateAll(self)
+            results.append(self.resultsDf)
+            self.sample_volume.extend(sample_volume)
+            self.sample_co2.extend(sample_co2)
+
+            # the next sampling interval starts at int(runtime) of the last event
+            self.lastEvent = float(self.resultsDf['runtime'].values[-1])
+            i0 = window.index.get_loc(events[-1])
+            before = np.flatnonzero(~(window['Time'].values[:i0] >= int(self.lastEvent)))
+            window = window.iloc[before[-1] + 1 if len(before) else 0:]
+            self.folded = [0., 0.]
+            self.foldedStart = None
+
+        runtime = window['Time'].values
+        if len(window.index) > self.maxRows and is_sorted(runtime):
+            # keep the rows needed for the baseline of the next event
+            if len(found) > len(events):
+                limit = self.df['Time'][found[len(events)]]
+            else:
+                limit = runtime[-1]
+            k = np.searchsorted(runtime, limit - self.baselinelength, side='left')
+            if k > 0:
+                # the row k stays in the window to integrate across the boundary
+                flow, co2 = self._samplingFlows(window.iloc[:k + 1])
+                self.folded[0] += np.trapz(flow, x=runtime[:k + 1])
+                self.folded[1] += np.trapz(co2, x=runtime[:k + 1])
+                if self.foldedStart is None:
+                    self.foldedStart = window['Daytime'].values[0]
+                window = window.iloc[k:]
+        return window
+
+    def _firstSampleRuntime(self):
+        if self.lastEvent is not None:
+            return int(self.lastEvent)
+        return self.firstRuntime
+
+    def _streamSamplingVolume(self, eventIndex):
+        # as Rawfile._calculateSamplingVolume, adding the rows dropped from the window
+        event_runtime = int(self.resultsDf['runtime'][eventIndex])
+        if eventIndex > 0:
+            start_runtime = int(self.resultsDf['runtime'][eventIndex - 1])
+        else:
+            start_runtime = self._firstSampleRuntime()
+        df_subset = self.df[(self.df['Time'] < event_runtime) & (self.df['Time'] >= start_runtime)]
+        flow, co2 = self._samplingFlows(df_subset)
+        time = df_subset["Time"]
+        volume = np.trapz(flow, x=time)
+        co2_integral = np.trapz(co2, x=time)
+        first = df_subset['Daytime'][df_subset.index[0]] if len(df_subset) > 0 else None
+        if eventIndex == 0 and self.foldedStart is not None:
+            volume += self.folded[0]
+            co2_integral += self.folded[1]
+            first = self.foldedStart
+        sample_volume = volume/60/1000
+        if len(df_subset) > 0:
+             print >> sys.stderr, "sample interval found: {}-{}".format(first, df_subset['Daytime'][df_subset.index[-1]])
+
+        if sample_volume > 0:
+            sample_co2 = co2_integral/60/1000/sample_volume # weigthed using sampling flowrate
+        else:
+            sample_co2 = 0
+
+        return sample_volume, sample_co2
+
+    def calculateAllBaseline(self):
+        pass # done while streaming
+
+    def integrateAll(self):
+        pass # done while streaming
+
+def process_datafile(file, options):
+    # analysis of one raw file as requested on the command line (see 'options' below)
+    try:
+        if options['checkpoint']:
+            checkpoint_file = options['checkpoint_path'] + os.path.basename(file.name) + '.json'
+            mydata = IncrementalRawfile(file, checkpoint_file, events_path=options['events_path'],
+                         integral_length = options['integral_length'], data_length = options['data_length'],
+                         baseline_length = options['baseline_length'], baseline = options['baseline'])
+        elif options['stream']:
+            mydata = StreamingRawfile(file, events_path=options['events_path'],
+                         integral_length = options['integral_length'], data_length = options['data_length'],
+                         baseline_length = options['baseline_length'], baseline = options['baseline'])
+        elif options['event']:
+            mydata = EventRawfile(file, options['event'], events_path=options['events_path'],
+                         integral_length = options['integral_length'], data_length = options['data_length'],
+                         baseline_length = options['baseline_length'], baseline = options['baseline'])
+        elif not options['all']:
+            mydata = LastEventRawfile(file, events_path=options['events_path'],
+                         integral_length = options['integral_length'], data_length = options['data_length'],
+                         baseline_length = options['baseline_length'], baseline = options['baseline'])
+        else:
+            mydata = Rawfile(file, events_path=options['events_path'],
+                         integral_length = options['integral_length'], data_length = options['data_length'],
+                         baseline_length = options['baseline_length'], all_events = options['all'],
+                         baseline = options['baseline'], cache = options['cache'])
+    except EventError as e:
+        log_message("{}".format(e.value))
+    except:
+        log_message("Oops! could not load the file {}. Check if it is a valid FATCAT FILE".format(file.name))
+        #raise
+    else:
+        try:
+            mydata.calculateAllBaseline()
+            mydata.integrateAll()
+            mydata.printResults(header = options['head'], all_events = options['all'])
+            if options['checkpoint']:
+                mydata.saveCheckpoint()
+        except:
+            log_message("Oops!  could not calculate tc table.  Try again...")
+            raise
+
+        if options['upload']:
+                print >>sys.stderr, "uploading events to DB..."
+                mydata.uploadData(options['date'], all_events = options['all'], istart = options['istart'])
+
+def process_datafile_job(job):
+    # worker of the --jobs pool: returns the printed table instead of writing it
+    # and the error instead of stopping the other files
+    filename, options = job
+    output = io.BytesIO()
+    sys.stdout = output
+    try:
+        process_datafile(open(filename, 'r'), options)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        sys.stdout = sys.__stdout__
+    return filename, output.getvalue(), error
+
 if __name__ == "__main__":
 
     #config_file = args.INI
@@ -553,6 +1302,18 @@ if __name__ == "__main__":
         baseline_length = eval(config['DATA_ANALYSIS']['BASELINE_LENGTH'])
         data_path = eval(config['GENERAL_SETTINGS']['DATA_PATH']) + '/'
         data_ext = eval(config['LOGGER']['EXTENSION'])
+        if config.has_option('DATA_ANALYSIS', 'CHECKPOINT_PATH'):
+            checkpoint_path = eval(config['DATA_ANALYSIS']['CHECKPOINT_PATH']) + '/'
+        else:
+            checkpoint_path = data_path + 'checkpoints/'
+        if config.has_option('DATA_ANALYSIS', 'CACHE_PATH'):
+            cache_path = eval(config['DATA_ANALYSIS']['CACHE_PATH']) + '/'
+        else:
+            cache_path = data_path + 'cache/'
+        if config.has_option('DATA_ANALYSIS', 'CACHE_SIZE'):
+            cache_size = eval(config['DATA_ANALYSIS']['CACHE_SIZE']) # MB
+        else:
+            cache_size = 500
     else:
         raise ValueError('File \'%s\' is not a valid \'.ini\' file' % config_file)
 
@@ -569,8 +1330,14 @@ if __name__ == "__main__":
     all_parser.add_argument('--all', dest='all', action='store_true',
                     help='calculate tc for all events (default)')
     all_parser.add_argument('--last', dest='all', action='store_false',
-                    help='include only last event')
-    parser.set_defaults(all=True)
+                    help='include only last event (reads only the end of the file)')
+    all_parser.add_argument('--checkpoint', dest='checkpoint', action='store_true',
+                    help='include only the events completed since the previous --checkpoint run (state kept in {})'.format(checkpoint_path))
+    all_parser.add_argument('--stream', dest='stream', action='store_true',
+                    help='calculate tc for all events reading the file in blocks (constant memory use for very long files)')
+    all_parser.add_argument('--event', dest='event', metavar='HH:MM:SS',
+                    help='calculate tc only for the event starting at this time (reads only its part of the file)')
+    parser.set_defaults(all=True, checkpoint=False, stream=False, event=None)
     upload_parser = parser.add_mutually_exclusive_group(required=False)
     upload_parser.add_argument('--upload', dest='upload', action='store_true',
                     help='upload data to cloud')
@@ -585,6 +1352,14 @@ if __name__ == "__main__":
 #                    help='Path to configuration file (config.ini if omitted)')
     parser.add_argument('--intlength', dest='intlength', type=int, default=integral_length,
                     help='Set the length of the integration time in seconds. Must be shorter than data length (default {}s)'.format(integral_length))
+    cache_parser = parser.add_mutually_exclusive_group(required=False)
+    cache_parser.add_argument('--cache', dest='cache', action='store_true',
+                    help='keep the parsed data in {} for the next runs (default)'.format(cache_path))
+    cache_parser.add_argument('--no-cache', dest='cache', action='store_false',
+                    help='always parse the raw files')
+    parser.set_defaults(cache=True)
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                    help='Number of files processed in parallel (default 1)')
     parser.add_argument('--datalength', dest='datalength', type=int, default=data_length,
                     help='Set the length of the integration time in seconds (default {}s)'.format(data_length))
 
@@ -621,23 +1396,49 @@ if __name__ == "__main__":
 ##        print >>sys.stderr, "Using file: {}".format(latest_datafile)
         args.datafile = [open(latest_datafile, 'r')]
 
-    for file in args.datafile:
-        try:
-            mydata = Rawfile(file, events_path=events_path,
-                             integral_length = integral_length, data_length = data_length,
-                             baseline_length = baseline_length, all_events = args.all, baseline = baseline)
-        except:
-            log_message("Oops! could not load the file {}. Check if it is a valid FATCAT FILE".format(file.name))
-            #raise
-        else:
-            try:
-                mydata.calculateAllBaseline()
-                mydata.integrateAll()
-                mydata.printResults(header = args.head, all_events = args.all)
-            except:
-                log_message("Oops!  could not calculate tc table.  Try again...")
-                raise
-
-            if args.upload:
-                    print >>sys.stderr, "uploading events to DB..."
-                    mydata.uploadData(date, all_events = args.all, istart = startIndex)
+    if args.checkpoint or args.stream:
+        args.all = True # all the (new) events
+    if args.checkpoint:
+        if not os.path.isdir(checkpoint_path):
+            os.makedirs(checkpoint_path)
+
+    if args.cache:
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        cache = RawCache(cache_path, max_size = cache_size*1e6)
+    else:
+        cache = None
+
+    options = {
+        "events_path":     events_path,
+        "integral_length": integral_length,
+        "data_length":     data_length,
+        "baseline_length": baseline_length,
+        "baseline":        baseline,
+        "cache":           cache,
+        "checkpoint":      args.checkpoint,
+        "checkpoint_path": checkpoint_path,
+        "stream":          args.stream,
+        "event":           args.event,
+        "all":             args.all,
+        "head":            args.head,
+        "upload":          args.upload,
+        "date":            date,
+        "istart":          startIndex}
+
+    if args.jobs > 1 and len(args.datafile) > 1:
+        # the workers open the files themselves, the tables are printed in the original order
+        filenames = [file.name for file in args.datafile]
+        for file in args.datafile:
+            file.close()
+        pool = multiprocessing.Pool(min(args.jobs, len(filenames)))
+        for filename, output, error in pool.imap(process_datafile_job, [(f, options) for f in filenames]):
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if error:
+                log_message("Oops! could not process the file {}:\n{}".format(filename, error))
+        pool.close()
+        pool.join()
+    else:
+        for file in args.datafile:
+            process_datafile(file, options)
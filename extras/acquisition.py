@@ -0,0 +1,327 @@
+import time, datetime
+import threading
+from collections import deque
+
+from log import log_message
+from persistence import BufferedAppender
+
+class DropQueue(object):
+    # Bounded queue between the tasks of the acquisition. put() never blocks:
+    # when the queue is full the newest item ('drop-newest') or the oldest
+    # one ('drop-oldest') is discarded and counted.
+    def __init__(self, name, maxsize, policy = 'drop-oldest'):
+        if policy not in ('drop-oldest', 'drop-newest'):
+            raise ValueError("unknown overflow policy: {}".format(policy))
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.put_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == 'drop-newest':
+                    return False
+                self.items.popleft()
+            self.items.append(item)
+            self.put_count += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify()
+        return True
+
+    def get_all(self, timeout = None):
+        # waits up to 'timeout' seconds for items and returns all of them
+        with self.cond:
+            if not self.items and timeout:
+                self.cond.wait(timeout)
+            items = list(self.items)
+            self.items.clear()
+        return items
+
+    def stats(self):
+        with self.cond:
+            return {"depth": len(self.items), "max_depth": self.max_depth,
+                    "queued": self.put_count, "dropped": self.dropped}
+
+class DiskWriter(object):
+    # Appends the data lines to the raw file of the day through a
+    # persistence.BufferedAppender with the crash journal 'journal' (see there
+    # for 'size_budget', 'time_budget' and 'fsync'). Every line comes with the
+    # name of its raw file, chosen by the serial intake with 'new_name()' (no
+    # disk access) when the date changes: the file is created with
+    # 'create_file(name)' when its first line arrives. 'binary(datafile, out)'
+    # creates the raw_binary.BinaryWriter of a raw file (optional), its records
+    # go through a second appender with the journal '<journal>.bin'. An append
+    # that raised (IOError, OSError) can be called again with the same line:
+    # the line is written once.
+    def __init__(self, new_name, create_file, journal, binary = None, size_budget = 64*1024,
+                 time_budget = 60, fsync = 'close'):
+        self.new_name = new_name
+        self.create_file = create_file
+        self.binary = binary
+        self.text = BufferedAppender(journal, size_budget, time_budget, fsync)
+        if binary:
+            self.binaryOut = BufferedAppender(journal + '.bin', size_budget, time_budget, fsync)
+        self.written = 0 # lines in the raw file or in the journal
+        self.textDone = False # the text of the line being appended is written
+        self.file = None
+        self._open(new_name())
+
+    def _open(self, datafile):
+        self.create_file(datafile)
+        log_message("Writing to Datafile: " + datafile)
+        self.text.open(datafile)
+        self.binaryFile = self.binary(datafile, self.binaryOut) if self.binary else None
+        # opened when all of it went through
+        self.file = datafile
+
+    def append(self, epoch, daytime, data_string, datafile):
+        if datafile != self.file:
+            # new file at midnight
+            self.close()
+            self._open(datafile)
+        if not self.textDone:
+            self.text.write(daytime + '\t' + data_string)
+            self.textDone = True
+        if self.binaryFile is not None:
+            self.binaryFile.append(epoch, data_string)
+        self.textDone = False
+        self.written += 1
+
+    def poll(self):
+        self.text.poll()
+        if self.binary:
+            self.binaryOut.poll()
+
+    def close(self):
+        self.text.close()
+        if self.binary:
+            self.binaryOut.close()
+
+    def stats(self):
+        stats = self.text.stats()
+        if self.binary:
+            for k, v in self.binaryOut.stats().items():
+                stats[k] += v
+        return stats
+
+class Acquisition(object):
+    # Reads the instrument in the calling thread (batches of lines from
+    # device.readlines()) and hands every line to two worker threads through
+    # bounded queues: the disk writer and the network publisher (broadcast.BroadcastServer, anything with send(lines), stats()
+    # and close()). The serial intake never waits for the disk or the network:
+    # a full disk queue drops the newest lines and a full network queue the
+    # oldest ones (the clients only need the recent data). The queue depths and
+    # the drop counters are logged every 'stats_interval' seconds (see stats()).
+    # 'events' (live_events.LiveEvents, optional) gets the lines in a third
+    # thread with its own queue (drops the newest lines as the disk queue).
+    # 'broker' (serial_broker.SerialBroker, optional) gets the answers to the
+    # queries of other processes before the lines are queued.
+    # The raw file of every line is chosen here, from the time of the line, and
+    # queued with it: the disk and the events threads change file with the
+    # same line at midnight. After a read error the port is opened again
+    # 'reconnect_wait' seconds later, twice as long after every further error
+    # (at most 'max_reconnect_wait') until a line is read. The workers log
+    # their errors and go on (the disk writer retries the line, see
+    # _disk_task()), the intake stops if the disk thread ends anyway.
+    def __init__(self, device, writer, sender, disk_queue = 3600, network_queue = 120,
+                 stats_interval = 600, reconnect_wait = 0.1, max_reconnect_wait = 30,
+                 events = None, broker = None):
+        self.device = device
+        self.writer = writer
+        self.sender = sender
+        self.events = events
+        self.broker = broker
+        self.queues = {
+            "disk":    DropQueue("disk", disk_queue, policy = 'drop-newest'),
+            "network": DropQueue("network", network_queue, policy = 'drop-oldest')}
+        if events is not None:
+            self.queues["events"] = DropQueue("events", disk_queue, policy = 'drop-newest')
+        self.stats_interval = stats_interval
+        self.reconnect_wait = reconnect_wait
+        self.max_reconnect_wait = max_reconnect_wait
+        self.failures = 0 # read errors since the last line read
+        self.date = datetime.date.today()
+        self.datafile = writer.file # written before the threads start
+        self.lines_read = 0
+        self.read_errors = 0
+        self.write_errors = 0
+        self.running = threading.Event()
+        self.threads = {}
+
+    def start(self):
+        self.running.set()
+        tasks = [("disk", self._disk_task), ("network", self._network_task)]
+        if self.events is not None:
+            tasks.append(("events", self._events_task))
+        for name, target in tasks:
+            t = threading.Thread(target = target, name = name)
+            t.daemon = True
+            t.start()
+            self.threads[name] = t
+
+    def stop(self, timeout = 10):
+        # lets the workers write what is left in the queues
+        self.running.clear()
+        for q in self.queues.values():
+            with q.cond:
+                q.cond.notify_all()
+        for t in self.threads.values():
+            t.join(timeout)
+        self.sender.close()
+        if self.broker is not None:
+            self.broker.close()
+
+    def _disk_task(self):
+        # a line that cannot be written (full or read-only card, ...) is
+        # written again after a pause, doubled for every further error (at
+        # most a minute); the lines behind it wait in the queue
+        q = self.queues["disk"]
+        pending = deque()
+        errors = 0
+        while True:
+            running = self.running.is_set()
+            if not pending:
+                pending.extend(q.get_all(timeout = 1))
+            try:
+                while pending:
+                    self.writer.append(*pending[0])
+                    pending.popleft()
+                self.writer.poll()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                self.write_errors += 1
+                wait = min(2**(errors - 1), 60)
+                log_message("cannot write the data ({}), {} line(s) waiting. Retrying in {} s...".format(
+                    e, len(pending) + q.stats()["depth"], wait))
+                if running:
+                    time.sleep(wait)
+            if not running:
+                try:
+                    self.writer.close()
+                except Exception as e:
+                    log_message("cannot close the data file ({})".format(e))
+                if pending:
+                    log_message("{} line(s) not written".format(len(pending)))
+                break
+
+    def _events_task(self):
+        q = self.queues["events"]
+        while True:
+            running = self.running.is_set()
+            for item in q.get_all(timeout = 1):
+                try:
+                    self.events.append(*item)
+                except Exception as e:
+                    log_message("live event processing failed: {}".format(e))
+            if not running:
+                break
+
+    def _network_task(self):
+        q = self.queues["network"]
+        while self.running.is_set():
+            lines = q.get_all(timeout = 1)
+            if lines:
+                try:
+                    self.sender.send(lines)
+                except Exception as e:
+                    log_message("cannot publish the data ({})".format(e))
+
+    def stats(self):
+        stats = dict((name, q.stats()) for name, q in self.queues.items())
+        stats["serial"] = {"lines": self.lines_read, "errors": self.read_errors}
+        stats["disk"]["written"] = self.writer.written
+        stats["disk"]["errors"] = self.write_errors
+        stats["stopped"] = sorted(name for name, t in self.threads.items() if not t.is_alive())
+        stats["disk"].update(self.writer.stats())
+        stats["network"].update(self.sender.stats())
+        if self.events is not None:
+            stats["events"]["found"] = self.events.events
+        if self.broker is not None:
+            stats["broker"] = self.broker.stats()
+        return stats
+
+    def log_stats(self):
+        s = self.stats()
+        log_message("serial lines: {}, read errors: {}; ".format(s["serial"]["lines"], s["serial"]["errors"]) +
+                    "; ".join("{} queue: depth {} (max {}), dropped {}".format(
+                        name, s[name]["depth"], s[name]["max_depth"], s[name]["dropped"])
+                              for name in sorted(self.queues)) +
+                    "; disk writes: {}, bytes: {}, fsyncs: {}, errors: {}".format(
+                        s["disk"]["writes"], s["disk"]["bytes"], s["disk"]["fsyncs"], s["disk"]["errors"]) +
+                    "; clients: {}, lines skipped for slow clients: {}, slow clients dropped: {}".format(
+                        s["network"]["clients"], s["network"]["decimated"], s["network"]["dropped_clients"]) +
+                    ("; STOPPED threads: " + ", ".join(s["stopped"]) if s["stopped"] else ""))
+
+    def run(self):
+        # serial intake until KeyboardInterrupt
+        self.start()
+        next_stats = time.time() + self.stats_interval
+        try:
+            while True:
+                try:
+                    lines = self.device.readlines()
+                    epoch = time.time()
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    self.read_errors += 1
+                    self.failures += 1
+                    log_message("cannot read data-line ({}). Restarting port...".format(e))
+                    try:
+                        self.device.close_port()
+                    except Exception as e:
+                        log_message("cannot close the port ({})".format(e))
+                    # open_port() waits for the instrument to come back, the
+                    # pause keeps a failing port from spinning: short after
+                    # the first error, doubled for every further one
+                    time.sleep(min(self.reconnect_wait*2**(self.failures - 1),
+                                   self.max_reconnect_wait))
+                    try:
+                        self.device.open_port()
+                    except Exception as e:
+                        # the next read fails and the port is opened again
+                        log_message("cannot open the port ({})".format(e))
+                    continue
+                if lines:
+                    self.failures = 0
+                if lines and self.broker is not None:
+                    lines = self.broker.route(lines)
+                if lines:
+                    # the lines of a batch arrived together, they get the same time
+                    self.lines_read += len(lines)
+                    daytime = time.strftime("%H:%M:%S", time.localtime(epoch))
+                    date = datetime.date.fromtimestamp(epoch)
+                    if date != self.date:
+                        # new raw file at midnight
+                        self.date = date
+                        self.datafile = self.writer.new_name()
+                    for data_string in lines:
+                        item = (epoch, daytime, data_string, self.datafile)
+                        self.queues["disk"].put(item)
+                        if self.events is not None:
+                            self.queues["events"].put(item)
+                        self.queues["network"].put(data_string)
+                if epoch >= next_stats:
+                    self.log_stats()
+                    next_stats = epoch + self.stats_interval
+                if not self.threads["disk"].is_alive():
+                    # nothing would be written any more
+                    log_message("the disk writer stopped, acquisition aborted!")
+                    break
+        except KeyboardInterrupt:
+            log_message("aborted by user!")
+        finally:
+            try:
+                self.device.close_port()
+            except Exception as e:
+                log_message("cannot close the port ({})".format(e))
+            log_message("Writing data...")
+            self.stop()
+            self.log_stats()
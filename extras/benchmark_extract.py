@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# python script for benchmarking the analysis of FATCAT raw files
+# The script generates synthetic multi-day raw files (same layout as the logger
+# output) and times the different steps of the extract.py analysis
+
+import argparse      # for argument parsing
+import os, sys, time
+import tempfile, shutil
+
+import numpy as np
+
+base_path = os.path.abspath(os.path.dirname(sys.argv[0]) + '/..')
+sys.path.append(base_path)
+sys.path.append(base_path + '/extras/')
+
+# bits of the status byte (same order as Rawfile.statusKeys, MSB first)
+VALVE = 0x80
+PUMP  = 0x40
+FAN   = 0x20
+OVEN  = 0x10
+BAND  = 0x08
+LICOR = 0x04
+RES2  = 0x02
+
+def write_synthetic_rawfile(filename, days = 1, deltaT = 0.5, cycle = 7200,
+                            oven_start = 360, oven_length = 40, analysis_length = 600,
+                            status_errors = 0, corrupt_lines = 0, seed = 0):
+    # Writes a FATCAT raw file with one burn cycle every 'cycle' seconds.
+    # The instrument is in analysis mode (valve, pump and ext. valve on) during the
+    # first 'analysis_length' seconds of each cycle and in sample mode otherwise
+    # (every second cycle samples with the internal pump on).
+    # 'status_errors' lines with an invalid status byte and 'corrupt_lines' lines
+    # with a garbled CO2 value (serial glitch) are spread over the file.
+    rng = np.random.RandomState(seed)
+    n = int(days*86400/deltaT)
+    runtime = np.arange(n)*deltaT
+    phase = np.mod(runtime, cycle)
+
+    analysis = phase < analysis_length
+    oven = (phase >= oven_start) & (phase < oven_start + oven_length)
+    pump_on = np.mod(runtime // cycle, 2) == 1
+    status = np.where(analysis, VALVE | PUMP | LICOR, np.where(pump_on, PUMP | RES2, RES2)) | FAN | BAND
+    status = np.where(oven, status | OVEN, status)
+
+    peak = 150*np.exp(-0.5*((phase - oven_start - 20)/6.)**2)
+    co2 = 410 + rng.normal(0, 1.5, n) + np.where(analysis, peak, 0)
+    flow = np.where(analysis | pump_on, 1.5, 0) + rng.normal(0, 0.01, n)
+    eflow = np.where(analysis, 0, 5.0) + rng.normal(0, 0.05, n)
+    toven = np.where(oven, 800, 30) + rng.normal(0, 0.5, n)
+    countdown = np.where(oven, oven_start + oven_length - phase, 0)
+
+    status_str = np.array(['{:02X}'.format(s) for s in range(256)])[status]
+    if status_errors:
+        status_str[rng.randint(0, n, status_errors)] = 'ZZ'
+
+    co2_str = np.array(['{:.1f}'.format(c) for c in co2], dtype=object)
+    if corrupt_lines:
+        for i in rng.randint(0, n, corrupt_lines):
+            co2_str[i] = co2_str[i][:2] + '#' + co2_str[i][2:]
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'columns.txt'), 'r') as f:
+        header = f.read()
+
+    line = ('{}\t{:.1f}\t{:.0f}\t{:.1f}\t500\t{:.1f}\t200\t199.5\t{:.2f}\t25.1\t51.2\t{:.2f}'
+            '\t{}\t{:.3f}\t{:.1f}\t{:.0f}\t{}\t0.07\t8.2\t0.05\t3000\t3100\t2900\t3000\n')
+    with open(filename, 'w') as fo:
+        fo.write('2020-01-01\n')
+        fo.write(header)
+        for i in range(n):
+            s = int(runtime[i]) % 86400
+            daytime = '{:02d}:{:02d}:{:02d}'.format(s//3600, (s//60) % 60, s % 60)
+            fo.write(line.format(daytime, runtime[i], 800 if oven[i] else 0, toven[i], toven[i],
+                                 eflow[i], 98.5 + rng.normal(0, 0.1), co2_str[i], flow[i],
+                                 10 if oven[i] else 0, countdown[i], status_str[i]))
+    return n
+
+def legacy_count_and_fetch_events(rawfile):
+    # iterrows implementation of Rawfile._countAndFetchEvents (before the
+    # vectorized version) used as reference for timing and validation
+    import pandas as pd
+    events = []
+    resultsDf = pd.DataFrame(columns = rawfile.eventKeys)
+    for index, row in rawfile.df[rawfile.on_status].iterrows():
+        if not events or (row['Time'] > rawfile.df['Time'][events[-1]] + rawfile.datalength):
+            events.append(index)
+            resultsDf = resultsDf.append(
+                {rawfile.eventKeys[0]: int(index), rawfile.eventKeys[1]: row['Time'],
+                 rawfile.eventKeys[2]: row['Daytime']}, ignore_index=True).fillna(0)
+    return events, resultsDf
+
+def legacy_decode_status(status, keys):
+    # hex2bin string expansion used by Rawfile._load before the bitwise decoder
+    from status_byte import statusKeys, hex2bin
+    def iserror(x):
+        try:
+            hex2bin(x)
+            return False
+        except Exception:
+            return True
+    mask = status.apply(iserror)
+    status = status[~mask]
+    flags = {}
+    for k in keys:
+        flags[k] = [bool(int(hex2bin(x)[statusKeys.index(k)])) for x in status]
+    return flags, ~mask
+
+def timeit(label, func, *args, **kw):
+    t0 = time.time()
+    result = func(*args, **kw)
+    print "{:<48} {:8.3f} s".format(label, time.time() - t0)
+    return result
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks the analysis of synthetic FATCAT raw files.')
+    parser.add_argument('--days', dest='days', type=float, default=3,
+                    help='Number of days of data in the synthetic file (default 3)')
+    parser.add_argument('--corrupt', dest='corrupt', type=int, default=0,
+                    help='Number of lines with a garbled value in the synthetic file (default 0)')
+    parser.add_argument('--legacy', dest='legacy', action='store_true',
+                    help='also time the reference (pre-vectorized) implementations')
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                    help='do not delete the generated files')
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from extract import Rawfile, LastEventRawfile
+
+    tmp_dir = tempfile.mkdtemp(prefix='fatcat-bench-')
+    events_dir = tmp_dir + '/events/'
+    os.mkdir(events_dir)
+    rawname = tmp_dir + '/FATCAT-synthetic.txt'
+    n = timeit('writing {:.1f} days ({} rows)'.format(args.days, int(args.days*172800)),
+               write_synthetic_rawfile, rawname, days = args.days, corrupt_lines = args.corrupt)
+
+    mydata = timeit('Rawfile (load + events + volume)', Rawfile, open(rawname, 'r'),
+                    events_path = events_dir, integral_length = 65,
+                    data_length = 120, baseline_length = 10)
+    timeit('LastEventRawfile (--last)', LastEventRawfile, open(rawname, 'r'),
+           events_path = events_dir, integral_length = 65,
+           data_length = 120, baseline_length = 10)
+    import pandas as pd
+    from status_byte import statusKeys, status_flags
+    status = pd.read_csv(rawname, sep='\t', skiprows = 3, header = None,
+                         usecols = [16], dtype = 'object')[16]
+    flags, valid = timeit('status_flags (all 8 bits)', status_flags, status)
+    if args.legacy:
+        old_flags, old_valid = timeit('hex2bin decoding (all 8 bits, legacy)',
+                                      legacy_decode_status, status, statusKeys)
+        print "identical status bits:  ", all(
+            np.array_equal(flags[k][valid], old_flags[k]) for k in statusKeys)
+
+    # _countAndFetchEvents rebuilds the results table, keep the complete one
+    resultsDf = mydata.resultsDf
+    events = timeit('_countAndFetchEvents', mydata._countAndFetchEvents)
+    if args.legacy:
+        eventsDf = mydata.resultsDf
+        old_events, old_results = timeit('_countAndFetchEvents (legacy)',
+                                         legacy_count_and_fetch_events, mydata)
+        print "identical event indexes:", list(events) == old_events
+        print "identical event table:  ", old_results.equals(eventsDf)
+    mydata.resultsDf = resultsDf
+
+    volume, co2 = timeit('_calculateAllSamplingVolumes', mydata._calculateAllSamplingVolumes)
+    if args.legacy:
+        old_volume = timeit('_calculateSamplingVolume (legacy, per event)',
+                            lambda: [mydata._calculateSamplingVolume(e) for e in range(mydata.numEvents)])
+        print "same sampling volumes:  ", np.allclose(volume, [v for v, c in old_volume]) and \
+            np.allclose(co2, [c for v, c in old_volume])
+    timeit('calculateAllBaseline', mydata.calculateAllBaseline)
+    timeit('integrateAll', mydata.integrateAll)
+
+    if args.keep:
+        print "files kept in", tmp_dir
+    else:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# python script for benchmarking the disk writes of logger.py
+# Writes one hour of synthetic data lines with the former logger loop (string
+# concatenation, open/append/close every BUFFER lines) and with the DiskWriter
+# (persistence.BufferedAppender) and reports per hour the write syscalls and
+# the bytes passed to them, the bytes sent to the block device by this process
+# (write_bytes of /proc/self/io, Linux) and, when the directory of the files
+# is on a block device, the bytes written to the device (/sys/dev/block stat,
+# after a sync, includes the writeback of the journal pages and the writes of
+# other processes).
+
+import argparse      # for argument parsing
+import os, sys, time
+import tempfile, shutil
+import subprocess
+
+base_path = os.path.abspath(os.path.dirname(sys.argv[0]) + '/..')
+sys.path.append(base_path)
+sys.path.append(base_path + '/extras/')
+
+from benchmark_extract import write_synthetic_rawfile
+
+def block_stat(path):
+    # stat file of the block device of 'path', None if there is none (tmpfs)
+    dev = os.stat(path).st_dev
+    stat = '/sys/dev/block/{}:{}/stat'.format(os.major(dev), os.minor(dev))
+    return stat if os.path.exists(stat) else None
+
+def io_counters(stat = None):
+    # write syscalls, bytes passed to write calls and bytes sent to the block
+    # device by this process, and bytes written to the device of the block
+    # 'stat' file (after a sync, None without 'stat')
+    counters = {}
+    with open('/proc/self/io', 'r') as f:
+        for line in f:
+            k, v = line.split(':')
+            counters[k] = int(v)
+    device = None
+    if stat is not None:
+        subprocess.call(['sync'])
+        with open(stat, 'r') as f:
+            device = int(f.read().split()[6])*512 # sectors written
+    return counters['syscw'], counters['wchar'], counters['write_bytes'], device
+
+def io_delta(c0, c1):
+    return [None if a is None else b - a for a, b in zip(c0, c1)]
+
+def legacy_logger(filename, lines, buffersize):
+    # disk writes of logger.py before the DiskWriter
+    i = 0
+    x = ''
+    for daytime, data_string in lines:
+        x += daytime + '\t' + data_string
+        i += 1
+        if i >= buffersize:
+            fo = open(filename, "a")
+            fo.write(x)
+            fo.close()
+            x = ''
+            i = 0
+    if x:
+        fo = open(filename, "a")
+        fo.write(x)
+        fo.close()
+
+class Clock(object):
+    # time of the synthetic lines for the time budget of the appender
+    def __init__(self):
+        self.now = 0
+    def __call__(self):
+        return self.now
+
+def buffered_logger(filename, lines, deltaT, journal, size_budget, time_budget, fsync,
+                    binary = None):
+    import acquisition
+    clock = Clock()
+    appender = acquisition.BufferedAppender
+    # the appenders of the DiskWriter use the clock of the synthetic lines
+    acquisition.BufferedAppender = lambda *args: appender(*args, clock = clock)
+    try:
+        writer = acquisition.DiskWriter(lambda: filename, lambda name: None, journal, binary = binary,
+                                        size_budget = size_budget, time_budget = time_budget,
+                                        fsync = fsync)
+    finally:
+        acquisition.BufferedAppender = appender
+    epoch = time.time() # same date for all lines
+    for daytime, data_string in lines:
+        clock.now += deltaT
+        writer.append(epoch, daytime, data_string, filename)
+        writer.poll()
+    writer.close()
+    return writer.stats()
+
+def report(label, counters, opens, hours):
+    syscalls, nbytes, block, device = counters
+    print "{:<44} {:8.0f} writes/h {:10.0f} bytes/h {:6.1f} opens/h".format(
+        label, syscalls/hours, nbytes/hours, opens/hours)
+    print "{:<44} {:10.0f} block bytes/h (process) {}".format(
+        '', block/hours, '' if device is None else '{:10.0f} block bytes/h (device)'.format(device/hours))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks the disk writes of logger.py.')
+    parser.add_argument('--hours', dest='hours', type=float, default=1,
+                    help='Hours of data (default 1)')
+    parser.add_argument('--buffer', dest='buffer', type=int, default=30,
+                    help='BUFFER of the former logger in lines (default 30)')
+    parser.add_argument('--bytes', dest='bytes', type=int, default=64*1024,
+                    help='size budget of the write buffer in bytes (default 65536)')
+    parser.add_argument('--seconds', dest='seconds', type=float, default=60,
+                    help='time budget of the write buffer in seconds (default 60)')
+    parser.add_argument('--fsync', dest='fsync', default='close',
+                    choices=['never', 'flush', 'close'],
+                    help='fsync policy (default close)')
+    parser.add_argument('--dir', dest='dir', default=None,
+                    help='directory of the files (default: a temporary directory)')
+    parser.add_argument('--journal', dest='journal', default='/dev/shm',
+                    help='directory of the journal (default /dev/shm, the directory of the files if missing)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='fatcat-bench-', dir=args.dir)
+    journal_dir = tempfile.mkdtemp(prefix='fatcat-bench-', dir=args.journal) \
+                  if os.path.isdir(args.journal) else tmp_dir
+    stat = block_stat(tmp_dir)
+    deltaT = 0.5
+    rawname = os.path.join(tmp_dir, 'synthetic.txt')
+    write_synthetic_rawfile(rawname, days = args.hours/24., deltaT = deltaT)
+    with open(rawname, 'r') as f:
+        lines = [(l[:8], l[9:]) for l in f.readlines()[3:]]
+    print "{} lines of {:.0f} bytes".format(len(lines), sum(len(l) for d, l in lines)/float(len(lines)) + 9)
+
+    t0 = time.time()
+    c0 = io_counters(stat)
+    legacy_logger(os.path.join(tmp_dir, 'legacy.txt'), lines, args.buffer)
+    c1 = io_counters(stat)
+    report('open/append/close every {} lines'.format(args.buffer), io_delta(c0, c1),
+           -(-len(lines)//args.buffer), args.hours)
+    print "{:<44} {:10.3f} s".format('', time.time() - t0)
+
+    t0 = time.time()
+    c0 = io_counters(stat)
+    stats = buffered_logger(os.path.join(tmp_dir, 'buffered.txt'), lines, deltaT,
+                            os.path.join(journal_dir, '.journal'), args.bytes, args.seconds, args.fsync)
+    c1 = io_counters(stat)
+    report('DiskWriter ({} bytes, {:g} s, fsync {})'.format(args.bytes, args.seconds, args.fsync),
+           io_delta(c0, c1), 1, args.hours)
+    print "{:<44} {:10.3f} s, {} fsync calls/h".format('', time.time() - t0, stats['fsyncs']/args.hours)
+    print "journal: {}, block device of the files: {}".format(journal_dir, stat)
+
+    shutil.rmtree(tmp_dir)
+    if journal_dir != tmp_dir:
+        shutil.rmtree(journal_dir)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# python script for benchmarking the serial intake of logger.py
+# A child process writes synthetic data lines to a pseudo terminal at a given
+# rate and the instrument reads them from the other end, one call per line
+# (former logger loop, pyserial readline) or in batches (instrument.readlines).
+# Reports the CPU time and the read syscalls (/proc/self/io) per 1000 lines.
+
+import argparse      # for argument parsing
+import os, sys, time, pty, tty
+import resource
+import tempfile, shutil
+import serial
+
+base_path = os.path.abspath(os.path.dirname(sys.argv[0]) + '/..')
+sys.path.append(base_path)
+sys.path.append(base_path + '/extras/')
+
+from instrument import instrument
+from benchmark_extract import write_synthetic_rawfile
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def read_counters():
+    # read syscalls of this process
+    with open('/proc/self/io', 'r') as f:
+        for line in f:
+            k, v = line.split(':')
+            if k == 'syscr':
+                return int(v)
+
+def feed(fd, lines, rate, burst):
+    # writes 'burst' lines every burst/rate seconds
+    t0 = time.time()
+    for i in range(0, len(lines), burst):
+        delay = t0 + i/rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        os.write(fd, ''.join(lines[i:i + burst]))
+
+def measure(device, method, lines, rate, burst):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    device.ser = serial.Serial(os.ttyname(slave), timeout = 1)
+    device.rxbuffer = ''
+    device.rxlines.clear()
+    pid = os.fork()
+    if pid == 0:
+        os.close(slave)
+        feed(master, lines, rate, burst)
+        time.sleep(2)
+        os._exit(0)
+
+    n = 0
+    cpu0, reads0 = cpu_time(), read_counters()
+    while n < len(lines):
+        if method == 'readline':
+            n += len(device.ser.readline()) > 0
+        else:
+            n += len(device.readlines())
+    cpu, reads = cpu_time() - cpu0, read_counters() - reads0
+    os.waitpid(pid, 0)
+    device.ser.close()
+    os.close(master)
+    os.close(slave)
+    return cpu, reads
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks the serial intake of logger.py.')
+    parser.add_argument('--lines', dest='lines', type=int, default=5000,
+                    help='number of lines (default 5000)')
+    parser.add_argument('--rate', dest='rate', type=float, default=200,
+                    help='lines per second (default 200)')
+    parser.add_argument('--burst', dest='burst', type=int, default=1,
+                    help='lines written together (default 1)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='fatcat-bench-')
+    rawname = os.path.join(tmp_dir, 'synthetic.txt')
+    write_synthetic_rawfile(rawname, days = args.lines*0.5/86400 + 1e-4)
+    with open(rawname, 'r') as f:
+        lines = [l.split('\t', 1)[1].replace('\n', '\r\n') for l in f.readlines()[3:3 + args.lines]]
+    config_file = os.path.join(tmp_dir, 'config.ini')
+    with open(config_file, 'w') as f:
+        f.write("[SERIAL_SETTINGS]\nSERIAL_PORT_DESCRIPTION: 'pty'\nSERIAL_BAUDRATE: 115200\n"
+                "SERIAL_PARITY: serial.PARITY_NONE\nSERIAL_STOPBITS: serial.STOPBITS_ONE\n"
+                "SERIAL_BYTESIZE: serial.EIGHTBITS\nSERIAL_TIMEOUT: 1\n")
+    device = instrument(config_file = config_file)
+    shutil.rmtree(tmp_dir)
+
+    print "{} lines at {:g} lines/s in bursts of {}".format(len(lines), args.rate, args.burst)
+    for method in ['readline', 'readlines']:
+        cpu, reads = measure(device, method, lines, args.rate, args.burst)
+        print "{:<10} {:8.1f} ms CPU/1000 lines {:8.0f} read syscalls/1000 lines".format(
+            method, cpu*1e6/len(lines), reads*1000./len(lines))
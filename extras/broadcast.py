@@ -0,0 +1,227 @@
+import os, time, fcntl
+import socket, select, errno
+import threading
+
+from log import log_message
+
+class Subscriber(object):
+    # A client of the BroadcastServer with its own send buffer. When the client
+    # does not read fast enough, only one of every 'decimation' lines is queued
+    # once the buffer is half full, and the client is dropped when it is full.
+    def __init__(self, sock, address, max_buffer, decimation):
+        self.sock = sock
+        self.address = address
+        self.max_buffer = max_buffer
+        self.decimation = decimation
+        self.out = bytearray()
+        self.lock = threading.Lock()
+        self.skip = 0
+        self.decimated = 0
+        self.full = False
+
+    def queue(self, lines):
+        with self.lock:
+            for line in lines:
+                if len(self.out) >= self.max_buffer:
+                    self.full = True
+                    return
+                if len(self.out) >= self.max_buffer//2:
+                    self.skip = (self.skip + 1) % self.decimation
+                    if self.skip:
+                        self.decimated += 1
+                        continue
+                self.out.extend(line)
+
+    def pending(self):
+        with self.lock:
+            return len(self.out) > 0
+
+    def flush(self):
+        # sends what the socket takes without blocking
+        with self.lock:
+            data = bytes(self.out[:65536])
+        n = self.sock.send(data)
+        with self.lock:
+            del self.out[:n]
+
+class BroadcastServer(object):
+    # Publishes the data lines of the logger to any number of TCP clients (gui,
+    # live analysis, remote monitors). The clients only have to connect and read.
+    # send() only copies the lines to the buffer of each client, a thread with a
+    # select loop accepts the clients and writes the buffers, thus a slow client
+    # does not delay the others nor the logger (see Subscriber for the limits).
+    def __init__(self, server_address, max_buffer = 256*1024, decimation = 4):
+        self.server_address = server_address
+        self.max_buffer = max_buffer
+        self.decimation = decimation
+        self.clients = []
+        self.lock = threading.Lock()
+        self.sent = 0          # lines published
+        self.not_sent = 0      # lines published without clients
+        self.decimated = 0     # lines skipped for slow clients
+        self.dropped_clients = 0
+        self.connections = 0
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(server_address)
+        self.listener.listen(5)
+        self.listener.setblocking(False)
+        # wakes the loop up; non blocking, a full pipe already wakes it
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.running = True
+        self.thread = threading.Thread(target = self._loop, name = "broadcast")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, lines):
+        with self.lock:
+            clients = self.clients[:]
+        if not clients:
+            self.not_sent += len(lines)
+            return
+        for c in clients:
+            c.queue(lines)
+        self.sent += len(lines)
+        self._wake()
+
+    def close(self):
+        self.running = False
+        self._wake()
+        self.thread.join(5)
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def stats(self):
+        with self.lock:
+            clients = len(self.clients)
+            decimated = self.decimated + sum(c.decimated for c in self.clients)
+        return {"clients": clients, "connections": self.connections, "sent": self.sent,
+                "not_sent": self.not_sent, "decimated": decimated,
+                "dropped_clients": self.dropped_clients}
+
+    def _remove(self, client, reason):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+                self.decimated += client.decimated
+        client.sock.close()
+        log_message("client {} disconnected ({})".format(client.address, reason))
+
+    def _loop(self):
+        # the errors are logged and the loop goes on (a dead loop would stop
+        # the data of all clients)
+        while self.running:
+            try:
+                self._step()
+            except Exception as e:
+                log_message("broadcast loop error ({})".format(e))
+                time.sleep(1)
+
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for c in clients:
+            c.sock.close()
+        self.listener.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def _step(self):
+        # one pass of the select loop
+        with self.lock:
+            clients = self.clients[:]
+        for c in clients:
+            if c.full:
+                self.dropped_clients += 1
+                self._remove(c, "too slow")
+        clients = [c for c in clients if not c.full]
+        writers = [c.sock for c in clients if c.pending()]
+        try:
+            readable, writable, _ = select.select(
+                [self.listener, self.wake_r] + [c.sock for c in clients], writers, [], 1)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            # e.g., a socket closed under the loop: the clients that cannot be
+            # selected are removed
+            for c in clients:
+                try:
+                    select.select([c.sock], [], [], 0)
+                except (select.error, socket.error) as e:
+                    self._remove(c, e)
+            raise
+        if self.wake_r in readable:
+            try:
+                os.read(self.wake_r, 4096)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        if self.listener in readable:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error:
+                pass
+            else:
+                sock.setblocking(False)
+                with self.lock:
+                    self.clients.append(Subscriber(sock, address, self.max_buffer, self.decimation))
+                self.connections += 1
+                log_message("client {} connected".format(address))
+        for c in clients:
+            try:
+                if c.sock in readable and not c.sock.recv(4096):
+                    self._remove(c, "closed")
+                    continue
+                if c.sock in writable:
+                    c.flush()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._remove(c, e)
+
+class LineReader(object):
+    # Client side: reads the lines published by the BroadcastServer from the
+    # socket 'sock' without blocking. TCP may split a line or merge several,
+    # the bytes after the last line break are kept for the next read().
+    def __init__(self, sock, max_line = 4096, max_bytes = 1 << 20):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.max_line = max_line   # longer partial lines are discarded (no line break)
+        self.max_bytes = max_bytes # bytes read at most by one read()
+        self.buffer = ''
+        self.closed = False        # the server closed the connection
+        self.discarded = 0
+
+    def read(self):
+        # returns all the complete lines received so far (without line break)
+        chunks = [self.buffer]
+        n = 0
+        while n < self.max_bytes:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                self.closed = True
+                break
+            chunks.append(data)
+            n += len(data)
+        data = ''.join(chunks)
+        end = data.rfind('\n') + 1
+        self.buffer = data[end:]
+        if len(self.buffer) > self.max_line:
+            self.discarded += len(self.buffer)
+            self.buffer = ''
+        if not end:
+            return []
+        return [l.rstrip('\r') for l in data[:end - 1].split('\n')]
@@ -0,0 +1,168 @@
+import numpy as np
+from collections import namedtuple
+
+# positions of the rows used for the analysis of each event:
+# the baseline is averaged over baseline_start <= i < event start,
+# the event data spans event start <= i <= data_end and the tc is
+# integrated over the first nintegral rows of the event data
+EventWindows = namedtuple("EventWindows", ["baseline_start", "data_end", "nintegral", "end_of_file"])
+
+def find_events(runtime, oven_on, data_length, previous_event = None):
+    # Returns the positions (not the DataFrame labels) of the rows starting an event.
+    # An event starts at the first row with the oven on (rising edge of the oven bit)
+    # and every oven-on row more than 'data_length' seconds after the start of the
+    # previous event begins a new one. 'previous_event' is the runtime of an event
+    # found before the first row (e.g., in an earlier part of the file).
+    runtime = np.asarray(runtime, dtype='float64')
+    on_pos = np.flatnonzero(np.asarray(oven_on, dtype=bool))
+    if previous_event is not None:
+        with np.errstate(invalid='ignore'):
+            after = np.flatnonzero(runtime[on_pos] > previous_event + data_length)
+        on_pos = on_pos[after[0]:] if len(after) else on_pos[:0]
+    if not len(on_pos):
+        return on_pos
+    on_time = runtime[on_pos]
+
+    starts = [0]
+    with np.errstate(invalid='ignore'):
+        monotonic = np.all(np.diff(on_time) >= 0)
+    if monotonic:
+        # monotonic runtime: jump straight to the next event using a binary search
+        i = 0
+        while True:
+            i = np.searchsorted(on_time, on_time[i] + data_length, side='right')
+            if i >= len(on_time):
+                break
+            starts.append(i)
+    else:
+        # runtime reset (instrument restart) or missing values: same rule row by row
+        last = on_time[0]
+        for i in range(1, len(on_time)):
+            if on_time[i] > last + data_length:
+                starts.append(i)
+                last = on_time[i]
+
+    return on_pos[starts]
+
+def is_sorted(runtime):
+    # True if the runtime never decreases and has no missing values
+    runtime = np.asarray(runtime, dtype='float64')
+    with np.errstate(invalid='ignore'):
+        return not np.isnan(runtime).any() and np.all(np.diff(runtime) >= 0)
+
+def cumulative_trapz(y, x):
+    # Running trapezoidal integral, c[i] is the integral of y from x[0] to x[i].
+    # Segments that are not finite are left out of the sum and counted in 'nbad'
+    # so that intervals containing them can be integrated separately.
+    y = np.asarray(y, dtype='float64')
+    x = np.asarray(x, dtype='float64')
+    with np.errstate(invalid='ignore'):
+        segments = np.diff(x)*(y[1:] + y[:-1])/2.0
+    bad = ~np.isfinite(segments)
+    c = np.concatenate(([0.], np.cumsum(np.where(bad, 0, segments))))
+    nbad = np.concatenate(([0], np.cumsum(bad)))
+    return c, nbad
+
+def trapz_intervals(y, x, lo, hi):
+    # np.trapz(y[lo:hi], x=x[lo:hi]) for every pair of bounds (lo, hi),
+    # evaluated as the difference of two cumulative integrals
+    y = np.asarray(y, dtype='float64')
+    x = np.asarray(x, dtype='float64')
+    lo = np.asarray(lo, dtype='int64')
+    hi = np.asarray(hi, dtype='int64')
+    result = np.zeros(len(lo))
+    valid = hi - lo >= 2 # one row or less integrates to zero
+    if not valid.any():
+        return result
+    c, nbad = cumulative_trapz(y, x)
+    first, last = lo[valid], hi[valid] - 1
+    result[valid] = c[last] - c[first]
+    # non finite values propagate as in np.trapz
+    for k in np.flatnonzero(valid)[nbad[last] - nbad[first] > 0]:
+        result[k] = np.trapz(y[lo[k]:hi[k]], x=x[lo[k]:hi[k]])
+    return result
+
+def window_means(y, lo, hi):
+    # mean of y[lo:hi] ignoring missing values (NaN if the window is empty)
+    y = np.asarray(y, dtype='float64')
+    missing = np.isnan(y)
+    s = np.concatenate(([0.], np.cumsum(np.where(missing, 0, y))))
+    n = np.concatenate(([0], np.cumsum(~missing)))
+    lo = np.asarray(lo, dtype='int64')
+    hi = np.maximum(np.asarray(hi, dtype='int64'), lo)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (s[hi] - s[lo])/(n[hi] - n[lo])
+
+def near_rounding_tie(values, decimals, tolerance = 1e-4):
+    # True where the last digit kept by round(values, decimals) could change
+    # within the floating point error of a cumulative sum
+    scaled = np.asarray(values, dtype='float64')*10**decimals
+    with np.errstate(invalid='ignore'):
+        return np.abs(scaled - np.floor(scaled) - 0.5) < tolerance
+
+def _first_within(runtime, t, length, hi):
+    # first position k <= hi with t - runtime[i] <= length for all k <= i < hi (sorted runtime)
+    k = min(np.searchsorted(runtime, t - length, side='left'), hi)
+    while k > 0 and t - runtime[k - 1] <= length:
+        k -= 1
+    while k < hi and not t - runtime[k] <= length:
+        k += 1
+    return k
+
+def _first_after(runtime, t, length, lo):
+    # first position k >= lo with runtime[k] - t > length (sorted runtime)
+    k = max(np.searchsorted(runtime, t + length, side='right'), lo)
+    while k > lo and not runtime[k - 1] - t <= length:
+        k -= 1
+    while k < len(runtime) and runtime[k] - t <= length:
+        k += 1
+    return k
+
+def event_windows(runtime, starts, event_runtime, baseline_length, integral_length, data_length):
+    # Resolves the baseline and integration windows of all events at once.
+    # 'starts' are the positions of the first row of each event and 'event_runtime'
+    # the runtime used as reference (normally runtime[starts]). The rules are the
+    # ones of the row by row search used in Rawfile before:
+    #   - the baseline goes back while 'event_runtime - runtime <= baseline_length'
+    #   - the event data goes forward while 'runtime - event_runtime <= data_length',
+    #     the last two rows before the first row out of range are dropped
+    #     (back compatibility), and stops one row before the end of the file
+    #   - the rows after the start of the event within the integral length are
+    #     counted, the integral then starts at the first row of the event
+    runtime = np.asarray(runtime, dtype='float64')
+    starts = np.asarray(starts, dtype='int64')
+    event_runtime = np.asarray(event_runtime, dtype='float64')
+    n = len(runtime)
+    sorted_runtime = is_sorted(runtime)
+
+    baseline_start = np.zeros(len(starts), dtype='int64')
+    data_end = np.zeros(len(starts), dtype='int64')
+    nintegral = np.zeros(len(starts), dtype='int64')
+    end_of_file = np.zeros(len(starts), dtype=bool)
+    for k, (i0, t) in enumerate(zip(starts, event_runtime)):
+        if sorted_runtime:
+            baseline_start[k] = _first_within(runtime, t, baseline_length, i0 + 1)
+            stop = _first_after(runtime, t, data_length, i0 + 1)
+        else:
+            with np.errstate(invalid='ignore'):
+                out = np.flatnonzero(~(t - runtime[:i0 + 1] <= baseline_length))
+                baseline_start[k] = out[-1] + 1 if len(out) else 0
+                out = np.flatnonzero(~(runtime[i0 + 1:] - t <= data_length))
+                stop = i0 + 1 + out[0] if len(out) else n
+        if i0 >= n - 1:
+            # no data after the start of the event
+            data_end[k] = i0 - 2
+            end_of_file[k] = runtime[i0] - t <= data_length
+            continue
+        if stop >= n:
+            stop = n - 1
+            end_of_file[k] = True
+        data_end[k] = stop - 2
+        # rows i0 < i <= stop within the integral length
+        if sorted_runtime:
+            nintegral[k] = min(_first_after(runtime, t, integral_length, i0 + 1), stop + 1) - (i0 + 1)
+        else:
+            with np.errstate(invalid='ignore'):
+                nintegral[k] = np.count_nonzero(runtime[i0 + 1:stop + 1] - t <= integral_length)
+
+    return EventWindows(baseline_start, data_end, nintegral, end_of_file)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Sidecar index of the oven-on segments of a raw file (the name of the raw file
+# with the extension .idx instead of its own, see index_name). After a json
+# header of 'headerLength' bytes (padded with spaces) every segment of
+# consecutive oven-on rows (rows with an invalid status byte are skipped) is a
+# fixed size record:
+#   offset   int64, byte offset of the first row of the segment
+#   row      int64, row number of that row (DataFrame index of extract.py)
+#   runtime  float64, runtime of the first row
+#   last     float64, largest runtime of the segment
+#   daytime  8 chars, daytime of the first row
+# The header keeps the end of the indexed data, update_index() only reads the
+# lines appended since the last update. The events are found from the records
+# (EventIndex.events) and the lookups are binary searches on them.
+
+import os, sys, json
+import argparse      # for argument parsing
+import datetime
+import numpy as np
+
+from status_byte import decode_status, status_bit
+from raw_lines import scan_lines, parsed_lines
+from log import log_message
+
+headerLength = 512
+version = 1
+extension = '.idx'
+record_dtype = np.dtype([('offset', '<i8'), ('row', '<i8'), ('runtime', '<f8'),
+                         ('last', '<f8'), ('daytime', 'S8')])
+
+def index_name(datafile):
+    # name of the index of the raw file 'datafile'
+    return os.path.splitext(datafile)[0] + extension
+
+def _raw_header(datafile):
+    # byte offset of the first data line and positions of the runtime and the
+    # status byte columns (same rules as Rawfile._read_header)
+    with open(datafile, 'r') as f:
+        line = f.readline()
+        try:
+            datetime.datetime.strptime(line.rstrip('\n'), '%Y-%m-%d')
+            line = f.readline()
+        except ValueError:
+            pass
+        columns = line.rstrip('\n').rstrip('\r').split('\t')
+        f.readline() # units
+        return f.tell(), columns.index('Time'), columns.index('Status Byte')
+
+class EventIndex(object):
+    # Header and records of an event index (see above)
+    def __init__(self, header, records):
+        self.header = header
+        self.records = records
+
+    def events(self, data_length):
+        # Positions of the records starting an event (rules of find_events) and
+        # False if the index cannot tell them: an event may start within a
+        # segment (longer than 'data_length' or with a runtime reset) or an
+        # oven-on row has no runtime.
+        exact = self.header['nan_oven'] == 0
+        events = []
+        last = None
+        for i, (start, end) in enumerate(zip(self.records['runtime'], self.records['last'])):
+            if last is None or start > last + data_length:
+                events.append(i)
+                last = start
+            if end > last + data_length:
+                exact = False
+        return np.array(events, dtype = 'int64'), exact
+
+    def find(self, daytime, positions = None):
+        # Position of the record (or of the record in 'positions') starting at
+        # 'daytime', None if there is none. Raises ValueError if several records
+        # start at 'daytime' (a file of several days). The daytimes of the files
+        # of the logger are sorted (one file per day), other files are searched
+        # record by record.
+        daytimes = self.records['daytime']
+        if positions is not None:
+            daytimes = daytimes[positions]
+        if self.header['sorted']:
+            i = np.searchsorted(daytimes, daytime)
+            n = np.searchsorted(daytimes, daytime, side = 'right') - i
+        else:
+            found = np.flatnonzero(daytimes == daytime)
+            i, n = (found[0] if len(found) else len(daytimes)), len(found)
+        if n > 1:
+            raise ValueError("{} records start at {}".format(n, daytime))
+        if n:
+            return i
+        return None
+
+    def at_row(self, row):
+        # position of the last record starting at or before the row 'row', -1 if none
+        return np.searchsorted(self.records['row'], row, side = 'right') - 1
+
+def read_index(filename):
+    # EventIndex of the file 'filename', None if it is not a valid index
+    try:
+        with open(filename, 'rb') as f:
+            header = json.loads(f.read(headerLength))
+            if header.get('format') != "FATCAT event index" or header.get('version') != version:
+                return None
+            records = np.frombuffer(f.read(header['count']*record_dtype.itemsize), dtype = record_dtype)
+    except (IOError, ValueError):
+        return None
+    if len(records) != header['count']:
+        return None
+    return EventIndex(header, records.copy())
+
+def update_index(datafile, block_size = 1 << 22):
+    # Indexes the lines appended to 'datafile' since the last update (the whole
+    # file the first time) and returns its EventIndex. The index is only kept in
+    # memory when it cannot be written.
+    filename = index_name(datafile)
+    stat = os.stat(datafile)
+    index = read_index(filename) if os.path.exists(filename) else None
+    if (index is None or index.header['inode'] != stat.st_ino
+            or index.header['end'] > stat.st_size):
+        data_offset, time_col, status_col = _raw_header(datafile)
+        index = EventIndex({"format": "FATCAT event index", "version": version,
+                            "inode": stat.st_ino, "data_offset": data_offset,
+                            "time_column": time_col, "status_column": status_col,
+                            "end": data_offset, # end of the indexed data
+                            "rows": 0,          # rows before 'end'
+                            "open": False,      # the last indexed row is oven-on
+                            "nan_oven": 0,      # oven-on rows without runtime
+                            "sorted": True,     # the daytimes of the records are sorted
+                            "count": 0}, np.zeros(0, dtype = record_dtype))
+        rewrite = 0
+    else:
+        # the last segment may go on
+        rewrite = max(index.header['count'] - 1, 0)
+    if stat.st_size == index.header['end']:
+        return index
+
+    header = index.header
+    records = [tuple(r) for r in index.records]
+    ncols = max(header['time_column'], header['status_column']) + 1
+    with open(datafile, 'rb') as f:
+        f.seek(header['end'], 0)
+        while True:
+            data = f.read(block_size)
+            complete = data[:data.rfind('\n') + 1]
+            if not complete:
+                break
+            offset = header['end']
+            f.seek(offset + len(complete), 0)
+            starts, ends = scan_lines(complete, offset)
+            parsed = np.flatnonzero(parsed_lines(complete, starts, ends, offset))
+            lines = complete.split('\n')
+            fields = [lines[i].split('\t', ncols) for i in parsed]
+            runtime = np.array([_float(l, header['time_column']) for l in fields], dtype = 'float64')
+            status = np.array([l[header['status_column']] if len(l) > header['status_column'] else ''
+                               for l in fields], dtype = object)
+            codes, nbits, valid = decode_status(status)
+            oven = status_bit(codes, nbits, "oven") & valid
+
+            on = oven[valid]
+            previous = np.concatenate(([header['open']], on[:-1]))
+            vpos = np.flatnonzero(valid)
+            for i in np.flatnonzero(on):
+                p = vpos[i]
+                t = runtime[p]
+                if np.isnan(t):
+                    header['nan_oven'] += 1
+                if not previous[i] or not records:
+                    daytime = fields[p][0][:8]
+                    if records and daytime < records[-1][4]:
+                        header['sorted'] = False
+                    records.append((starts[parsed[p]], header['rows'] + p, t, t, daytime))
+                elif not np.isnan(t) and not t <= records[-1][3]:
+                    records[-1] = records[-1][:3] + (t,) + records[-1][4:]
+            if len(on):
+                header['open'] = bool(on[-1])
+            header['rows'] += len(parsed)
+            header['end'] = offset + len(complete)
+
+    index.records = np.array(records, dtype = record_dtype)
+    header['count'] = len(records)
+    try:
+        _write(filename, index, rewrite)
+    except (IOError, OSError) as e:
+        log_message("Could not write the event index {} ({})".format(filename, e))
+    return index
+
+def _float(fields, i):
+    try:
+        return float(fields[i])
+    except (ValueError, IndexError):
+        return np.nan
+
+def _write(filename, index, first):
+    # writes the records from 'first' on, then the header
+    if not os.path.exists(filename):
+        first = 0
+        f = open(filename, 'wb')
+    else:
+        f = open(filename, 'r+b')
+    with f:
+        f.seek(headerLength + first*record_dtype.itemsize, 0)
+        f.write(index.records[first:].tobytes())
+        f.truncate()
+        f.seek(0, 0)
+        f.write(json.dumps(index.header).ljust(headerLength - 1) + '\n')
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Updates the event index of FATCAT raw files (background indexer).')
+    parser.add_argument('datafile', metavar='file', nargs='+', help='raw files to index')
+    parser.add_argument('--datalength', dest='datalength', type=int, default=None,
+                    help='also list the events for this data length in seconds')
+    args = parser.parse_args()
+
+    for datafile in args.datafile:
+        try:
+            index = update_index(datafile)
+        except Exception as e:
+            log_message("Could not index {} ({})".format(datafile, e))
+            continue
+        print "{}: {} oven-on segment(s), {} rows".format(datafile, index.header['count'], index.header['rows'])
+        if args.datalength is not None:
+            events, exact = index.events(args.datalength)
+            for r in index.records[events]:
+                print "{}\t{}\t{:.2f}\t{}".format(r['daytime'], r['row'], r['runtime'], r['offset'])
+            if not exact:
+                print "the events cannot be found from the index alone"
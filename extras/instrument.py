@@ -1,12 +1,21 @@
 import time
+from collections import deque
 import serial
 import serial.tools.list_ports
 import os, sys, configparser
+import socket
+
+from serial_broker import BrokerClient
+from port_discovery import PortDiscovery
 
 class instrument(object):
     def __init__(self, config_file):
 
         self.port = "n/a"
+        self.rxbuffer = ''      # partial line received from the instrument
+        self.rxlines = deque()  # complete lines not returned yet
+        self.max_line = 4096    # longer partial lines are discarded (no line break)
+        self.broker = None      # serial_broker.BrokerClient if the logger holds the port
 
         # Read the name of the serial port
         if os.path.exists(config_file):
@@ -18,10 +27,17 @@ class instrument(object):
             self.serial_stopbits = eval(config['SERIAL_SETTINGS']['SERIAL_STOPBITS'])
             self.serial_bytesize = eval(config['SERIAL_SETTINGS']['SERIAL_BYTESIZE'])
             self.serial_timeout = eval(config['SERIAL_SETTINGS']['SERIAL_TIMEOUT'])
+            if config.has_option('SERIAL_SETTINGS', 'BROKER_SOCKET'):
+                self.broker_path = eval(config['SERIAL_SETTINGS']['BROKER_SOCKET'])
+            else:
+                self.broker_path = '/tmp/fatcat-serial.sock'
         else:
             self.log_message("INSTRUMENT", "Could not find the configuration file: " + config_file)
             exit()
 
+        self.discovery = PortDiscovery(self.serial_port_description)
+        self.open_retry = 2 # seconds between the attempts to open a port that does not answer
+
         self.stop_str  = 'X0000'
         self.start_str = 'X1000'
         self.queries = [
@@ -41,65 +57,100 @@ class instrument(object):
 #            "X?", # Response:"Control DATASTREAM: <ON> = X1000 or <OFF> = X0000 \r\n"
             "Z?"  # Response:"STATUSBYTE HEX = %X \r\n"
             ]
+        # beginning of the response to each query, the responses are recognised
+        # among the data lines while the datastream runs (see answers())
+        self.responses = {
+            "A?": "Duration of next burn cycle",
+            "B?": "Status OVEN=",
+            "C?": "Status PUMP=",
+            "F?": "FLOW Controller Setpoint",
+            "N?": "Serial Number=",
+            "O?": "Status LICOR=",
+            "P?": "P1=",
+            "S?": "S1=",
+            "Z?": "STATUSBYTE HEX"
+            }
+        self.query_timeout = 2 # seconds
 
     def serial_ports(self):
-        # produce a list of all serial ports. The list contains a tuple with the port number,
-        # description and hardware address
-        #
-        ports = list(serial.tools.list_ports.comports())
-
-        # return the port if self.serial_port_description is in the description
-        for port in ports:
-            if self.serial_port_description in port[2]:
-                return port[0]
-        return "n/a"
+        # returns the port of the instrument: the first port with
+        # self.serial_port_description in the description of its hardware
+        # (the path found is cached, see port_discovery), "n/a" if there is none
+        port = self.discovery.find()
+        if port is None:
+            return "n/a"
+        return port
 
     def open_port(self):
-        # searches for an available port and opens the serial connection
-        # Waits 2 seconds before trying again if no port found
-        # and doubles time each try with maximum 32 second waiting time
-        # until success or KeyboardInterrupt
-        wait = 2
-
+        # Waits until the port of the instrument is there and opens the serial
+        # connection, until success or KeyboardInterrupt. The ports are only
+        # enumerated again when a device is plugged in or removed, the port is
+        # opened within about 0.1 seconds of the instrument coming back.
         try:
-            while self.port == "n/a":
-                self.log_message("SERIAL", "no TCA found, waiting " + str(wait) + " seconds to retry...")
-                time.sleep(wait)
-                if wait < 32:
-                    wait = wait*2
-                self.port = self.serial_ports()
+            self.port = self.serial_ports()
+            if self.port == "n/a":
+                self.log_message("SERIAL", "no TCA found, waiting for it...")
+            while True:
+                self.port = self.discovery.wait()
+                try:
+                    self.ser = serial.Serial(
+                        port = self.port,
+                        baudrate = self.serial_baudrate,
+                        parity = self.serial_parity,
+                        stopbits = self.serial_stopbits,
+                        bytesize = self.serial_bytesize,
+                        timeout = self.serial_timeout
+                    )
+                    break
+                except serial.SerialException as e:
+                    # removed meanwhile, or not ready yet (e.g., permissions)
+                    self.log_message("SERIAL", "Cannot open " + str(self.port) + " (" + str(e) + ")")
+                    self.discovery.forget()
+                    self.discovery.changed(self.open_retry)
         except KeyboardInterrupt:
            self.log_message("SERIAL", "aborted by user!... bye...")
            raise
 
         self.log_message("SERIAL", "Serial port found: " + str(self.port))
 
-        self.ser = serial.Serial(
-            port = self.port,
-            baudrate = self.serial_baudrate,
-            parity = self.serial_parity,
-            stopbits = self.serial_stopbits,
-            bytesize = self.serial_bytesize,
-            timeout = self.serial_timeout
-        )
-
     def close_port(self):
         self.ser.close()
+        self.rxbuffer = ''
+        self.rxlines.clear()
+
+    def connect(self):
+        # Uses the serial broker of the logger if it runs (the logger holds the
+        # port), opens the port otherwise
+        try:
+            self.broker = BrokerClient(self.broker_path)
+        except socket.error:
+            self.broker = None
+            self.open_port()
+
+    def disconnect(self):
+        if self.broker is not None:
+            self.broker.close()
+            self.broker = None
+        else:
+            self.close_port()
 
     def send_commands(self, commands, open_port = False):
         if open_port:
-            self.open_port()
+            self.connect()
         for c in commands:
-            self.ser.write(c)
+            if self.broker is not None:
+                self.broker.command(c)
+            else:
+                self.ser.write(c)
         if open_port:
-            self.close_port()
+            self.disconnect()
 
     def stop_datastream(self):
         # This function sends the stop datastream command (X0000) and
         # waits until there is no furter answer
         self.log_message("SERIAL", "Stopping datastream.")
         self.ser.write(self.stop_str)
-        while len(self.ser.readline()):
+        while len(self.readline()):
             pass
 
     def start_datastream(self):
@@ -107,13 +158,45 @@ class instrument(object):
         self.log_message("SERIAL", "Starting datastream.")
         self.ser.write(self.start_str)
 
+    def answers(self, query, line):
+        # True if 'line' is the response to 'query'. The response to a query
+        # without entry in self.responses is the next line that is not a data
+        # line (no tab).
+        prefix = self.responses.get(query)
+        if prefix is None:
+            return '\t' not in line
+        return line.lstrip().startswith(prefix)
+
+    def is_response(self, line):
+        # True if 'line' is the response to one of the queries
+        return line.lstrip().startswith(tuple(self.responses.values()))
+
     def query_status(self, query):
         # This function sends a query to port 'ser' and returns the instrument response
+        # The datastream does not need to be stopped: the data lines read
+        # before the response are kept for the next readline()/readlines().
+        # Returns "" if there is no response within self.query_timeout seconds.
         self.log_message("SERIAL", "Sending command '" + query + "'")
+        if self.broker is not None:
+            try:
+                return self.broker.query(query) + "\r\n"
+            except IOError as e:
+                self.log_message("SERIAL", "No response to '" + query + "' ({})".format(e))
+                return ""
         self.ser.write(query)
+        skipped = []
         answer = ""
-        while not answer.endswith("\n"):
-            answer=self.ser.readline()
+        deadline = time.time() + self.query_timeout
+        while time.time() < deadline:
+            line = self.readline()
+            if line and self.answers(query, line):
+                answer = line
+                break
+            elif line:
+                skipped.append(line)
+        self.rxlines.extendleft(reversed(skipped))
+        if not answer:
+            self.log_message("SERIAL", "No response to '" + query + "'")
         return answer
 
     def set_mfc1(self, flow, open_port = False): # flow must be in dl
@@ -131,7 +214,36 @@ class instrument(object):
             self.log_message("SERIAL", "External MFC setting invalid: '" + c + "'")
 
     def readline(self):
-        return self.ser.readline()
+        # returns one line or "" if nothing arrived within the serial timeout
+        self._fill()
+        if self.rxlines:
+            return self.rxlines.popleft()
+        return ""
+
+    def readlines(self):
+        # Returns all complete lines received so far (with their line break), []
+        # if nothing arrived within the serial timeout. The bytes waiting in the
+        # input buffer are read with a single call (pyserial's readline reads one
+        # byte per call), a partial line is kept for the next call.
+        self._fill()
+        lines = list(self.rxlines)
+        self.rxlines.clear()
+        return lines
+
+    def _fill(self):
+        # reads until there is a complete line or the serial timeout expires
+        while not self.rxlines:
+            data = self.ser.read(self.ser.in_waiting or 1)
+            if not data:
+                return
+            data = self.rxbuffer + data
+            end = data.rfind('\n') + 1
+            self.rxbuffer = data[end:]
+            if len(self.rxbuffer) > self.max_line:
+                self.log_message("SERIAL", "no line break in {} bytes, discarding them".format(len(self.rxbuffer)))
+                self.rxbuffer = ''
+            if end:
+                self.rxlines.extend(l + '\n' for l in data[:end - 1].split('\n'))
 
     def log_message(self, module, msg):
         """
@@ -0,0 +1,223 @@
+import os, time, datetime
+from collections import deque
+import numpy as np
+import pandas as pd
+
+from status_byte import check_status, status_bit
+from event_engine import event_windows
+from log import log_message
+
+ppmtoug = 12.01/22.4 # factor to convert C in ppm to ug/lt at 0 degC and 1atm
+
+class LiveEvents(object):
+    # Detects and integrates the events while the logger receives the data, with
+    # the rules of extract.py (Rawfile): an event starts at the first oven-on row
+    # more than 'data_length' seconds after the previous event, the baseline is
+    # the mean co2 of the 'baseline_length' seconds before it and the tc is the
+    # trapezoidal integral of dtc over the first 'integral_length' seconds.
+    #   - the results row is appended to 'results_path'/<yyyymmdd>-live.txt as
+    #     soon as the integral is complete (max T_oven of the rows so far)
+    #   - the event file is written to 'events_path' after 'data_length' seconds
+    #     (the same file as extract.py, which overwrites it when it runs)
+    # The sampling volume of each event is integrated from the previous event on.
+    # 'columns' and 'units' are the data columns and units of extras/columns.txt
+    # (without the daytime). Every line comes with the name of its raw file.
+    keys = ["Time", "T Oven", "CO2 Cell P", "CO2", "Flowrate", "Cycle Countdown", "Ext flow"]
+    eventfileKeys = ["Time", "T Oven", "CO2 Cell P", "CO2", "Flowrate", "Cycle Countdown"]
+    keyDict = {
+        "Daytime":"time",
+        "Time":"runtime",
+        "T Oven":"toven",
+        "CO2 Cell P":"pco2",
+        "CO2":"co2",
+        "Flowrate":"flow",
+        "Cycle Countdown":"countdown"}
+
+    def __init__(self, columns, units, events_path, results_path, integral_length,
+                 data_length, baseline_length):
+        self.columns = list(columns)
+        self.unitsDict = dict(zip(["Daytime"] + self.columns, units))
+        self.index = dict((k, self.columns.index(k)) for k in self.keys)
+        self.status = self.columns.index("Status Byte")
+        self.eventDir = events_path
+        self.resultsDir = results_path
+        self.integrallength = integral_length
+        self.datalength = data_length
+        self.baselinelength = baseline_length
+        self.file = None
+        self._reset()
+        self.events = 0
+
+    def _reset(self):
+        self.history = deque() # rows for the baseline and the start of the sampling interval
+        self.event = None      # rows of the current event
+        self.lastEvent = None  # runtime of the last event
+        self.intervalStart = None
+
+    def append(self, epoch, daytime, data_string, datafile):
+        if datafile != self.file:
+            # new raw file: the event chain starts again as in extract.py
+            self._reset()
+            self.file = datafile
+            self.rows = 0 # rows of the raw file (index of the results)
+        index = self.rows
+        self.rows += 1
+        row = self._parse(epoch, daytime, data_string, index)
+        if row is None:
+            return
+        if self.history and row['Time'] < self.history[-1]['Time']:
+            log_message("runtime reset, the event detection starts again")
+            self._reset()
+        if self.intervalStart is None:
+            self.intervalStart = int(row['Time'])
+        self._accumulate(row, self.history[-1] if self.history else None)
+        self.history.append(row)
+
+        if self.event is not None:
+            self._continueEvent(row)
+        # the first row after the data of an event may start the next one
+        if self.event is None:
+            if row['oven'] and (self.lastEvent is None or row['Time'] > self.lastEvent + self.datalength):
+                self._startEvent(row)
+
+        # the baseline and the end of the sampling interval need the last seconds
+        keep = max(self.baselinelength, 2)
+        while len(self.history) > 1 and row['Time'] - self.history[0]['Time'] > keep:
+            self.history.popleft()
+
+    def _parse(self, epoch, daytime, data_string, index):
+        fields = data_string.rstrip('\r\n').split('\t')
+        try:
+            status = check_status(fields[self.status])
+        except (ValueError, IndexError):
+            return None # rows with status errors are removed by extract.py
+        codes, nbits = np.array([int(status, 16)]), np.array([4*len(status)])
+        row = {"Daytime": daytime, "epoch": epoch, "index": index,
+               "oven":  status_bit(codes, nbits, "oven")[0],
+               "valve": status_bit(codes, nbits, "valve")[0],
+               "pump":  status_bit(codes, nbits, "pump")[0]}
+        for k, i in self.index.items():
+            try:
+                row[k] = float(fields[i])
+            except (ValueError, IndexError):
+                row[k] = np.nan
+        if np.isnan(row['Time']):
+            return None
+        # sampling flows as in Rawfile._samplingFlows
+        row['sflow'] = 0 if row['valve'] else row['Ext flow'] + row['Flowrate']
+        row['sco2'] = row['sflow']*row['CO2'] if row['pump'] else 0
+        return row
+
+    def _accumulate(self, row, prev):
+        # running trapezoids of the sampling flows since the start of the interval
+        if row['Time'] < self.intervalStart:
+            row['volume'] = None
+        elif prev is None or prev['volume'] is None:
+            row['volume'], row['co2int'] = 0., 0.
+        else:
+            dt = row['Time'] - prev['Time']
+            row['volume'] = prev['volume'] + dt*(row['sflow'] + prev['sflow'])/2.0
+            row['co2int'] = prev['co2int'] + dt*(row['sco2'] + prev['sco2'])/2.0
+
+    def _startEvent(self, row):
+        t = row['Time']
+        # sampling interval: previous event (or first row) <= runtime < int(t)
+        volume, co2int = 0., 0.
+        for r in self.history:
+            if r['Time'] < int(t) and r['volume'] is not None:
+                volume, co2int = r['volume'], r['co2int']
+        # the next interval starts at int(t)
+        self.intervalStart = int(t)
+        prev = None
+        for r in self.history:
+            self._accumulate(r, prev)
+            prev = r
+
+        sample = volume/60/1000
+        if sample > 0:
+            sample_co2 = co2int/60/1000/sample
+        else:
+            sample_co2 = 0
+        rows = list(self.history)
+        self.event = {"rows": rows, "i0": len(rows) - 1, "runtime": t, "tc": None,
+                      "sample": sample, "sample co2": sample_co2}
+        co2 = np.array([r['CO2'] for r in rows[:-1] if t - r['Time'] <= self.baselinelength])
+        co2 = co2[~np.isnan(co2)]
+        self.event['baseline'] = round(np.mean(co2), 2) if len(co2) else np.nan
+        self.lastEvent = t
+        log_message("event found at {} (runtime {})".format(row['Daytime'], t))
+
+    def _windows(self):
+        rows = self.event['rows']
+        runtime = np.array([r['Time'] for r in rows])
+        return event_windows(runtime, [self.event['i0']], [self.event['runtime']],
+                             self.baselinelength, self.integrallength, self.datalength)
+
+    def _eventData(self, i1):
+        # co2 - baseline and dtc of the rows i0 <= i <= i1 (Rawfile._eventData)
+        rows = self.event['rows'][self.event['i0']:i1 + 1]
+        co2 = np.array([r['CO2'] for r in rows]) - self.event['baseline']
+        seconds = np.array([r['Time'] for r in rows])
+        flow = np.array([r['Flowrate'] for r in rows])
+        deltatc = co2*flow*ppmtoug
+        return rows, co2, deltatc, seconds
+
+    def _continueEvent(self, row):
+        self.event['rows'].append(row)
+        dt = row['Time'] - self.event['runtime']
+        if self.event['tc'] is None and dt > self.integrallength:
+            # first row after the integral: same rows as Rawfile.integrateEvent
+            windows = self._windows()
+            j = windows.nintegral[0]
+            rows, co2, deltatc, seconds = self._eventData(len(self.event['rows']) - 1)
+            self.event['tc'] = (np.trapz(deltatc[:j], x=seconds[:j])/60).round(3)
+            self.event['maxtoven'] = max(r['T Oven'] for r in rows)
+            self._writeResults()
+        if dt > self.datalength:
+            # first row after the event data, the last two rows are dropped
+            i1 = len(self.event['rows']) - 3
+            rows, co2, deltatc, seconds = self._eventData(i1)
+            self._saveEvent(rows, co2.round(3), deltatc.round(3))
+            self.event = None
+            self.events += 1
+
+    def _writeResults(self):
+        e = self.event
+        row = e['rows'][e['i0']]
+        filename = os.path.join(self.resultsDir, time.strftime("%Y%m%d", time.localtime(row['epoch'])) + "-live.txt")
+        new = not os.path.exists(filename)
+        with open(filename, 'a') as f:
+            if new:
+                f.write("datafile: {}\n".format(self.file))
+                f.write('event time\tindex\truntime\tco2 base\tmax T_oven\ttc\tsample\tsample co2\n')
+                f.write('hh:mm:ss\t-\tseconds\tppm\tdegC\tug-C\tm^3\tppm\n')
+            line = '{0}\t{1:.0f}\t{2:.2f}\t{3:.2f}\t{4:.0f}\t{5:.3f}\t{6:.5f}'.format(
+                row['Daytime'], row['index'], e['runtime'], e['baseline'], e['maxtoven'], e['tc'], e['sample'])
+            if e['sample co2'] > 0:
+                line += '\t{:.1f}'.format(e['sample co2'])
+            else:
+                line += '\t-'
+            f.write(line + '\n')
+        log_message("event at {}: tc = {:.3f} ug-C".format(row['Daytime'], e['tc']))
+
+    def _saveEvent(self, rows, co2, deltatc):
+        e = self.event
+        daytime = rows[0]['Daytime']
+        date = datetime.date.fromtimestamp(rows[0]['epoch']).strftime("%Y-%m-%d")
+        filename = date + "-" + daytime[0:2] + daytime[3:5] + "-eventdata.csv"
+        colNames = [self.keyDict[k] for k in ["Daytime"] + self.eventfileKeys] + ['co2-event', 'dtc']
+        units = [self.unitsDict[k] for k in ["Daytime"] + self.eventfileKeys] + ['ppm', 'ug/min']
+        valuesDf = pd.DataFrame(dict([("Daytime", [r['Daytime'] for r in rows])] +
+                                     [(k, [r[k] for r in rows]) for k in self.eventfileKeys] +
+                                     [("co2-event", co2), ("dtc", deltatc)]),
+                                columns = ["Daytime"] + self.eventfileKeys + ["co2-event", "dtc"])
+
+        header = "{}\nsource: {}\n".format(filename, self.file)
+        if e['sample'] > 0:
+            header += "volume: {:.5f} m^3\n".format(e['sample'])
+            if e['sample co2'] > 0:
+                header += "sample_co2: {:.1f} ppm (average)\n".format(e['sample co2'])
+        header += ",".join(colNames) + "\n" + ",".join(units) + "\n"
+        with open(self.eventDir + filename, "w") as fw:
+            fw.write(header)
+            valuesDf.to_csv(fw, index=False, header=False)
@@ -0,0 +1,165 @@
+import os, time
+import struct, mmap
+
+from log import log_message
+
+# Crash journal of a BufferedAppender. The write buffer is a memory mapped
+# file: the bytes not yet written to the data file are kept by the kernel when
+# the process is killed and recover() appends them at the next start. Layout:
+#   header  'journalHeader' bytes: magic, pending bytes, size of the data file
+#           when the buffer was started and the name of the data file
+#   buffer  the pending bytes ('size_budget' bytes are preallocated)
+# The pages of a journal on the SD card are written back to it by the kernel
+# every few seconds, as many writes as the data itself. A journal in /dev/shm
+# (tmpfs, the default of logger.py) spares these writes, but only survives a
+# crash of the logger: a power failure loses the buffer (up to 'size_budget'
+# bytes or 'time_budget' seconds of data).
+journalHeader = 4096
+magic = 'FATCATJ1'
+headerFormat = '<8sQQH' # magic, pending bytes, file size, length of the name
+fsyncPolicies = ('never', 'flush', 'close')
+
+def _read_journal(journal):
+    with open(journal, 'rb') as f:
+        head = f.read(journalHeader)
+        if len(head) < journalHeader:
+            return None, 0, 0, ''
+        tag, used, base, length = struct.unpack_from(headerFormat, head)
+        if tag != magic:
+            return None, 0, 0, ''
+        start = struct.calcsize(headerFormat)
+        return head[start:start + length], used, base, f.read(used)
+
+def recover(journal):
+    # Appends the bytes left in 'journal' by an interrupted logger to their data
+    # file. Returns the name of the file and the number of bytes recovered.
+    if not os.path.exists(journal):
+        return None, 0
+    filename, used, base, data = _read_journal(journal)
+    if not filename or not used:
+        return None, 0
+    if len(data) < used or not os.path.exists(filename):
+        log_message("cannot recover {} bytes of {} from the journal {}".format(used, filename, journal))
+        return None, 0
+    # part of the buffer may have been written before the interruption
+    done = min(max(os.path.getsize(filename) - base, 0), used)
+    with open(filename, 'ab') as f:
+        f.write(data[done:])
+    with open(journal, 'r+b') as f:
+        f.write(struct.pack(headerFormat, magic, 0, 0, 0))
+    log_message("recovered {} bytes of {} from the journal {}".format(used - done, filename, journal))
+    return filename, used - done
+
+class BufferedAppender(object):
+    # Appends data to a file through a preallocated buffer of 'size_budget' bytes
+    # (the crash journal, see above). The buffer is written with a single write
+    # call when it is full (by the next write() or poll()) and 'time_budget'
+    # seconds after its first byte (see poll()). The file stays open between the writes. 'fsync' is one of:
+    #   never   the kernel writes the data to the card when it wants
+    #   flush   fsync after every write of the buffer
+    #   close   fsync when the file is closed (e.g., at midnight)
+    # The journal left by a previous run is recovered when the appender starts.
+    def __init__(self, journal, size_budget = 64*1024, time_budget = 60, fsync = 'close',
+                 clock = time.time):
+        if fsync not in fsyncPolicies:
+            raise ValueError("unknown fsync policy: {}".format(fsync))
+        self.journal = journal
+        self.size_budget = size_budget
+        self.time_budget = time_budget
+        self.fsync = fsync
+        self.clock = clock
+        self.filename = ''
+        self.fd = None
+        self.base = 0   # size of the file when the buffer was started
+        self.used = 0   # bytes in the buffer
+        self.deadline = None
+        self.writes = 0 # write calls to the file
+        self.fsyncs = 0
+        self.bytes = 0  # bytes written to the file
+
+        recover(journal)
+        fd = os.open(journal, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, journalHeader + size_budget)
+            self.map = mmap.mmap(fd, journalHeader + size_budget)
+        finally:
+            os.close(fd)
+        self._header()
+
+    def _header(self):
+        self.map[:journalHeader] = struct.pack(headerFormat, magic, self.used, self.base,
+                                               len(self.filename)).ljust(journalHeader, '\0')
+        start = struct.calcsize(headerFormat)
+        self.map[start:start + len(self.filename)] = self.filename
+
+    def open(self, filename):
+        # appends to 'filename' from now on
+        self.close()
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.filename = filename
+        self.base = os.fstat(self.fd).st_size
+        self._header()
+
+    def write(self, data):
+        n = len(data)
+        if self.used + n > self.size_budget:
+            self.flush()
+        if n > self.size_budget:
+            # does not fit in the buffer
+            self._write(data)
+            self.base += n
+            self._header()
+            return
+        if not self.used:
+            self.deadline = self.clock() + self.time_budget
+        start = journalHeader + self.used
+        self.map[start:start + n] = data
+        # the data is in the journal before it is counted
+        self.used += n
+        struct.pack_into('<Q', self.map, 8, self.used)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = os.write(self.fd, view)
+            self.writes += 1
+            self.bytes += n
+            view = view[n:]
+
+    def poll(self):
+        # writes the buffer when it is full or the time budget is over
+        if self.used >= self.size_budget or (self.deadline is not None and self.clock() >= self.deadline):
+            self.flush()
+
+    def flush(self):
+        # A failed write (IOError, OSError) leaves the buffer as it is and the
+        # next flush goes on where it stopped, as recover() does. write() only
+        # does I/O before it changes the buffer, thus it can be called again
+        # with the same data after an error.
+        if self.used:
+            done = min(max(os.fstat(self.fd).st_size - self.base, 0), self.used)
+            self._write(self.map[journalHeader + done:journalHeader + self.used])
+            if self.fsync == 'flush':
+                os.fsync(self.fd)
+                self.fsyncs += 1
+            self.base += self.used
+            self.used = 0
+            self._header()
+        self.deadline = None
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        if self.fsync == 'close':
+            os.fsync(self.fd)
+            self.fsyncs += 1
+        os.close(self.fd)
+        self.fd = None
+        self.filename = ''
+        self.base = 0
+        self._header()
+
+    def stats(self):
+        return {"writes": self.writes, "fsyncs": self.fsyncs, "bytes": self.bytes,
+                "pending": self.used}
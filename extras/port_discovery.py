@@ -0,0 +1,78 @@
+import os, time
+import serial.tools.list_ports
+
+class PortDiscovery(object):
+    # Finds the serial port whose hardware description contains 'description'.
+    # The path found is cached: find() only checks that it still exists and
+    # enumerates the ports (comports(), slow on the Raspberry Pi) when it does
+    # not. wait() blocks until the device is plugged in: it watches the
+    # directories 'watch' (the mtime of /dev changes when udev creates or
+    # removes a device node, checked every 'interval' seconds with a stat
+    # call) and only enumerates again when one of them changed, or every
+    # 'rescan' seconds. sysfs directories are not watched, their mtime does
+    # not change on hot-plug. Without udev notifications (pyudev or inotify
+    # are not used), the periodic rescan is the fallback for the devices the
+    # stat misses.
+    def __init__(self, description, watch = ('/dev',), interval = 0.05, rescan = 5):
+        self.description = description
+        self.watch = [d for d in watch if os.path.isdir(d)]
+        self.interval = interval
+        self.rescan = rescan
+        self.port = None  # cached path of the device
+        self.scans = 0    # enumerations of the ports
+
+    def scan(self):
+        # path of the device from the list of all ports, None if not found
+        self.scans += 1
+        for port in serial.tools.list_ports.comports():
+            if self.description in port[2]:
+                return port[0]
+        return None
+
+    def find(self):
+        # cached path if it still exists, enumerates the ports otherwise
+        if self.port is None or not os.path.exists(self.port):
+            self.port = self.scan()
+        return self.port
+
+    def forget(self):
+        # the cached path is not the device any more (e.g., open failed)
+        self.port = None
+
+    def _stamp(self):
+        stamp = []
+        for d in self.watch:
+            try:
+                stamp.append(os.stat(d).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def changed(self, timeout, stamp = None):
+        # waits up to 'timeout' seconds for a change in the watched directories
+        # (since 'stamp', a former _stamp()), returns True if there was one
+        if stamp is None:
+            stamp = self._stamp()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(self.interval)
+            if self._stamp() != stamp:
+                return True
+        return False
+
+    def wait(self, timeout = None):
+        # path of the device, waits until it is plugged in (None after
+        # 'timeout' seconds)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            # a device plugged in during the enumeration changes the stamp
+            stamp = self._stamp()
+            port = self.find()
+            if port is not None:
+                return port
+            wait = self.rescan
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return None
+            self.changed(wait, stamp)
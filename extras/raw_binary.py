@@ -0,0 +1,100 @@
+import os, json, struct
+import numpy as np
+
+from status_byte import check_status
+
+# Binary copy of a raw data file written by logger.py next to the text file.
+# After a text header of 'headerLength' bytes (json with the format and the
+# column names, padded with spaces) every data line is a fixed size record:
+#   epoch          float64, time.time() when the line was received
+#   <columns>      float64, numeric columns of extras/columns.txt (NaN if missing)
+#   status         uint8, value of the status byte
+#   status_digits  uint8, hex digits of the status byte (0 if not valid). The
+#                  bits are read MSB first as in status_byte.status_bit, thus
+#                  "F" and "0F" are different states.
+# The records can be mapped with np.memmap without parsing (see open_binary).
+headerLength = 4096
+version = 1
+extension = '.bin'
+
+def binary_name(datafile):
+    # name of the binary file of the raw file 'datafile'
+    return os.path.splitext(datafile)[0] + extension
+
+def data_columns(header):
+    # columns of the data lines (without the daytime added by the logger)
+    # from the first line of the header file (extras/columns.txt)
+    return header.split('\n')[0].rstrip('\r').split('\t')[1:]
+
+def record_dtype(columns):
+    # numpy dtype of the records for the data columns 'columns'
+    fields = [('epoch', 'f8')]
+    fields += [(c, 'f8') for c in columns if c != 'Status Byte']
+    fields += [('status', 'u1'), ('status_digits', 'u1')]
+    return np.dtype(fields)
+
+class BinaryWriter(object):
+    # Appends the data lines received by the logger to a binary file. The records
+    # are handed to 'out' (persistence.BufferedAppender) as they arrive.
+    def __init__(self, filename, columns, out):
+        self.filename = filename
+        self.columns = list(columns)
+        self.dtype = record_dtype(self.columns)
+        self.status = self.columns.index('Status Byte') if 'Status Byte' in self.columns else None
+        self.numeric = [i for i, c in enumerate(self.columns) if i != self.status]
+        # same layout as self.dtype (numpy does not align the fields)
+        self.packer = struct.Struct('<' + 'd'*(len(self.numeric) + 1) + 'BB')
+        self.out = out
+        if not os.path.exists(filename):
+            header = json.dumps({"format": "FATCAT binary", "version": version,
+                                 "columns": self.columns})
+            with open(filename, 'wb') as f:
+                f.write(header.ljust(headerLength - 1) + '\n')
+        else:
+            with open(self.filename, 'r+b') as f:
+                self._truncate(f)
+        out.open(filename)
+
+    def _truncate(self, f):
+        # a partial record of an interrupted write is overwritten
+        f.seek(0, 2)
+        size = f.tell()
+        complete = headerLength + (size - headerLength)//self.dtype.itemsize*self.dtype.itemsize
+        if size != complete:
+            f.truncate(complete)
+            f.seek(complete)
+
+    def append(self, epoch, data_string):
+        fields = data_string.rstrip('\r\n').split('\t')
+        fields += [''] * (len(self.columns) - len(fields))
+        record = [epoch]
+        for i in self.numeric:
+            try:
+                record.append(float(fields[i]))
+            except ValueError:
+                record.append(np.nan)
+        code, digits = 0, 0
+        if self.status is not None:
+            try:
+                code = int(check_status(fields[self.status].strip()), 16)
+                digits = len(fields[self.status].strip())
+            except ValueError:
+                pass
+            if code > 0xFF:
+                code, digits = 0, 0
+        record += [code, digits]
+        self.out.write(self.packer.pack(*record))
+
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        return json.loads(f.read(headerLength))
+
+def open_binary(filename):
+    # Maps the complete records of a binary file. Returns a structured array
+    # (np.memmap) with the fields of record_dtype, e.g., r['CO2'] or r['epoch'].
+    header = read_header(filename)
+    dtype = record_dtype(header['columns'])
+    n = (os.path.getsize(filename) - headerLength)//dtype.itemsize
+    if n <= 0:
+        return np.zeros(0, dtype = dtype)
+    return np.memmap(filename, dtype = dtype, mode = 'r', offset = headerLength, shape = (n,))
@@ -0,0 +1,224 @@
+import os, sys, json, shutil, hashlib
+import numpy as np
+import pandas as pd
+
+from status_byte import decode_status
+from raw_lines import scan_lines, parsed_lines
+
+class RawCache(object):
+    # Cache of the parsed columns of raw files. Every raw file has a directory
+    # with a json file with the key (path, size and mtime), the number of bytes
+    # covered and the list of blocks of rows. Every block has one .npy file per
+    # column (<block>.col<i>.npy, memory mapped when loaded) and the decoded
+    # status byte (<block>.codes.npy, ...). If the
+    # logger appended data since the last load, only the new lines are parsed
+    # and written as a new block: the last blocks are merged with it while they
+    # are not larger (a row is written about log2(rows) times, a few blocks per
+    # file). The least recently used entries are removed when the cache is
+    # larger than 'max_size' bytes.
+    version = 2
+    checkLength = 4096 # bytes before the end of the cached data used to detect changes
+
+    def __init__(self, path, max_size = 500e6):
+        self.path = path
+        self.maxSize = max_size
+
+    def entry(self, datafile):
+        # directory with the cached data of 'datafile'
+        datafile = os.path.abspath(datafile)
+        return os.path.join(self.path, "{}-{}".format(os.path.basename(datafile),
+                                                      hashlib.md5(datafile).hexdigest()[:8]))
+
+    def load(self, f, data_offset, columns, parse):
+        # Returns the DataFrame with all rows of the open raw file 'f' and the
+        # decoded status byte (codes, nbits, valid), or None if the caller has to
+        # parse the file itself. 'parse(data, slow)' parses a block of data lines
+        # and tells if the slow path for corrupt lines was used (see Rawfile).
+        entry = self.entry(f.name)
+        stat = os.fstat(f.fileno())
+        meta = self._meta(entry, f, stat, data_offset, columns)
+        frames = []
+        status = []
+        if meta is not None:
+            try:
+                for block in meta['blocks']:
+                    frames.append(self._frame(entry, block, meta['keys']))
+                    status.append([np.load(os.path.join(entry, '{}.{}.npy'.format(block['name'], k)),
+                                           mmap_mode = 'r') for k in ['codes', 'nbits', 'valid']])
+            except (IOError, ValueError):
+                meta = None # a block was removed by another run
+                frames = []
+                status = []
+        if meta is not None:
+            start = meta['end']
+            slow = meta['slow']
+            os.utime(entry, None) # recently used
+        else:
+            start = data_offset
+            slow = False
+
+        f.seek(start, 0)
+        data = f.read()
+        complete = data[:data.rfind('\n') + 1]
+        tail = data[len(complete):]
+        if complete.strip():
+            df, used_slow = parse(complete, slow)
+            if used_slow and not slow and frames:
+                # a corrupt line changes how the whole file is parsed
+                f.seek(data_offset, 0)
+                complete = f.read(start + len(complete) - data_offset)
+                start = data_offset
+                meta = None
+                frames = []
+                status = []
+                df, used_slow = parse(complete, True)
+            slow = slow or used_slow
+            starts, ends = scan_lines(complete)
+            if len(df.index) != np.count_nonzero(parsed_lines(complete, starts, ends)):
+                return None # the rows can not be mapped to the lines
+            blocks = list(meta['blocks']) if meta is not None else []
+            new = [df]
+            newStatus = [decode_status(df['Status Byte'].values)]
+            # the last blocks that are not larger go into the new one
+            merged = []
+            while blocks and blocks[-1]['rows'] <= sum(len(d.index) for d in new):
+                merged.append(blocks.pop()['name'])
+                new.insert(0, frames.pop())
+                newStatus.insert(0, status.pop())
+            df = pd.concat(new, ignore_index = True) if len(new) > 1 else df
+            frames.append(df)
+            status.append([np.concatenate(s) for s in zip(*newStatus)])
+            try:
+                self._store(entry, f, stat, data_offset, columns, start + len(complete), slow,
+                            blocks, df, status[-1], merged)
+            except (IOError, OSError) as e:
+                print >>sys.stderr, "could not update the cache {}: {}".format(entry, e)
+        if not frames:
+            return None
+
+        if tail.strip():
+            # line being written by the logger (not cached)
+            df, used_slow = parse(tail, slow)
+            if used_slow and not slow:
+                return None
+            frames.append(df)
+            status.append(decode_status(df['Status Byte'].values))
+        df = pd.concat(frames, ignore_index = True) if len(frames) > 1 else frames[0]
+        codes, nbits, valid = [np.concatenate(s) for s in zip(*status)]
+        return df, (codes.astype('int64'), nbits.astype('int64'), np.asarray(valid))
+
+    def _checksum(self, f, end):
+        # checksum of the last bytes before 'end'
+        start = max(end - self.checkLength, 0)
+        f.seek(start, 0)
+        return hashlib.md5(f.read(end - start)).hexdigest()
+
+    def _meta(self, entry, f, stat, data_offset, columns):
+        # description of the cached data, None if it does not match the open file
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as fm:
+                meta = json.load(fm)
+        except (IOError, ValueError):
+            return None
+        if (meta['version'] != self.version or meta['datafile'] != os.path.abspath(f.name)
+                or meta['inode'] != stat.st_ino or meta['data_offset'] != data_offset
+                or meta['columns'] != list(columns) or meta['end'] > stat.st_size):
+            return None
+        if meta['size'] == stat.st_size and meta['mtime'] != stat.st_mtime:
+            return None # rewritten, not appended
+        if meta['checksum'] != self._checksum(f, meta['end']):
+            return None
+        return meta
+
+    def _frame(self, entry, block, keys):
+        # DataFrame with the rows of a cached block
+        data = {}
+        for i, (key, kind) in enumerate(zip(keys, block['kinds'])):
+            name = os.path.join(entry, '{}.col{}'.format(block['name'], i))
+            values = np.load(name + '.npy', mmap_mode = 'r')
+            if kind == 'text':
+                values = values.astype(object)
+                values[np.load(name + '-missing.npy')] = np.nan
+            data[key] = values
+        return pd.DataFrame(data, columns = keys)
+
+    def _saveBlock(self, path, name, df, status):
+        # writes the columns and the status of the rows of 'df', returns the
+        # description of the block
+        kinds = []
+        for i, key in enumerate(df.columns):
+            values = df[key].values
+            filename = os.path.join(path, '{}.col{}'.format(name, i))
+            if values.dtype == object:
+                # text columns as fixed length strings and the mask of missing values
+                missing = pd.isnull(values)
+                values = np.where(missing, '', values).astype(str)
+                np.save(filename + '-missing.npy', missing)
+                kinds.append('text')
+            else:
+                kinds.append('number')
+            np.save(filename + '.npy', values)
+        for k, values in zip(['codes', 'nbits', 'valid'], status):
+            values = np.asarray(values)
+            if k != 'valid':
+                # one byte per row for the status bytes of the logger
+                values = values.astype(np.min_scalar_type(values.max()) if len(values) else 'uint8')
+            np.save(os.path.join(path, '{}.{}.npy'.format(name, k)), values)
+        return {"name": name, "rows": len(df.index), "kinds": kinds}
+
+    def _store(self, entry, f, stat, data_offset, columns, end, slow, blocks, df, status, merged):
+        # writes the block of the rows of 'df' after the cached 'blocks' and the
+        # new meta.json, then removes the 'merged' blocks
+        first = sum(b['rows'] for b in blocks)
+        name = 'r{}-{}-{}'.format(first, len(df.index), os.getpid())
+        if blocks:
+            path = entry
+        else:
+            # new entry: written aside and renamed
+            path = entry + '.tmp{}'.format(os.getpid())
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+        blocks = blocks + [self._saveBlock(path, name, df, status)]
+        meta = os.path.join(path, 'meta.json.tmp{}'.format(os.getpid()))
+        with open(meta, 'w') as fm:
+            json.dump({
+                "version":     self.version,
+                "datafile":    os.path.abspath(f.name),
+                "inode":       stat.st_ino,
+                "size":        stat.st_size,
+                "mtime":       stat.st_mtime,
+                "data_offset": data_offset,
+                "columns":     list(columns),
+                "end":         end,           # bytes of the file in the cache
+                "checksum":    self._checksum(f, end),
+                "slow":        slow,          # parsed with the corrupt lines path
+                "rows":        first + len(df.index),
+                "keys":        list(df.columns),
+                "blocks":      blocks}, fm, indent = 1)
+        os.rename(meta, os.path.join(path, 'meta.json'))
+        if path != entry:
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(path, entry)
+        else:
+            for name in os.listdir(entry):
+                if name.split('.')[0] in merged:
+                    os.remove(os.path.join(entry, name))
+        self.evict()
+
+    def size(self, entry):
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+    def evict(self):
+        # removes the least recently used entries until the cache fits in 'max_size'
+        # (the '.tmp<pid>' directories of the runs writing a new entry are skipped)
+        entries = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                   if '.tmp' not in name]
+        entries = sorted((e for e in entries if os.path.isdir(e)), key = os.path.getmtime)
+        total = sum(self.size(e) for e in entries)
+        for e in entries:
+            if total <= self.maxSize:
+                break
+            total -= self.size(e)
+            shutil.rmtree(e, ignore_errors = True)
@@ -0,0 +1,54 @@
+import numpy as np
+
+# characters of a valid data line: numbers, daytime, hex status byte and nan/inf
+DATA_CHARS = '0123456789.+-eE:\t\r abcdefABCDEFnNiI'
+BAD_CHARS  = ''.join(chr(c) for c in range(256) if chr(c) not in DATA_CHARS + '\n')
+
+def scan_lines(data, offset = 0):
+    # Splits a block of raw data in lines. Returns the byte offsets of the start
+    # and of the end (the newline character) of every complete line. An
+    # unterminated last line (e.g., being written by the logger) is ignored.
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype('int64')
+    return starts + offset, ends + offset
+
+def count_chars(data, starts, ends, chars, offset = 0):
+    # number of characters of each line found in 'chars'
+    table = np.zeros(256, dtype=bool)
+    table[np.frombuffer(chars, dtype=np.uint8)] = True
+    found = np.flatnonzero(table[np.frombuffer(data, dtype=np.uint8)])
+    return np.searchsorted(found, ends - offset) - np.searchsorted(found, starts - offset)
+
+def count_tabs(data, starts, ends, offset = 0):
+    # number of tab characters of each line
+    return count_chars(data, starts, ends, '\t', offset)
+
+def parsed_lines(data, starts, ends, offset = 0):
+    # Mask of the lines that pandas turns into rows when reading a raw file:
+    # only the blank lines (spaces and '\r' at most) are skipped. Lines with
+    # too many fields are kept, the extra fields are not in 'usecols'.
+    buf = np.frombuffer(data, dtype=np.uint8)
+    blank = ends == starts
+    if len(buf):
+        first = buf[np.minimum(starts - offset, len(buf) - 1)]
+        for i in np.flatnonzero(~blank & ((first == ord(' ')) | (first == ord('\r')))):
+            blank[i] = not data[starts[i] - offset:ends[i] - offset].strip(' \r')
+    return ~blank
+
+def count_parsed_lines(f, start, end, block_size = 1 << 20):
+    # Number of rows pandas parses from the complete lines of the open file 'f'
+    # between the byte offsets 'start' and 'end'. The file is read in blocks,
+    # thus the memory use does not depend on the size of the file.
+    f.seek(start, 0)
+    rows = 0
+    rest = ''
+    while start < end:
+        data = rest + f.read(min(block_size, end - start))
+        start += len(data) - len(rest)
+        if len(data) == len(rest):
+            break # file shorter than expected
+        starts, ends = scan_lines(data)
+        rows += np.count_nonzero(parsed_lines(data, starts, ends))
+        rest = data[ends[-1] + 1:] if len(ends) else data
+    return rows
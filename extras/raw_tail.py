@@ -0,0 +1,91 @@
+import os, glob
+import time, datetime
+from StringIO import StringIO
+import numpy as np
+import pandas as pd
+
+from raw_binary import binary_name, read_header, open_binary
+
+# Last samples of the raw file being written by the logger, for the clients
+# that start while it runs (e.g., the plots of gui.py). Only the end of the
+# file is read: the binary copy if there is one, otherwise the text file
+# backwards in blocks until enough lines are found.
+
+def latest_rawfile(data_path, datafile, extension):
+    # newest raw file of the logger ('datafile' and 'extension' of the LOGGER
+    # settings) in 'data_path', None if there is none
+    files = glob.glob(os.path.join(data_path, '*-' + datafile + '*' + extension))
+    if not files:
+        return None
+    return max(files, key = os.path.getmtime)
+
+def _is_data(line):
+    # data lines begin with the daytime (hh:mm:ss) added by the logger
+    return (len(line) > 9 and line[2] == ':' and line[5] == ':' and line[8] == '\t'
+            and line[:2].isdigit())
+
+def tail_lines(filename, max_lines, since = None, block_size = 1 << 16):
+    # Last 'max_lines' data lines of the raw file 'filename' (without line
+    # break), only those received after the datetime 'since' if given. The
+    # file is read backwards, a block of 'block_size' bytes at a time.
+    with open(filename, 'rb') as f:
+        date = f.readline().strip()
+        f.seek(0, 2)
+        pos = f.tell()
+        blocks = []
+        breaks = 0
+        while pos > 0 and breaks <= max_lines:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            block = f.read(step)
+            breaks += block.count('\n')
+            blocks.append(block)
+    data = ''.join(reversed(blocks))
+    # the last line may not be complete yet, the first one may be cut
+    lines = data[:data.rfind('\n') + 1].split('\n')[:-1]
+    if pos > 0:
+        lines = lines[1:]
+    lines = [l.rstrip('\r') for l in lines if _is_data(l)][-max_lines:]
+    if since is not None and lines:
+        try:
+            day = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+        except ValueError:
+            return lines
+        if day < since.date():
+            return []
+        if day == since.date():
+            start = since.strftime('%H:%M:%S')
+            lines = [l for l in lines if l[:8] >= start]
+    return lines
+
+def lines_to_array(lines, columns):
+    # values of the data columns 'columns' (positions after the daytime) of the
+    # data lines 'lines' as an array of floats (NaN if not a number)
+    if not lines:
+        return np.zeros((0, len(columns)))
+    positions = [c + 1 for c in columns]
+    df = pd.read_csv(StringIO('\n'.join(lines)), sep = '\t', header = None,
+                     usecols = positions, names = range(max(positions) + 1), index_col = False)
+    return df[positions].apply(pd.to_numeric, errors = 'coerce').values.astype('float64')
+
+def tail_samples(filename, columns, max_samples, since = None):
+    # Last 'max_samples' samples of the raw file 'filename' (received after the
+    # datetime 'since' if given). Returns an array with the values of the data
+    # columns 'columns' (positions after the daytime) and the last data line
+    # without the daytime (None if there is no sample).
+    binfile = binary_name(filename)
+    if os.path.exists(binfile):
+        names = read_header(binfile)['columns']
+        records = open_binary(binfile)
+        records = records[max(len(records) - max_samples, 0):]
+        if since is not None and len(records):
+            records = records[records['epoch'] >= time.mktime(since.timetuple())]
+        values = np.column_stack([records[names[c]] for c in columns]) if len(records) else \
+                 np.zeros((0, len(columns)))
+        lines = tail_lines(filename, 1)
+    else:
+        lines = tail_lines(filename, max_samples, since)
+        values = lines_to_array(lines, columns)
+    last = lines[-1].split('\t', 1)[1] if lines and len(values) else None
+    return values, last
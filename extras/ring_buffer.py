@@ -0,0 +1,95 @@
+import numpy as np
+
+class MinMaxBuffer(object):
+    # Last 'size' samples of the float channels 'keys' at several resolutions
+    # for plotting long histories: level l keeps the minimum and the maximum of
+    # the blocks of factor**l samples (level 0 keeps the samples). The levels
+    # are updated on every append, envelope() returns the coarsest level that
+    # still has about one point per pixel. Every level is a ring of blocks,
+    # block number b at row b % rows, the last block fills up as the samples
+    # arrive.
+    def __init__(self, keys, size, factor = 4, min_points = 256, fill = None):
+        self.keys = list(keys)
+        self.column = dict((k, i) for i, k in enumerate(self.keys))
+        self.size = size
+        self.blocks = [] # samples per block of each level
+        self.lo = []
+        self.hi = []
+        b = 1
+        while True:
+            rows = size//b + 2
+            lo = np.zeros((rows, len(self.keys)))
+            self.blocks.append(b)
+            self.lo.append(lo)
+            self.hi.append(lo if b == 1 else np.zeros_like(lo))
+            if rows <= min_points:
+                break
+            b *= factor
+        self.count = 0 # samples appended
+        if fill is not None:
+            self.extend([fill]*size)
+
+    def append(self, sample):
+        self.extend([sample])
+
+    def extend(self, samples):
+        # appends the list of samples 'samples' (dicts with a value for each
+        # channel) to all the levels with a few array operations per level
+        if not samples:
+            return
+        self.extend_values(np.array([[s[k] for k in self.keys] for s in samples[-self.size:]],
+                                    dtype = 'float64'), len(samples))
+
+    def extend_values(self, values, n = None):
+        # appends the samples of the array 'values' (a row per sample, a column
+        # per channel), 'n' is the number of samples if 'values' only has the
+        # last ones
+        if n is None:
+            n = len(values)
+        values = values[-self.size:]
+        if not len(values):
+            return
+        first = self.count + n - len(values) # number of the first sample kept
+        for b, lo, hi in zip(self.blocks, self.lo, self.hi):
+            block = (first + np.arange(len(values)))//b
+            starts = np.flatnonzero(np.concatenate(([True], block[1:] != block[:-1])))
+            block = block[starts]
+            bmin = np.fmin.reduceat(values, starts, axis = 0)
+            bmax = np.fmax.reduceat(values, starts, axis = 0)
+            if self.count and block[0] == (self.count - 1)//b:
+                # the last block of the level goes on
+                row = block[0] % len(lo)
+                bmin[0] = np.fmin(bmin[0], lo[row])
+                bmax[0] = np.fmax(bmax[0], hi[row])
+            rows = block[-len(lo):] % len(lo)
+            lo[rows] = bmin[-len(lo):]
+            if hi is not lo:
+                hi[rows] = bmax[-len(lo):]
+        self.count += n
+
+    def envelope(self, key, points, window = None):
+        # (x, y) of the channel 'key' over the last 'window' samples (default
+        # all) with at most about 'points' points: the minimum and the maximum of
+        # every block, x is the age of the block in samples (0 for the newest
+        # sample, negative for the older ones)
+        n = min(self.count, self.size if window is None else min(window, self.size))
+        if n <= 0:
+            return np.zeros(0), np.zeros(0)
+        c = self.column[key]
+        for level, b in enumerate(self.blocks):
+            first, last = (self.count - n)//b, (self.count - 1)//b
+            if b == 1 and last - first + 1 <= points:
+                break
+            if b > 1 and 2*(last - first + 1) <= points:
+                break
+        rows = np.arange(first, last + 1) % len(self.lo[level])
+        start = np.arange(first, last + 1)*b
+        # middle of the samples of the block (the last one may not be full)
+        age = (self.count - 1) - (start + np.minimum(start + b - 1, self.count - 1))/2.
+        if b == 1:
+            return -age, self.lo[level][rows, c]
+        x = np.repeat(-age, 2)
+        y = np.empty(2*len(rows))
+        y[0::2] = self.lo[level][rows, c]
+        y[1::2] = self.hi[level][rows, c]
+        return x, y
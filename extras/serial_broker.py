@@ -0,0 +1,206 @@
+import os, json, fcntl
+import socket, select, errno
+import threading, time
+from collections import deque
+
+from log import log_message
+
+# Requests and replies between the clients and the SerialBroker are json
+# objects, one per line:
+#   {"command": "U1000"}  ->  {"ok": true}
+#   {"query": "N?"}       ->  {"ok": true, "response": "Serial Number=..."}
+# and {"ok": false, "error": "..."} if the request failed.
+
+class SerialBroker(object):
+    # Lets other processes (gui, cron commands) use the serial port held by the
+    # logger through the UNIX socket 'path'. The commands are written to the
+    # port as soon as they arrive (the logger only reads it). The datastream
+    # keeps running during the queries: the acquisition hands the lines to
+    # route() before queuing them, which picks the responses out of the data
+    # lines (device.answers()) and queues the replies: the broker thread sends
+    # them, the serial intake never waits for a client. A query without answer
+    # after 'query_timeout' seconds fails.
+    def __init__(self, path, device, query_timeout = 2):
+        self.path = path
+        self.device = device
+        self.query_timeout = query_timeout
+        self.waiting = deque() # (client, query, deadline) of the queries sent
+        self.replies = deque() # (client, reply) to be sent by the broker thread
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.queries = 0
+        self.unrequested = 0   # responses nobody waited for (not data lines)
+
+        if os.path.exists(path):
+            os.remove(path) # left by a previous run
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(5)
+        self.clients = {}
+        # wakes the loop up; non blocking, a full pipe already wakes it
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.running = True
+        self.thread = threading.Thread(target = self._loop, name = "broker")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def route(self, lines):
+        # answers the waiting queries with their responses (the oldest query a
+        # line answers gets it), returns the data lines
+        with self.lock:
+            data = []
+            answered = len(self.replies)
+            for line in lines:
+                for w in self.waiting:
+                    if self.device.answers(w[1], line):
+                        self.waiting.remove(w)
+                        self.replies.append((w[0], {"ok": True, "response": line.rstrip('\r\n')}))
+                        break
+                else:
+                    if self.device.is_response(line):
+                        self.unrequested += 1
+                    else:
+                        data.append(line)
+            answered = len(self.replies) > answered
+        if answered:
+            self._wake()
+        return data
+
+    def close(self):
+        self.running = False
+        self._wake()
+        self.thread.join(5)
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def stats(self):
+        return {"clients": len(self.clients), "commands": self.commands, "queries": self.queries,
+                "unrequested": self.unrequested}
+
+    def _reply(self, client, reply):
+        try:
+            client.sendall(json.dumps(reply) + '\n')
+        except socket.error:
+            pass # the client is removed by the loop
+
+    def _request(self, client, line):
+        try:
+            request = json.loads(line)
+            if "command" in request:
+                with self.lock:
+                    self.device.send_commands([str(request["command"])])
+                    self.commands += 1
+                self._reply(client, {"ok": True})
+            elif "query" in request:
+                query = str(request["query"])
+                with self.lock:
+                    self.device.send_commands([query])
+                    self.waiting.append((client, query, time.time() + self.query_timeout))
+                    self.queries += 1
+            else:
+                self._reply(client, {"ok": False, "error": "unknown request"})
+        except Exception as e:
+            log_message("serial broker: request {!r} failed ({})".format(line, e))
+            self._reply(client, {"ok": False, "error": str(e)})
+
+    def _loop(self):
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.listener, self.wake_r] + self.clients.keys(),
+                                               [], [], 0.1)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wake_r in readable:
+                try:
+                    os.read(self.wake_r, 4096)
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+            if self.listener in readable:
+                client, address = self.listener.accept()
+                client.settimeout(1)
+                self.clients[client] = ''
+            for client in readable:
+                if client is self.listener or client is self.wake_r:
+                    continue
+                try:
+                    data = client.recv(4096)
+                except socket.error:
+                    data = ''
+                if not data:
+                    self._remove(client)
+                    continue
+                buf = self.clients[client] + data
+                while '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    self._request(client, line)
+                self.clients[client] = buf
+            # queries without answer
+            now = time.time()
+            with self.lock:
+                while self.waiting and self.waiting[0][2] < now:
+                    client, query, deadline = self.waiting.popleft()
+                    self.replies.append((client, {"ok": False,
+                                                  "error": "no answer to {} from the instrument".format(query)}))
+                replies, self.replies = self.replies, deque()
+            # sent without the lock, route() does not wait for the clients
+            for client, reply in replies:
+                self._reply(client, reply)
+
+        for client in self.clients.keys():
+            client.close()
+        self.listener.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _remove(self, client):
+        with self.lock:
+            self.waiting = deque(w for w in self.waiting if w[0] is not client)
+            self.replies = deque(r for r in self.replies if r[0] is not client)
+        del self.clients[client]
+        client.close()
+
+class BrokerClient(object):
+    # Connection to the SerialBroker of the logger, raises socket.error if the
+    # logger does not run.
+    def __init__(self, path, timeout = 5):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except socket.error:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('r')
+
+    def _request(self, request):
+        self.sock.sendall(json.dumps(request) + '\n')
+        line = self.rfile.readline()
+        if not line:
+            raise IOError("the serial broker closed the connection")
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise IOError(reply["error"])
+        return reply
+
+    def command(self, command):
+        self._request({"command": command})
+
+    def query(self, query):
+        # returns the answer of the instrument (without line break)
+        return str(self._request({"query": query})["response"])
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
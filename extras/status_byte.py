@@ -0,0 +1,78 @@
+import string
+import numpy as np
+import pandas as pd
+
+# interpretation of bits on the "Status Byte" column (first key is the most significant bit)
+statusKeys = [
+    "valve",   # internal valve
+    "pump",    # internal pump
+    "fan",
+    "oven",    # induction furnace
+    "band",    # cat. heater
+    "licor",   # external valve
+    "res2",    # external pump
+    "res"]
+
+def hex2bin(s):
+    hex_table = ['0000', '0001', '0010', '0011',
+                 '0100', '0101', '0110', '0111',
+                 '1000', '1001', '1010', '1011',
+                 '1100', '1101', '1110', '1111']
+    bits = ''
+    for i in range(len(s)):
+        bits += hex_table[int(s[i], base=16)]
+    return bits
+
+def check_status(s):
+    # returns the status string if it is a valid hex value, raises ValueError otherwise
+    if not isinstance(s, basestring) or not s or s.strip(string.hexdigits):
+        raise ValueError("invalid status byte: {!r}".format(s))
+    return s
+
+def decode_status(values):
+    # Parses a column of hex strings in one step. Returns three arrays:
+    # the integer value, the number of bits (4 per hex digit) and a mask
+    # that is False where the value is not a valid hex string.
+    # Only the distinct values are parsed, i.e., a few hundred at most.
+    values = pd.Series(values)
+    if values.dtype != object:
+        values = values.astype(str)
+    labels, uniques = pd.factorize(values)
+
+    unique_codes = np.zeros(len(uniques) + 1, dtype='int64')
+    unique_nbits = np.zeros(len(uniques) + 1, dtype='int64')
+    unique_valid = np.zeros(len(uniques) + 1, dtype=bool) # last element for missing values
+    for i, s in enumerate(uniques):
+        try:
+            unique_codes[i] = int(check_status(s), 16)
+        except ValueError:
+            continue
+        unique_nbits[i] = 4*len(s)
+        unique_valid[i] = True
+
+    # factorize marks missing values with -1, i.e., the last element
+    return unique_codes[labels], unique_nbits[labels], unique_valid[labels]
+
+def status_bit(codes, nbits, key):
+    # boolean array with the bit 'key' of the decoded status values
+    shift = np.asarray(nbits) - 1 - statusKeys.index(key)
+    return (shift >= 0) & ((np.asarray(codes) >> np.maximum(shift, 0)) & 1 == 1)
+
+def status_flags(values, keys = statusKeys):
+    # Returns a dictionary with a boolean array for each bit in 'keys'
+    # and the mask of valid values
+    codes, nbits, valid = decode_status(values)
+    flags = {}
+    for k in keys:
+        flags[k] = status_bit(codes, nbits, k) & valid
+    return flags, valid
+
+def status_dict(s, keys = statusKeys):
+    # value (0 or 1) of each bit of a single status string
+    code = int(check_status(s), 16)
+    nbits = 4*len(s)
+    status = {}
+    for k in keys:
+        shift = nbits - 1 - statusKeys.index(k)
+        status[k] = (code >> shift) & 1 if shift >= 0 else 0
+    return status
@@ -8,8 +8,9 @@ import configparser
 
 base_path = os.path.abspath(os.path.dirname(sys.argv[0]) + '/..')
 sys.path.append(base_path)
+sys.path.append(base_path + '/extras/')
 
-from gui import send_string
+from broadcast import BroadcastServer
 
 # READ ini file
 config_file = base_path + '/config.ini'
@@ -17,14 +18,16 @@ if os.path.exists(config_file):
     config = configparser.ConfigParser()
     config.read(config_file)
     host_name = eval(config['TCP_INTERFACE']['HOST_NAME'])
+    host_port = eval(config['TCP_INTERFACE']['HOST_PORT'])
 else:
     host_name = 'localhost'
+    host_port = 10000
     print >>sys.stderr, 'Could not find the configuration file {0}'.format(config_file)
 
 
-# Connect the socket to the port where the server is listening
-server_address = (host_name, 10000)
-sock = 0
+# Publish the data as the logger does (the gui connects to this address)
+server_address = (host_name, host_port)
+server = BroadcastServer(server_address)
 
 datafile = "SampleData.txt"
 fi = open(datafile, "r")
@@ -38,9 +41,9 @@ for line in fi:
        #print >>sys.stderr, line.rstrip('\n')
        print >>sys.stderr, datastring
        # Send data
-       #sock = send_string(line, server_address, sock)
-       sock = send_string(datastring, server_address, sock)
+       server.send([datastring + '\n'])
        time.sleep(0.5)
    else:
        i += 1
 fi.close()
+server.close()
@@ -22,7 +22,8 @@ def create_status_file( path = "logs/status/", name = "fatcat_status.txt" ):
 if __name__ == "__main__":
 
     description_text = """Reads settings of fatcat device.
-        Datastreaming is stopped temporary."""
+        The datastream keeps running (the responses are picked out of the data
+        lines, through the logger if it runs)."""
 
     parser = argparse.ArgumentParser(description=description_text)
     
@@ -38,15 +39,13 @@ if __name__ == "__main__":
         exit()
 
     device = instrument(config_file = config_file)
-    device.open_port()
-    device.stop_datastream()
+    device.connect()
     fatcat_status = ""
 
     for q in device.queries:
         fatcat_status += device.query_status(q)
 
-    device.start_datastream()
-    device.close_port()
+    device.disconnect()
 
     print >>sys.stderr, fatcat_status
 
@@ -7,7 +7,8 @@
 
 from pyqtgraph.Qt import QtGui, QtCore
 import pyqtgraph as pg
-import socket
+import socket, select
+import threading
 import sys, os
 import ast # for datastring parsing
 import numpy as np
@@ -15,63 +16,34 @@ import configparser
 from functools import partial # function mapping
 from collections import namedtuple
 
-import pandas as pd
-
-import time
+import time, datetime
 import serial
 import serial.tools.list_ports
 
 base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
 sys.path.append(base_path + '/extras/')
 from instrument import instrument
-
-def hex2bin(s):
-    hex_table = ['0000', '0001', '0010', '0011',
-                 '0100', '0101', '0110', '0111',
-                 '1000', '1001', '1010', '1011',
-                 '1100', '1101', '1110', '1111']
-    bits = ''
-    for i in range(len(s)):
-        bits += hex_table[int(s[i], base=16)]
-    return bits
+from status_byte import hex2bin, check_status, status_dict, statusKeys
+from ring_buffer import MinMaxBuffer
+from broadcast import LineReader
+from acquisition import DropQueue
+from raw_tail import latest_rawfile, tail_samples
 
 ### map function for propper parameter convertion
 def apply(f,a):
     return f(a)
 
-def send_string(line, server_address, sock = 0):
-    # Sends a string to through a TCP socket
-
-    # Send data
-    try:
-        if not sock:
-            # Create a TCP/IP socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-##            print >>sys.stderr, 'Sending data to %s port %s' % server_address
-            sock.connect(server_address)
-            
-        sock.sendall(line)
-    except socket.error:
-##        print >>sys.stderr, "nobody listening"
-        sock.close()
-##        print >>sys.stderr, 'closing socket'
-        sock = 0
-
-    return sock
-
 class Visualizer(object):
-    def __init__(self, host_name='localhost', host_port=10000, config_file='config.ini'):
+    def __init__(self, host_name='localhost', host_port=10000, config_file='config.ini', history=1200, frame_rate=2,
+                 datafile=None, backfill=None):
         
-        # init socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Create a TCP/IP socket
+        # init socket (the logger publishes the data, see extras/broadcast.py)
         self.server_address = (host_name, host_port)
-        print >>sys.stderr, 'starting up on %s port %s' % self.server_address
-        self.sock.bind(self.server_address) # Bind the socket to the port
-        self.sock.listen(1) # Listen for incoming connections
-        print >>sys.stderr, 'waiting for a connection'
-        self.connection, self.client_address = self.sock.accept() # Wait for a connection
-        print >>sys.stderr, 'connection from', self.client_address
+        self.connection = None
+        self.reader = None
+        # the receiver thread connects (see receive()), the window opens without
+        # the logger
+        print >>sys.stderr, 'waiting for the logger on %s port %s' % self.server_address
 
         self.device = instrument(config_file = config_file)
 
@@ -84,7 +56,8 @@ class Visualizer(object):
         pg.setConfigOption('foreground', 'w')
 
         #init data structure
-        self.numSamples = 1200
+        self.numSamples = history # samples in the plots
+        self.frame_rate = frame_rate # plot updates per second, see update()
         self.datastring = ""
         self.deltaT = 0.5 # s, sampling time
         # set status to new application
@@ -131,7 +104,7 @@ class Visualizer(object):
             float,  # flow
             float,  # current
             int,    # countdown
-            hex2bin,# status
+            check_status,# status
             float,  # co2abs
             float,  # h2o
             float,  # h2oabs
@@ -167,22 +140,30 @@ class Visualizer(object):
             "- [raw]"   # rawh2oref
             ]
 
+        # channels in the plots
+        self.plotKeys = ['spoven', 'toven', 'spcoil', 'tcoil', 'spband', 'tband', 'tcat',
+                         'pco2', 'co2', 'flow', 'eflow']
+
         self.unitsDict = dict(zip(self.keys, self.units))
-        self.df = pd.DataFrame(columns=self.keys)
         zeroDict = dict(zip(self.keys,
                        map(partial(apply, a="0"), self.functions)
                        ))
-        self.df = self.df.append([zeroDict]*self.numSamples,ignore_index=True)
+        # min/max envelopes at several resolutions, a frame draws about one
+        # point per pixel whatever the history length (see curve())
+        self.data = MinMaxBuffer(self.plotKeys, self.numSamples, fill=zeroDict)
+        # (line, sample) parsed by the receive thread, not plotted yet
+        self.samples = DropQueue("gui", self.numSamples, policy='drop-oldest')
+        self.lastSample = zeroDict
+        self.styles = {} # style sheet of the labels, see setStyle()
+
+        # the plots start with the last minutes of the raw file of the logger
+        # ('backfill' minutes, the whole history if None)
+        if datafile is not None and backfill != 0:
+            if backfill is None:
+                backfill = self.numSamples*self.deltaT/60.
+            self.backfill(datafile, backfill)
             
-        self.statusKeys = [
-            "valve",
-            "pump",
-            "fan",
-            "oven",
-            "band",
-            "licor",
-            "res2",
-            "res"]
+        self.statusKeys = statusKeys[:]
         
 #        self.statusData = namedtuple("statusData", self.statusKeys)
 #        self.statusVarsData = self.statusData._make(np.zeros((np.shape(self.statusKeys)[0],self.numSamples)))
@@ -194,7 +175,6 @@ class Visualizer(object):
 
         # setup plots
         self.pen = pg.mkPen('y', width=1)
-        self.t = np.linspace(-self.deltaT*self.numSamples, 0, self.numSamples)
 
         self.Tcurves = dict()
 
@@ -205,13 +185,13 @@ class Visualizer(object):
         self.Tplot.setLabel('left', "Temperature", units='°C')
         self.Tplot.setLabel('bottom', "t", units='s')
         self.Tplot.showGrid(False, True)
-        self.Tcurves[0] = self.Tplot.plot(self.t, self.df['spoven'], pen=pg.mkPen('y', width=1, style=QtCore.Qt.DashLine))
-        self.Tcurves[1] = self.Tplot.plot(self.t, self.df['toven'], pen=pg.mkPen('y', width=1), name='Oven')
-        self.Tcurves[2] = self.Tplot.plot(self.t, self.df['spcoil'], pen=pg.mkPen('r', width=1, style=QtCore.Qt.DashLine))
-        self.Tcurves[3] = self.Tplot.plot(self.t, self.df['tcoil'], pen=pg.mkPen('r', width=1), name='Coil')
-        self.Tcurves[4] = self.Tplot.plot(self.t, self.df['spband'], pen=pg.mkPen('b', width=1, style=QtCore.Qt.DashLine))
-        self.Tcurves[5] = self.Tplot.plot(self.t, self.df['tband'], pen=pg.mkPen('b', width=1), name='Band')
-        self.Tcurves[6] = self.Tplot.plot(self.t, self.df['tcat'], pen=pg.mkPen('g', width=1), name='Cat')
+        self.Tcurves[0] = self.Tplot.plot(*self.curve('spoven'), connect='finite', pen=pg.mkPen('y', width=1, style=QtCore.Qt.DashLine))
+        self.Tcurves[1] = self.Tplot.plot(*self.curve('toven'), connect='finite', pen=pg.mkPen('y', width=1), name='Oven')
+        self.Tcurves[2] = self.Tplot.plot(*self.curve('spcoil'), connect='finite', pen=pg.mkPen('r', width=1, style=QtCore.Qt.DashLine))
+        self.Tcurves[3] = self.Tplot.plot(*self.curve('tcoil'), connect='finite', pen=pg.mkPen('r', width=1), name='Coil')
+        self.Tcurves[4] = self.Tplot.plot(*self.curve('spband'), connect='finite', pen=pg.mkPen('b', width=1, style=QtCore.Qt.DashLine))
+        self.Tcurves[5] = self.Tplot.plot(*self.curve('tband'), connect='finite', pen=pg.mkPen('b', width=1), name='Band')
+        self.Tcurves[6] = self.Tplot.plot(*self.curve('tcat'), connect='finite', pen=pg.mkPen('g', width=1), name='Cat')
 #        self.win.nextRow()
 
         self.Pcurves = dict()
@@ -222,7 +202,7 @@ class Visualizer(object):
         self.Pplot.setLabel('left', "CO2 Press.", units='kPa')
         self.Pplot.setLabel('bottom', "t", units='s')
         self.Pplot.showGrid(False, True)
-        self.Pcurves[0] = self.Pplot.plot(self.t, self.df['pco2'], pen=pg.mkPen('y', width=1))
+        self.Pcurves[0] = self.Pplot.plot(*self.curve('pco2'), connect='finite', pen=pg.mkPen('y', width=1))
 #        self.win.nextRow()
 
         self.Ccurves = dict()
@@ -233,7 +213,7 @@ class Visualizer(object):
         self.Cplot.setLabel('left', "CO2", units='ppm')
         self.Cplot.setLabel('bottom', "t", units='s')
         self.Cplot.showGrid(False, True)
-        self.Ccurves[0] = self.Cplot.plot(self.t, self.df['co2'], pen=pg.mkPen('y', width=1))
+        self.Ccurves[0] = self.Cplot.plot(*self.curve('co2'), connect='finite', pen=pg.mkPen('y', width=1))
 #        self.win.nextRow()
 
         self.Fcurves = dict()
@@ -245,8 +225,8 @@ class Visualizer(object):
         self.Fplot.setLabel('left', "Flow", units='lpm')
         self.Fplot.setLabel('bottom', "t", units='s')
         self.Fplot.showGrid(False, True)
-        self.Fcurves[0] = self.Fplot.plot(self.t, self.df['flow'], pen=pg.mkPen('y', width=1), name='Intern')
-        self.Fcurves[1] = self.Fplot.plot(self.t, self.df['flow'], pen=pg.mkPen('r', width=1), name='Extern')
+        self.Fcurves[0] = self.Fplot.plot(*self.curve('flow'), connect='finite', pen=pg.mkPen('y', width=1), name='Intern')
+        self.Fcurves[1] = self.Fplot.plot(*self.curve('flow'), connect='finite', pen=pg.mkPen('r', width=1), name='Extern')
 #        self.win.nextRow()
 
 #####################################################################
@@ -406,33 +386,115 @@ class Visualizer(object):
         self.widgets.setLayout(self.centralLayout)
         self.widgets.show()
 
-    def update(self):
+        # the network and the parsing run in their own thread, the ui thread
+        # only plots (see update())
+        self.running = True
+        self.receiver = threading.Thread(target=self.receive, name="receive")
+        self.receiver.daemon = True
+        self.receiver.start()
+
+    def connect(self):
+        # connects to the logger, returns False if it is not running
+        try:
+            self.connection = socket.create_connection(self.server_address, timeout = 2)
+        except socket.error:
+            self.connection = None
+            return False
+        # non blocking, receive() waits for the data with select
+        self.reader = LineReader(self.connection)
+        print >>sys.stderr, 'connected to', self.server_address
+        return True
+
+    def backfill(self, datafile, minutes):
+        # adds the samples of the last 'minutes' minutes of the raw file
+        # 'datafile' to the plots, reading only the end of the file (see
+        # extras/raw_tail.py)
+        t0 = time.time()
+        since = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
+        samples = min(int(minutes*60/self.deltaT), self.numSamples)
+        columns = [self.keys.index(k) for k in self.plotKeys]
+        try:
+            values, last = tail_samples(datafile, columns, samples, since)
+        except Exception as e:
+            print >>sys.stderr, 'could not read the history of', datafile, '(' + str(e) + ')'
+            return
+        self.data.extend_values(values)
+        if len(values):
+            # break in the curves between the history and the first live
+            # sample (a NaN sample, see connect='finite' of the plots)
+            self.data.extend_values(np.full((1, len(self.plotKeys)), np.nan))
+        if last is not None:
+            # last values for the samples with missing values
+            self.parse(last)
+        print >>sys.stderr, '{} samples of {} in {:.2f} s'.format(len(values), datafile, time.time() - t0)
+
+    def receive(self):
+        # worker thread: connects to the logger, reads and parses its lines, the
+        # lines and their samples wait in self.samples for the next frame
+        while self.running:
+            if self.connection is None and not self.connect():
+                time.sleep(2)
+                continue
+            try:
+                select.select([self.connection], [], [], 0.5)
+                lines = self.reader.read()
+                if self.reader.closed:
+                    # logger stopped, try again
+                    self.connection.close()
+                    self.connection = None
+                for line in lines:
+                    sample = self.parse(line)
+                    if sample is not None:
+                        # the line goes with its sample, update() takes both
+                        self.samples.put((line, sample))
+            except socket.error as e:
+                print >>sys.stderr, e
+                self.connection.close()
+                self.connection = None
+            except Exception as e:
+                print >>sys.stderr, e
+
+    def parse(self, line):
+        # sample of the data line 'line', None for an empty line
+
+        ####### syntax changed for the status byte... ignore
+        ####### additional variables at the end
+
+        ###### ring buffer version (a value that cannot be read keeps the last one)
+        values = line.split( )
+        if not values:
+            return None
+        newData = dict(self.lastSample)
+        for k, f, v in zip(self.keys, self.functions, values):
+            try:
+                newData[k] = f(v)
+            except:
+                print "could not apply funtion " + str(f) + " to " + str(v)
+        self.lastSample = newData
+        return newData
+
+    def curve(self, key, plot=None):
+        # x (s) and y of the channel 'key', about one point per pixel of 'plot'
+        points = plot.width() if plot is not None else 800
+        x, y = self.data.envelope(key, max(points, 100))
+        return x*self.deltaT, y
+
+    def setStyle(self, label, style):
+        # only sets the style sheets that changed (restyling is slow)
+        if self.styles.get(label) != style:
+            self.styles[label] = style
+            label.setStyleSheet(style)
 
+    def update(self):
+        # draws a frame with the samples received since the last one (called
+        # 'frame_rate' times per second by the timer of the ui thread)
         try: 
-            self.datastring = self.connection.recv(1024)
+            received = self.samples.get_all()
+            if received:
+                self.datastring, newData = received[-1]
+                self.data.extend([sample for line, sample in received])
 
-            if self.datastring:
-                ####### syntax changed for the status byte... ignore
-                ####### additional variables at the end
-                
-                ###### DATAFRAME version
-                #Eliminate first element
-                self.df = self.df[1:self.numSamples]
-                values = self.datastring.split( )
-                newData = self.df.iloc[[-1]].to_dict('records')[0]
-                for k, f, v in zip(self.keys, self.functions, values):
-                    try:
-                        newData[k] = f(v)
-                    except:
-                        print "could not apply funtion " + str(f) + " to " + str(v)
-
-                self.df = self.df.append([newData],ignore_index=True)
-
-                statusbyte = newData['status']
-                j = 0
-                for k in self.statusKeys:
-                    self.statusDict[k] = int(statusbyte[j])
-                    j += 1
+                self.statusDict = status_dict(newData['status'], self.statusKeys)
                 
 ##                i = 0
 ##                self.datavector = []
@@ -464,20 +526,20 @@ class Visualizer(object):
 ##                    self.streamVarsData = self.streamVarsData._replace(**{k:self.tempArray})
 ##                    i += 1
 ####                print >>sys.stderr, self.streamVarsData.runtime
-                self.Tcurves[0].setData(self.t, self.df['spoven'])
-                self.Tcurves[1].setData(self.t, self.df['toven'])
-                self.Tcurves[2].setData(self.t, self.df['spcoil'])
-                self.Tcurves[3].setData(self.t, self.df['tcoil'])
-                self.Tcurves[4].setData(self.t, self.df['spband'])
-                self.Tcurves[5].setData(self.t, self.df['tband'])
-                self.Tcurves[6].setData(self.t, self.df['tcat'])
+                self.Tcurves[0].setData(*self.curve('spoven', self.Tplot))
+                self.Tcurves[1].setData(*self.curve('toven', self.Tplot))
+                self.Tcurves[2].setData(*self.curve('spcoil', self.Tplot))
+                self.Tcurves[3].setData(*self.curve('tcoil', self.Tplot))
+                self.Tcurves[4].setData(*self.curve('spband', self.Tplot))
+                self.Tcurves[5].setData(*self.curve('tband', self.Tplot))
+                self.Tcurves[6].setData(*self.curve('tcat', self.Tplot))
 
-                self.Pcurves[0].setData(self.t, self.df['pco2'])
+                self.Pcurves[0].setData(*self.curve('pco2', self.Pplot))
 
-                self.Ccurves[0].setData(self.t, self.df['co2'])
+                self.Ccurves[0].setData(*self.curve('co2', self.Cplot))
 
-                self.Fcurves[0].setData(self.t, self.df['flow'])
-                self.Fcurves[1].setData(self.t, self.df['eflow'])
+                self.Fcurves[0].setData(*self.curve('flow', self.Fplot))
+                self.Fcurves[1].setData(*self.curve('eflow', self.Fplot))
                 
 ####################################################################
 
@@ -497,79 +559,79 @@ class Visualizer(object):
                     self.spMFC2.setValue(int(newData['eflow']*10))
 
                 if (newData['countdown'] % 2 == 0):
-                    self.lblCD.setStyleSheet('color: black')
+                    self.setStyle(self.lblCD, 'color: black')
                 else:
-                    self.lblCD.setStyleSheet('color: red')
+                    self.setStyle(self.lblCD, 'color: red')
                 
                 if self.statusDict['oven']:
-                    self.lblOven.setStyleSheet('color: green')
+                    self.setStyle(self.lblOven, 'color: green')
                 else:
-                    self.lblOven.setStyleSheet('color: red')
+                    self.setStyle(self.lblOven, 'color: red')
 
                 if self.statusDict['band']:
-                    self.lblBand.setStyleSheet('color: green')
+                    self.setStyle(self.lblBand, 'color: green')
                 else:
-                    self.lblBand.setStyleSheet('color: red')
+                    self.setStyle(self.lblBand, 'color: red')
 
                 if self.statusDict['fan']:
-                    self.lblFan.setStyleSheet('color: green')
+                    self.setStyle(self.lblFan, 'color: green')
                 else:
-                    self.lblFan.setStyleSheet('color: red')
+                    self.setStyle(self.lblFan, 'color: red')
 
                 if self.statusDict['pump']:
-                    self.lblPump.setStyleSheet('color: green')
+                    self.setStyle(self.lblPump, 'color: green')
                 else:
-                    self.lblPump.setStyleSheet('color: red')
+                    self.setStyle(self.lblPump, 'color: red')
 
                 if self.statusDict['licor']:
-                    self.lblLicor.setStyleSheet('color: green')
+                    self.setStyle(self.lblLicor, 'color: green')
                 else:
-                    self.lblLicor.setStyleSheet('color: red')
+                    self.setStyle(self.lblLicor, 'color: red')
 
                 if self.statusDict['valve']:
-                    self.lblValve.setStyleSheet('color: green')
+                    self.setStyle(self.lblValve, 'color: green')
                 else:
-                    self.lblValve.setStyleSheet('color: red')
+                    self.setStyle(self.lblValve, 'color: red')
 
                 if self.statusDict['res']:
-                    self.lblRes.setStyleSheet('color: green')
+                    self.setStyle(self.lblRes, 'color: green')
                 else:
-                    self.lblRes.setStyleSheet('color: red')
+                    self.setStyle(self.lblRes, 'color: red')
 
                 if self.statusDict['res2']:
-                    self.lblRes2.setStyleSheet('color: green')
+                    self.setStyle(self.lblRes2, 'color: green')
                 else:
-                    self.lblRes2.setStyleSheet('color: red')
+                    self.setStyle(self.lblRes2, 'color: red')
 
                 if (not self.statusDict['pump'] and not self.statusDict['valve'] and
                         self.statusDict['res2'] and not self.statusDict['licor']):
-                    self.lblSample.setStyleSheet('color: green')
+                    self.setStyle(self.lblSample, 'color: green')
                 else:
-                    self.lblSample.setStyleSheet('color: red')
+                    self.setStyle(self.lblSample, 'color: red')
 
                 if (self.statusDict['pump']     and self.statusDict['valve'] and
                     not self.statusDict['res2'] and self.statusDict['licor']):
-                    self.lblZeroAir.setStyleSheet('color: green')
+                    self.setStyle(self.lblZeroAir, 'color: green')
                 else:
-                    self.lblZeroAir.setStyleSheet('color: red')
+                    self.setStyle(self.lblZeroAir, 'color: red')
 
                 if (self.statusDict['pump'] and not self.statusDict['valve'] and
                         self.statusDict['res2'] and not self.statusDict['licor']):
-                    self.lblESample.setStyleSheet('color: green')
+                    self.setStyle(self.lblESample, 'color: green')
                 else:
-                    self.lblESample.setStyleSheet('color: red')
+                    self.setStyle(self.lblESample, 'color: red')
 
                 if (self.statusDict['pump']     and self.statusDict['valve'] and
                     self.statusDict['res2'] and self.statusDict['licor']):
-                    self.lblEAnalysis.setStyleSheet('color: green')
+                    self.setStyle(self.lblEAnalysis, 'color: green')
                 else:
-                    self.lblEAnalysis.setStyleSheet('color: red')
+                    self.setStyle(self.lblEAnalysis, 'color: red')
 
                 if (not self.statusDict['pump'] and self.statusDict['valve'] and
                     not self.statusDict['res2'] and not self.statusDict['licor']):
-                    self.lblStandby.setStyleSheet('color: green')
+                    self.setStyle(self.lblStandby, 'color: green')
                 else:
-                    self.lblStandby.setStyleSheet('color: red')
+                    self.setStyle(self.lblStandby, 'color: red')
                 
         except Exception as e:
             print >>sys.stderr, e
@@ -679,16 +741,33 @@ if __name__ == '__main__':
         config.read(config_file)
         host_name = eval(config['TCP_INTERFACE']['HOST_NAME'])
         host_port = eval(config['TCP_INTERFACE']['HOST_PORT'])
+        if config.has_option('GUI', 'HISTORY'):
+            history = eval(config['GUI']['HISTORY']) # samples in the plots
+        else:
+            history = 1200
+        if config.has_option('GUI', 'BACKFILL'):
+            backfill = eval(config['GUI']['BACKFILL']) # minutes of data at startup (0: none)
+        else:
+            backfill = None
+        # raw file of the logger for the history
+        data_path = eval(config['GENERAL_SETTINGS']['DATA_PATH'])
+        datafile = latest_rawfile(data_path, eval(config['LOGGER']['DATAFILE']),
+                                  eval(config['LOGGER']['EXTENSION']))
+        if config.has_option('GUI', 'FRAME_RATE'):
+            frame_rate = eval(config['GUI']['FRAME_RATE']) # plot updates per second
+        else:
+            frame_rate = 2
     else:
         print >> sys.stderr, "Could not find the configuration file: " + config_file
         exit()
 
 
-    vis = Visualizer(host_name=host_name, host_port=host_port, config_file=config_file)
+    vis = Visualizer(host_name=host_name, host_port=host_port, config_file=config_file, history=history,
+                     frame_rate=frame_rate, datafile=datafile, backfill=backfill)
 
     timer = QtCore.QTimer()
     timer.timeout.connect(vis.update)
-    timer.start(vis.deltaT*1000)
+    timer.start(1000./vis.frame_rate)
 
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
         QtGui.QApplication.instance().exec_()
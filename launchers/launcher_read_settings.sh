@@ -0,0 +1,7 @@
+#!/bin/sh
+# launcher_read_settings.sh
+# navigate to home directory, then to this directory, then execute python script, then back home
+
+cd /FATCAT-scripts
+./fatcat_read_settings.py
+cd /
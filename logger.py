@@ -10,19 +10,26 @@ import serial.tools.list_ports
 base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
 sys.path.append(base_path + '/extras/')
 sys.path.append(base_path + '/')
-from gui import send_string
 from instrument import instrument
+from raw_binary import BinaryWriter, binary_name, data_columns
+from acquisition import Acquisition, DiskWriter
+from broadcast import BroadcastServer
+from live_events import LiveEvents
+from serial_broker import SerialBroker
 
 ## from sense_interface import sense_interface
 
-def create_data_file(path, header, name): 
+def data_file_name(path, name):
+    #This function returns the name of a new datafile
+    prefix  = time.strftime("%Y%m%d-%H%M%S-")
+    return path + prefix + name
+
+def create_data_file(newname, header): 
     #This function creates column headers for a new datafile
     fo      = open(header, "r")
     header  = fo.read()
     fo.close()
-    prefix  = time.strftime("%Y%m%d-%H%M%S-")
     date    = time.strftime("%Y-%m-%d")
-    newname = path + prefix + name
     fo      = open(newname, "w")
     fo.write(date)
     fo.write('\n')
@@ -42,22 +49,67 @@ if os.path.exists(config_file):
     server_port = eval(config['TCP_INTERFACE']['HOST_PORT'])
     
     header_file_name = eval(config['LOGGER']['HEADER'])
-    buffersize = eval(config['LOGGER']['BUFFER'])
     use_sense = eval(config['LOGGER']['SENSE'])
     basefilename = eval(config['LOGGER']['DATAFILE'])
     extension = eval(config['LOGGER']['EXTENSION'])
     use_serial_number = eval(config['LOGGER']['SN'])
+    if config.has_option('LOGGER', 'BINARY'):
+        use_binary = eval(config['LOGGER']['BINARY'])
+    else:
+        use_binary = False
+    # write buffer of the raw files (bytes and seconds) and its crash journal
+    if config.has_option('LOGGER', 'FLUSH_BYTES'):
+        flush_bytes = eval(config['LOGGER']['FLUSH_BYTES'])
+    else:
+        flush_bytes = 64*1024
+    if config.has_option('LOGGER', 'FLUSH_SECONDS'):
+        flush_seconds = eval(config['LOGGER']['FLUSH_SECONDS'])
+    else:
+        flush_seconds = 60
+    if config.has_option('LOGGER', 'FSYNC'):
+        fsync = eval(config['LOGGER']['FSYNC']) # 'never', 'flush' or 'close'
+    else:
+        fsync = 'close'
+    # the journal in /dev/shm (tmpfs) keeps the buffer when the logger is
+    # killed but not through a power failure (up to FLUSH_BYTES or
+    # FLUSH_SECONDS of data lost), a journal on the card survives both at the
+    # cost of the writeback of its pages to the card
+    if config.has_option('LOGGER', 'JOURNAL'):
+        journal = eval(config['LOGGER']['JOURNAL'])
+    else:
+        journal = '/dev/shm/fatcat-logger-journal'
+    # queues between the serial intake, the disk and the network (lines)
+    if config.has_option('LOGGER', 'DISK_QUEUE'):
+        disk_queue = eval(config['LOGGER']['DISK_QUEUE'])
+    else:
+        disk_queue = 3600
+    if config.has_option('LOGGER', 'NETWORK_QUEUE'):
+        network_queue = eval(config['LOGGER']['NETWORK_QUEUE'])
+    else:
+        network_queue = 120
+    if config.has_option('LOGGER', 'STATS_INTERVAL'):
+        stats_interval = eval(config['LOGGER']['STATS_INTERVAL']) # seconds
+    else:
+        stats_interval = 600
+    # events detected and integrated while logging
+    if config.has_option('DATA_ANALYSIS', 'LIVE_EVENTS'):
+        live_events = eval(config['DATA_ANALYSIS']['LIVE_EVENTS'])
+    else:
+        live_events = False
+    events_path = eval(config['GENERAL_SETTINGS']['EVENTS_PATH']) + '/'
+    summary_path = eval(config['DATA_ANALYSIS']['SUMMARY_PATH']) + '/'
+    data_length = eval(config['DATA_ANALYSIS']['EVENT_LENGTH'])
+    integral_length = eval(config['DATA_ANALYSIS']['INTEGRAL_LENGTH'])
+    baseline_length = eval(config['DATA_ANALYSIS']['BASELINE_LENGTH'])
 else:
     print >> sys.stderr, "Could not find the configuration file: " + config_file
     exit()
 
-# Connect the socket to the port where the server is listening
+# Address of the server publishing the data lines (gui and other clients connect to it)
 server_address = (server_name, server_port)
-sock = 0
 
 # Variables
 headerfile=base_path + "/" + header_file_name
-counter=0
 
 ##if use_sense:
 ##	sense = sense_interface()
@@ -65,8 +117,10 @@ device = instrument(config_file = config_file)
 device.open_port()
 
 # Fetch the serial number and establish filename
-device.stop_datastream()
-str = device.query_status(query='N?').strip() # get serial number
+# (the data lines read meanwhile are kept for the acquisition)
+str = ''
+while not str:
+    str = device.query_status(query='N?').strip() # get serial number
 device.log_message("LOGGER", "Answer to serial number query: '" + str + "'")
 device.start_datastream()
 for s in str.split("="):
@@ -76,74 +130,35 @@ if use_serial_number:
     basefilename = basefilename + '-SN' + serial_number 
 basefilename = basefilename + extension
 
-filedate = datetime.datetime.now()
-file = create_data_file(data_path, header=headerfile, name=basefilename)
-device.log_message("LOGGER", "Writing to Datafile: " + file)
 device.log_message("LOGGER", "Using header file: " + headerfile)
-x=''
-
-device.log_message("LOGGER", 'starting up on %s port %s' %server_address)
-
-while 1:
-    try:
-       data_string=device.readline()
-       daytime = time.strftime("%H:%M:%S")
-    except serial.serialutil.SerialException:
-       device.close_port()
-       device.log_message("LOGGER", "cannot read data-line. Restarting port and waiting 5 seconds...")
-##       if use_sense:
-##           sense.error()
-       time.sleep(5)
-       device.open_port()
-    except KeyboardInterrupt:
-       device.log_message("LOGGER", "aborted by user!")
-       device.close_port()
-       device.log_message("LOGGER", "Writing data...")
-       fo = open(file, "a")
-       fo.write(x)
-       fo.close()
-       device.log_message("LOGGER", "bye...")
-##       if use_sense:
-##          sense.sense.clear()
-       break
-    except:
-       device.close_port()
-       device.log_message("LOGGER", "something went wrong... Restarting port and waiting 5 seconds...")
-       device.log_message("LOGGER", "    --- error type: " + str(sys.exc_info()[0]))
-       device.log_message("LOGGER", "    --- error value: " + str(sys.exc_info()[1]))
-       device.log_message("LOGGER", "    --- error traceback: " + str(sys.exc_info()[2]))
-##       if use_sense:
-##           sense.error()
-       time.sleep(5)
-       device.open_port()
+fo = open(headerfile, "r")
+header = fo.read()
+fo.close()
+columns = data_columns(header)
+if use_binary:
+    # binary copy of the data for the readers that map it with numpy
+    binary = lambda datafile, out: BinaryWriter(binary_name(datafile), columns, out)
+else:
+    binary = None
 
-    if data_string <> "":
-##       if use_sense:
-##          ambient_data = sense.sense_sensor_string()
-##          sense.increase()
-       x+=daytime + '\t' + data_string
-       # transmit TCP data
-       sock = send_string(data_string, server_address, sock)
-    counter+=1;
-    newdate = datetime.datetime.now()
+writer = DiskWriter(lambda: data_file_name(data_path, name=basefilename),
+                    lambda newname: create_data_file(newname, header=headerfile),
+                    journal, binary = binary, size_budget = flush_bytes,
+                    time_budget = flush_seconds, fsync = fsync)
+sender = BroadcastServer(server_address)
+if live_events:
+    events = LiveEvents(columns, header.split('\n')[1].rstrip('\r').split('\t'), events_path,
+                        summary_path, integral_length, data_length, baseline_length)
+    device.log_message("LOGGER", "Live results in: " + summary_path)
+else:
+    events = None
+# commands and queries of the gui and of the cron jobs go through the logger
+broker = SerialBroker(device.broker_path, device)
+device.log_message("LOGGER", "Serial broker listening on " + device.broker_path)
+acquisition = Acquisition(device, writer, sender, disk_queue = disk_queue,
+                          network_queue = network_queue, stats_interval = stats_interval,
+                          events = events, broker = broker)
 
-    # Create a new file at midnight
-    if newdate.day <> filedate.day:
-##       if use_sense:
-##           sense.sense.clear(sense.blue)
-       fo = open(file, "a")
-       fo.write(x)
-       fo.close()
-       x=''
-       counter=0
-       filedate = newdate
-       file = create_data_file(data_path, header=headerfile, name=basefilename)
-       device.log_message("LOGGER", "Writing to Datafile: " + file)
-    elif counter >= buffersize:
-##       if use_sense:
-##           sense.sense.clear(sense.green)
-       fo = open(file, "a")
-       fo.write(x)
-       fo.close()
-       x=''
-       counter=0
+device.log_message("LOGGER", 'starting up on %s port %s' %server_address)
+acquisition.run()
+device.log_message("LOGGER", "bye...")